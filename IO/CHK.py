@@ -0,0 +1,545 @@
+# -*- coding: utf-8 -*-
+"""
+CHK
+===
+
+Chunked array format with compressed chunks.
+
+A chunked array is a directory with the extension '.chk' that contains a
+small json index with shape, dtype, order, the chunk grid and compression,
+and one zlib or lzma compressed file per chunk. Chunks that are equal to the
+fill value are not stored, so sparse binary masks take little disk space.
+
+The chunk grid is given by the edges of the chunks along each axis and can be
+aligned with the blocks of :func:`ParallelProcessing.BlockProcessing.split_into_blocks`,
+see :func:`~ParallelProcessing.BlockProcessing.block_edges`. Each block then
+reads and writes exactly the chunks it needs and the workers of
+:func:`~ParallelProcessing.BlockProcessing.process` write disjoint chunks.
+
+Example
+-------
+>>> import IO.IO as io
+>>> import ParallelProcessing.BlockProcessing as bp
+>>> edges = bp.block_edges(source, axes=[2], size_max=100, overlap=10)
+>>> sink = io.create('result.chk', shape=source.shape, dtype=bool, edges=edges, chunks=256)
+>>> bp.process(function, source, sink, axes=[2], size_max=100, overlap=10)
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE.txt)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+import os
+import json
+import zlib
+import lzma
+import fcntl
+import itertools
+import threading
+import contextlib
+import concurrent.futures as cf
+
+import numpy as np
+
+import IO.Source as src
+import IO.Slice as slc
+
+import ParallelProcessing.Parallelism as par
+
+
+extension = 'chk';
+"""Extension of chunked array directories."""
+
+index_name = 'index.json';
+"""Name of the index file in the chunked array directory."""
+
+default_chunks = 128;
+"""Default chunk size along each axis."""
+
+default_compression = 'zlib';
+"""Default compression of the chunks."""
+
+default_level = 1;
+"""Default compression level."""
+
+compressors = {
+  'zlib' : (lambda data, level: zlib.compress(data, level), zlib.decompress),
+  'lzma' : (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+  None   : (lambda data, level: data, lambda data: data)
+};
+"""Compression and decompression functions of the compression methods."""
+
+
+###############################################################################
+### Source class
+###############################################################################
+
+class Source(src.Source):
+  """Chunked array source.
+
+  Arguments
+  ---------
+  location : str
+    The directory of the chunked array.
+  shape : tuple or None
+    The shape of a new chunked array.
+  dtype : dtype or None
+    The data type of a new chunked array.
+  order : 'C', 'F' or None
+    The order of the data in the chunks, 'F' if None.
+  chunks : int, tuple or None
+    The chunk size along each axis. If None, :const:`default_chunks`.
+  edges : list or None
+    Optional edges of the chunks along each axis, e.g. aligned with blocks.
+    Chunks are split further to have at most the chunk size.
+  compression : 'zlib', 'lzma' or None
+    The compression of the chunks.
+  level : int or None
+    The compression level.
+  mode : 'r', 'w' or None
+    If 'w' a new array is created, otherwise an existing array is opened and
+    only created if it does not exists.
+  name : str or None
+    The name of the source.
+  """
+  def __init__(self, location, shape = None, dtype = None, order = None, chunks = None, edges = None,
+               compression = default_compression, level = None, mode = None, name = None):
+    super(Source, self).__init__(name=name);
+    self._location = os.path.abspath(location);
+
+    if mode != 'w' and os.path.exists(self.index_location):
+      self._load();
+    elif shape is not None and dtype is not None and mode != 'r':
+      self._create(shape=shape, dtype=dtype, order=order, chunks=chunks, edges=edges, compression=compression, level=level);
+    else:
+      raise ValueError('Cannot open or create chunked array at %r!' % location);
+
+  @property
+  def name(self):
+    return 'Chunked-Source';
+
+  @property
+  def shape(self):
+    return self._shape;
+
+  @property
+  def dtype(self):
+    return self._dtype;
+
+  @property
+  def order(self):
+    return self._order;
+
+  @property
+  def location(self):
+    return self._location;
+
+  @property
+  def index_location(self):
+    return os.path.join(self._location, index_name);
+
+  @property
+  def edges(self):
+    """The edges of the chunks along each axis."""
+    return self._edges;
+
+  @property
+  def chunks_shape(self):
+    """The number of chunks along each axis."""
+    return tuple(len(e) - 1 for e in self._edges);
+
+  @property
+  def compression(self):
+    return self._compression;
+
+  @property
+  def array(self):
+    return self.__getitem__(Ellipsis);
+
+  def exists(self):
+    return os.path.exists(self.index_location);
+
+
+  ### Chunks
+  def chunk_location(self, index):
+    """The file of a chunk."""
+    return os.path.join(self._location, '.'.join('%d' % i for i in index));
+
+  def chunk_range(self, index):
+    """The lower and upper bounds of a chunk along each axis."""
+    return tuple((int(e[i]), int(e[i+1])) for e, i in zip(self._edges, index));
+
+  def chunks(self, region):
+    """The indices of the chunks overlapping a region.
+
+    Arguments
+    ---------
+    region : list of tuples
+      The lower and upper bounds of the region along each axis.
+
+    Returns
+    -------
+    indices : list of tuples
+      The indices of the overlapping chunks.
+    """
+    ranges = [range(np.searchsorted(e, lo, side='right') - 1, np.searchsorted(e, hi, side='left'))
+              for e, (lo, hi) in zip(self._edges, region)];
+    return list(itertools.product(*ranges));
+
+  def read_chunk(self, index):
+    """Read a chunk, None if it is not stored and equal to the fill value."""
+    try:
+      with open(self.chunk_location(index), 'rb') as f:
+        data = f.read();
+    except FileNotFoundError:
+      return None;
+    shape = tuple(hi - lo for lo, hi in self.chunk_range(index));
+    data = compressors[self._compression][1](data);
+    return np.frombuffer(data, dtype=self._dtype).reshape(shape, order=self._order);
+
+  def write_chunk(self, index, data):
+    """Write a chunk atomically, chunks equal to the fill value are removed."""
+    location = self.chunk_location(index);
+    if not np.any(data != self._fill):
+      if os.path.exists(location):
+        os.remove(location);
+      return;
+    data = np.asarray(data, dtype=self._dtype).tobytes(order=self._order);
+    data = compressors[self._compression][0](data, self._level);
+    temporary = '%s.%d.%d.tmp' % (location, os.getpid(), threading.get_ident());
+    with open(temporary, 'wb') as f:
+      f.write(data);
+    os.replace(temporary, location);
+
+
+  ### Data
+  def __getitem__(self, slicing, processes = None):
+    region, post = slc.sliced_region(slicing, self._shape);
+    return self._read(region, processes=processes)[post];
+
+  def __setitem__(self, slicing, data, processes = None):
+    region, post = slc.sliced_region(slicing, self._shape);
+    region_shape = tuple(hi - lo for lo, hi in region);
+    if isinstance(data, src.Source):
+      data = data.array;
+    if _is_full(post, region):
+      data = np.asarray(data);
+      values = np.broadcast_to(data, tuple(n for n, p in zip(region_shape, post) if not isinstance(p, (int, np.integer))));
+      values = values[tuple(np.newaxis if isinstance(p, (int, np.integer)) else slice(None) for p in post)];
+    else:
+      values = self._read(region, processes=processes);
+      values[post] = data;
+    self._write(region, values, processes=processes);
+
+  def _read(self, region, processes = None):
+    shape = tuple(hi - lo for lo, hi in region);
+    array = np.full(shape, self._fill, dtype=self._dtype, order=self._order);
+    if array.size == 0:
+      return array;
+
+    def read(index):
+      data = self.read_chunk(index);
+      if data is not None:
+        target, source = _intersection(region, self.chunk_range(index));
+        array[target] = data[source];
+
+    _map(read, self.chunks(region), processes=processes);
+    return array;
+
+  def _write(self, region, values, processes = None):
+    if any(hi <= lo for lo, hi in region):
+      return;
+
+    def write(index):
+      chunk_range = self.chunk_range(index);
+      target, source = _intersection(region, chunk_range);
+      if all(lo <= c0 and c1 <= hi for (lo, hi), (c0, c1) in zip(region, chunk_range)):
+        self.write_chunk(index, values[target]);
+      else:
+        with _locked(self.chunk_location(index) + '.lock'):
+          data = self.read_chunk(index);
+          if data is None:
+            data = np.full(tuple(c1 - c0 for c0, c1 in chunk_range), self._fill, dtype=self._dtype, order=self._order);
+          else:
+            data = data.copy(order=self._order);
+          data[source] = values[target];
+          self.write_chunk(index, data);
+
+    _map(write, self.chunks(region), processes=processes);
+
+
+  ### Index
+  def _create(self, shape, dtype, order, chunks, edges, compression, level):
+    self._shape = tuple(int(s) for s in shape);
+    self._dtype = np.dtype(dtype);
+    self._order = 'F' if order is None else order;
+    self._edges = chunk_edges(self._shape, chunks=chunks, edges=edges);
+    if compression not in compressors:
+      raise ValueError('Compression %r not in %r!' % (compression, list(compressors.keys())));
+    self._compression = compression;
+    self._level = default_level if level is None else level;
+    self._fill = self._dtype.type(0);
+
+    os.makedirs(self._location, exist_ok=True);
+    for name in os.listdir(self._location):
+      if name != index_name:
+        os.remove(os.path.join(self._location, name));
+
+    index = dict(shape=self._shape, dtype=self._dtype.str, order=self._order,
+                 edges=[[int(e) for e in edge] for edge in self._edges],
+                 compression=self._compression, level=self._level, fill=self._fill.item());
+    temporary = self.index_location + '.tmp';
+    with open(temporary, 'w') as f:
+      json.dump(index, f);
+    os.replace(temporary, self.index_location);
+
+  def _load(self):
+    with open(self.index_location, 'r') as f:
+      index = json.load(f);
+    self._shape = tuple(index['shape']);
+    self._dtype = np.dtype(index['dtype']);
+    self._order = index['order'];
+    self._edges = [np.array(e, dtype=int) for e in index['edges']];
+    self._compression = index['compression'];
+    self._level = index['level'];
+    self._fill = self._dtype.type(index['fill']);
+
+
+  ### Parallel processing
+  def as_virtual(self):
+    return VirtualSource(source=self);
+
+  def as_real(self):
+    return self;
+
+  def as_buffer(self):
+    raise RuntimeError('The chunked source %r has no buffer!' % self);
+
+
+class VirtualSource(src.VirtualSource):
+  """Virtual chunked array source."""
+
+  @property
+  def name(self):
+    return 'Virtual-Chunked-Source';
+
+  def as_virtual(self):
+    return self;
+
+  def as_real(self):
+    return Source(location=self.location, mode='r');
+
+  def as_buffer(self):
+    return self.as_real().as_buffer();
+
+
+###############################################################################
+### IO Interface
+###############################################################################
+
+def is_chunked(source):
+  """Checks if this source is a chunked array source."""
+  if isinstance(source, (Source, VirtualSource)):
+    return True;
+  if isinstance(source, str):
+    return os.path.exists(os.path.join(source, index_name));
+  return False;
+
+
+def read(source, slicing = None, processes = None, **kwargs):
+  """Read data from a chunked array.
+
+  Arguments
+  ---------
+  source : str or Source
+    The chunked array.
+  slicing : slice specification or None
+    Optional sub-slice to read.
+  processes : int or None
+    Number of threads to decompress the chunks.
+
+  Returns
+  -------
+  data : array
+    The data in the chunked array.
+  """
+  if not isinstance(source, Source):
+    source = Source(source, mode='r');
+  if slicing is None:
+    slicing = Ellipsis;
+  return source.__getitem__(slicing, processes=processes);
+
+
+def write(sink, data, slicing = None, processes = None, **kwargs):
+  """Write data to a chunked array.
+
+  Arguments
+  ---------
+  sink : str or Source
+    The chunked array.
+  data : array or Source
+    The data to write.
+  slicing : slice specification or None
+    Optional sub-slice of an existing array to write to.
+  processes : int or None
+    Number of threads to compress the chunks.
+
+  Returns
+  -------
+  sink : str or Source
+    The sink.
+  """
+  if slicing is None:
+    slicing = Ellipsis;
+  if isinstance(sink, str) and (not is_chunked(sink) or kwargs or slicing is Ellipsis):
+    source = create(location=sink, shape=data.shape, dtype=data.dtype, **kwargs);
+  elif isinstance(sink, str):
+    source = Source(sink, mode='r');
+  else:
+    source = sink;
+  source.__setitem__(slicing, data, processes=processes);
+  return sink;
+
+
+def create(location = None, shape = None, dtype = None, order = None, mode = None, as_source = True,
+           chunks = None, edges = None, compression = default_compression, level = None, **kwargs):
+  """Create a chunked array.
+
+  Arguments
+  ---------
+  location : str
+    The directory of the chunked array.
+  shape : tuple
+    The shape of the array.
+  dtype : dtype
+    The data type of the array.
+  order : 'C', 'F' or None
+    The order of the data in the chunks.
+  mode : 'w' or None
+    Mode to open the array, by default an existing array is replaced.
+  as_source : bool
+    If True, return as Source class.
+  chunks, edges, compression, level
+    The chunk grid and compression, see :class:`Source`.
+
+  Returns
+  -------
+  source : Source or str
+    The chunked array.
+  """
+  mode = 'w' if mode is None else mode;
+  source = Source(location, shape=shape, dtype=dtype, order=order, chunks=chunks, edges=edges,
+                  compression=compression, level=level, mode=mode);
+  if as_source:
+    return source;
+  else:
+    return source.location;
+
+
+###############################################################################
+### Helpers
+###############################################################################
+
+def chunk_edges(shape, chunks = None, edges = None):
+  """Edges of the chunks along each axis.
+
+  Arguments
+  ---------
+  shape : tuple
+    The shape of the array.
+  chunks : int, tuple or None
+    The maximal chunk size along each axis. If None, :const:`default_chunks`.
+  edges : list or None
+    Edges along each axis that need to be chunk edges, None for an axis
+    without edges.
+
+  Returns
+  -------
+  edges : list of arrays
+    The chunk edges along each axis including 0 and the size of the axis.
+  """
+  ndim = len(shape);
+  if chunks is None:
+    chunks = default_chunks;
+  if not isinstance(chunks, (list, tuple)):
+    chunks = (chunks,) * ndim;
+  if edges is None:
+    edges = [None] * ndim;
+
+  result = [];
+  for n, c, e in zip(shape, chunks, edges):
+    e = [] if e is None else [int(x) for x in e];
+    e = sorted(set([0, n] + e));
+    edge = [e[0]];
+    for lo, hi in zip(e[:-1], e[1:]):
+      if c is None or c <= 0:
+        parts = 1;
+      else:
+        parts = max(1, int(np.ceil(float(hi - lo) / c)));
+      edge.extend(int(x) for x in np.linspace(lo, hi, parts + 1)[1:]);
+    result.append(np.array(edge, dtype=int));
+  return result;
+
+
+def _is_full(post, region):
+  """Check if a relative slicing covers the full region."""
+  for p, (lo, hi) in zip(post, region):
+    if isinstance(p, (int, np.integer)):
+      continue;
+    if not isinstance(p, slice) or p.indices(hi - lo) != (0, hi - lo, 1):
+      return False;
+  return True;
+
+
+def _intersection(region, chunk_range):
+  """Slicings of the overlap of a region and a chunk in region and chunk coordinates."""
+  target = [];
+  source = [];
+  for (lo, hi), (c0, c1) in zip(region, chunk_range):
+    a, b = max(lo, c0), min(hi, c1);
+    target.append(slice(a - lo, b - lo));
+    source.append(slice(a - c0, b - c0));
+  return tuple(target), tuple(source);
+
+
+def _map(function, indices, processes = None):
+  """Apply a function to the chunks in parallel threads."""
+  if processes is None:
+    processes = par.threads();
+  processes = min(processes, len(indices));
+  if processes > 1:
+    with cf.ThreadPoolExecutor(processes) as executor:
+      list(executor.map(function, indices));
+  else:
+    for index in indices:
+      function(index);
+
+
+@contextlib.contextmanager
+def _locked(location):
+  """Exclusive lock on a file for partial chunk updates."""
+  with open(location, 'a') as f:
+    fcntl.flock(f, fcntl.LOCK_EX);
+    try:
+      yield;
+    finally:
+      fcntl.flock(f, fcntl.LOCK_UN);
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import numpy as np
+  import IO.IO as io
+  import ParallelProcessing.BlockProcessing as bp
+
+  source = io.as_source(np.asarray(np.random.rand(50,60,70) > 0.9, order='F'));
+  edges = bp.block_edges(source, axes=[2], size_max=20, overlap=4);
+  sink = io.create('test.chk', shape=source.shape, dtype=bool, edges=edges, chunks=32);
+  print(sink, sink.chunks_shape)
+
+  bp.process(np.logical_not, source, sink, axes=[2], size_max=20, overlap=4, processes=2);
+  print(np.all(io.read('test.chk') == np.logical_not(source.array)))
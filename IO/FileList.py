@@ -6,6 +6,11 @@ FileList
 Module to handle sources distributed over a list of files.
 
 File lists ar specified using a :mod:`~ClearMap.Utils.TagExpression`.
+
+The files, their shapes, data types and data offsets are held in a
+:class:`FileIndex` that is built once per source and rebuilt when the
+modification time of a directory of the files changes. Files with a data
+offset are read directly into the sink without decoding.
 """
 __author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
 __license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE.txt)'
@@ -22,12 +27,12 @@ import itertools
 import numbers
 
 import numpy as np
-import multiprocessing as mp
 import concurrent.futures
 
 import IO.FileUtils as fu
 import IO.Source as src
 import IO.Slice as slc
+import IO.NPY as npy
 
 import sys
 if sys.version_info[0] < 3:
@@ -38,6 +43,7 @@ else:
 import Utils.TagExpression as te
 
 import ParallelProcessing.ParallelTraceback as ptb
+import ParallelProcessing.Parallelism as par
 
 ###############################################################################
 ### Source class
@@ -52,7 +58,7 @@ class Source(src.VirtualSource):
   the shape of the data in each file, i.e. shape = file_list_shape + array_shape.
   """
   
-  def __init__(self, expression = None, file_list = None, axes_order = None, shape = None, dtype = None, order = None, name = None):
+  def __init__(self, expression = None, file_list = None, axes_order = None, shape = None, dtype = None, order = None, index = None, name = None):
     """File list source class construtor.
     
     Arguments
@@ -63,6 +69,8 @@ class Source(src.VirtualSource):
       List of filenames.
     axes_order : list of str
       List of names indicating the ordering of the tags along the axes.
+    index : FileIndex or None
+      Optional index of the files, e.g. from a virtual source.
     name : str or None
      Optional name of the source.
      
@@ -80,6 +88,8 @@ class Source(src.VirtualSource):
     self._shape = shape;
     self._dtype = dtype;
     self._order = order;
+    self._specified = (shape, dtype);
+    self._index = index;
   
   
   @property
@@ -88,7 +98,23 @@ class Source(src.VirtualSource):
   
   
   @property
-  def file_list(self, sort = True):
+  def index(self):
+    """The cached index of the files.
+    
+    Returns
+    -------
+    index : FileIndex
+      The index of the files, rebuilt if a directory of the files changed.
+    """
+    if self._index is None or not self._index.is_valid():
+      if self._index is not None:
+        self._shape, self._dtype = self._specified;
+      self._index = FileIndex(expression=self._expression, file_list=self._file_list);
+    return self._index;
+  
+  
+  @property
+  def file_list(self):
     """The underlying file list.
     
     Returns
@@ -96,9 +122,7 @@ class Source(src.VirtualSource):
     filelist : list
       The underlying sources of this source.
     """
-    if self._file_list is None:
-      self._file_list = _file_list(expression=self.expression, sort=sort);
-    return self._file_list;
+    return self.index.file_list;
   
   @file_list.setter
   def file_list(self, value):
@@ -156,8 +180,9 @@ class Source(src.VirtualSource):
     shape : tuple
       The shape of the source.
     """
+    index = self.index;
     if self._shape is None: #cache the result
-      self._shape = shape(expression=self.expression, file_list=self.file_list, axes_order=self.axes_order, axis=axis);
+      self._shape = index.shape(-1) + index.shape_list(self.expression, axes_order=self.axes_order);
     return self._shape;  
   
   @shape.setter
@@ -174,8 +199,9 @@ class Source(src.VirtualSource):
     dtype : dtype
       The data type of the source.
     """
+    index = self.index;
     if self._dtype is None:
-      self._dtype = dtype(expression=self._expression, file_list=self.file_list);
+      self._dtype = index.dtype(0);
     return self._dtype;
   
   
@@ -200,13 +226,13 @@ class Source(src.VirtualSource):
   @property
   def shape_file(self):
     """Source shape of the individual files."""
-    return shape_file(expression=self._expression, file_list=self._file_list);
+    return self.shape[:-self.expression.ntags()];
   
   
   @property
   def shape_list(self):
     """Source shape of the file list."""
-    return shape_list(expression=self._expression, file_list=self._file_list, axes_order=self.axes_order);
+    return self.shape[-self.expression.ntags():];
   
   
   @property
@@ -247,7 +273,25 @@ class Source(src.VirtualSource):
     return axes_to_tags;
   
   
-  def __getitem__(self, slicing, processes = None, order = None):
+  def __getitem__(self, slicing, processes = None, order = None, sink = None):
+    """Read a slice of the file list.
+    
+    Arguments
+    ---------
+    slicing : slice specification
+      The slicing of the source.
+    processes : int, 'serial' or None
+      The number of threads reading the files.
+    order : 'C', 'F' or None
+      The order of a new array.
+    sink : array or None
+      Optional array of the sliced shape the files are read into.
+    
+    Returns
+    -------
+    data : array
+      The data, the sink if given.
+    """
     e  = self.expression;
     
     shape = self.shape;
@@ -266,8 +310,8 @@ class Source(src.VirtualSource):
     #sliced_shape_list = slc.sliced_shape(slicing=slicing_list, shape=shape_list);
     
     #start indices
-    indices_start = self.expression.indices(self.file_list[0]);
-    #print(indices_start)
+    index = self.index;
+    indices_start = index.indices(e)[0][self.tag_to_axes_order()];
     #TODO: steps in file list
     
     #genereate file list to read
@@ -288,7 +332,7 @@ class Source(src.VirtualSource):
       elif isinstance(sl, (list, np.ndarray)):
         indices.append(np.array(sl) + i);
         n = len(indices[-1]);
-        slicing_list_indices.append(sl);
+        slicing_list_indices.append(range(n));
         shape_list_keep_dims += (n,);
         slicing_keep_dims_to_final += (slice(None),);
       elif isinstance(sl, numbers.Integral):
@@ -310,31 +354,29 @@ class Source(src.VirtualSource):
     if len(axes_to_tags) > 1 and axes_to_tags != list(range(len(axes_to_tags))):
       indices = [tuple(i[j] for j in axes_to_tags) for i in indices];
     
-    fl = [e.string_from_index(i) for i in indices];
-    #print(fl);
-    
-    dtype = self.dtype;
+    fl = index.files(e, indices);
     
-    data = np.zeros(sliced_shape_file + shape_list_keep_dims, dtype=dtype, order=order);    
+    shape_keep_dims = sliced_shape_file + shape_list_keep_dims;
+    if sink is None:
+      data = np.empty(shape_keep_dims, dtype=self.dtype, order=order);
+    else:
+      data = sink.array if isinstance(sink, src.Source) else sink;
+      data = np.expand_dims(data, tuple(len(sliced_shape_file) + a for a, s in enumerate(slicing_keep_dims_to_final[1:]) if s == 0));
+      if data.shape != shape_keep_dims:
+        raise ValueError('The sink shape %r does not match the sliced shape %r!' % (data.shape, shape_keep_dims));
     
-    #@ptb.parallel_traceback
-    def func(filename, index, data=data, slicing=slicing_file):
-      index = (Ellipsis,) + index;
-      data[index] = io.read(filename, slicing=slicing, processes = 'serial');
+    def func(filename, position):
+      index.read(filename, data[(Ellipsis,) + position], slicing=slicing_file);
     
     if processes is None:
-      processes = mp.cpu_count();
+      processes = par.processes();
     
-    if processes == 'serial':
-      for f,i in zip(fl, slicing_list_indices):
-        func(f,i);
-    else:
-      with concurrent.futures.ThreadPoolExecutor(processes) as executor:
-        executor.map(func, fl, slicing_list_indices);
+    _map(func, fl, slicing_list_indices, processes=processes);
     
-    data = data[slicing_keep_dims_to_final];
+    if sink is not None:
+      return sink;
     
-    return data;
+    return data[slicing_keep_dims_to_final];
 
   
   def __setitem__(self, slicing, data, processes = None):
@@ -352,7 +394,7 @@ class Source(src.VirtualSource):
     shape_list = shape[-ndim_list:];
     
     #start indices
-    indices_start = self.expression.indices(self.file_list[0]);
+    indices_start = self.index.indices(e)[0][self.tag_to_axes_order()];
     #TODO: steps in file list
     
     #genereate file list to read
@@ -385,7 +427,7 @@ class Source(src.VirtualSource):
     fu.create_directory(fl[0], split=True);     
     
     if processes is None:
-      processes = mp.cpu_count();
+      processes = par.processes();
     
     @ptb.parallel_traceback
     def func(filename, index, data=data, slicing=slicing_file):
@@ -401,7 +443,7 @@ class Source(src.VirtualSource):
   
   @property
   def array(self):
-    return self._getitem__(slice(None));
+    return self.__getitem__(slice(None));
   
   
   
@@ -431,7 +473,7 @@ class Source(src.VirtualSource):
       order = '';
     
     try:
-      file_list = '<%d>' % len(self._file_list);
+      file_list = '<%d>' % len(self._file_list if self._index is None else self._index);
     except:
       file_list = '';    
     
@@ -451,8 +493,8 @@ class Source(src.VirtualSource):
 
   def as_virtual(self):
     return VirtualSource(expression=self.expression, file_list=None,
-                         shape = self._shape, dtype = self._dtype, order = self._order,
-                         axes_order = self._axes_order);
+                         shape = self.shape, dtype = self.dtype, order = self._order,
+                         axes_order = self._axes_order, index = self.index);
                          
   def as_buffer(self):
    return self.array;                        
@@ -461,11 +503,12 @@ class Source(src.VirtualSource):
 class VirtualSource(src.VirtualSource):
   """Virtual file list source."""
   
-  def __init__(self, expression = None, file_list = None, shape = None, dtype = None, order = None, axes_order = None, source = None, name = None):
+  def __init__(self, expression = None, file_list = None, shape = None, dtype = None, order = None, axes_order = None, index = None, source = None, name = None):
     super(VirtualSource, self).__init__(source=source, shape=shape, dtype=dtype, order=order, name=name);
     self._expression = expression;
     self._file_list = file_list;
     self._axes_order = axes_order;
+    self._index = index;
   
   @property 
   def name(self):
@@ -548,7 +591,7 @@ class VirtualSource(src.VirtualSource):
   
   def as_real(self):
     return Source(expression=self.expression, file_list=self.file_list, axes_order=self.axes_order,
-                  shape=self.shape, dtype=self.dtype, order=self.order, name=self.name);
+                  shape=self.shape, dtype=self.dtype, order=self.order, index=self._index, name=self.name);
 
   def as_buffer(self):
     return self.as_real().as_buffer();
@@ -584,7 +627,7 @@ class VirtualSource(src.VirtualSource):
       order = '';
     
     try:
-      file_list = '<%d>' % len(self._file_list);
+      file_list = '<%d>' % len(self._file_list if self._index is None else self._index);
     except:
       file_list = '';    
     
@@ -599,6 +642,247 @@ class VirtualSource(src.VirtualSource):
     return name + shape + dtype + file_list + expression
 
 
+###############################################################################
+### File index
+###############################################################################
+
+class FileIndex(object):
+  """Index of the files of a file list with their shapes, types and data offsets.
+  
+  Arguments
+  ---------
+  expression : str, Expression or None
+    The expression specifying the file list.
+  file_list : list of str or None
+    The file names, if None the files matching the expression.
+  
+  Note
+  ----
+  The file information is read from the file headers on first use and kept,
+  the index is invalid once the modification time of a directory changes.
+  """
+  def __init__(self, expression = None, file_list = None):
+    self.file_list = _file_list(expression=expression, file_list=file_list, sort=True);
+    self.directories = sorted(set(os.path.dirname(os.path.abspath(f)) for f in self.file_list));
+    self.stamp = directory_stamp(self.directories);
+    self.positions = {f : i for i, f in enumerate(self.file_list)};
+    self.infos = [None] * len(self.file_list);
+    self.tables = {};
+  
+  def is_valid(self):
+    """True if no directory of the files changed since the index was built."""
+    return self.stamp == directory_stamp(self.directories);
+  
+  def info(self, file):
+    """Shape, data type, data offset and order of a file.
+    
+    Arguments
+    ---------
+    file : int or str
+      The position or name of the file.
+    
+    Returns
+    -------
+    info : tuple or None
+      The shape, dtype, offset and order of the data in the file, the offset
+      is None if the data cannot be mapped. None if the file is not indexed.
+    """
+    if not isinstance(file, numbers.Integral):
+      file = self.positions.get(file);
+      if file is None:
+        return None;
+    if len(self.infos) == 0:
+      raise ValueError('Cannot determine the file information of a file list without files!');
+    if self.infos[file] is None:
+      self.infos[file] = file_info(self.file_list[file]);
+    return self.infos[file];
+  
+  def table(self, expression):
+    """Tag indices of the files and a lookup table from tag indices to files.
+    
+    Arguments
+    ---------
+    expression : Expression
+      The tag expression of the files.
+    
+    Returns
+    -------
+    indices : array
+      The tag indices of the files as array of shape (n_files, n_tags).
+    lookup : tuple
+      The origin of the tag indices and an array of the file positions over 
+      the range of tag indices, -1 for missing files. If the indices are too 
+      sparse for an array a dict from the index tuples to file positions.
+    
+    Note
+    ----
+    The table is built once per expression with a single match over all files.
+    """
+    key = expression.tag();
+    if key not in self.tables:
+      indices = expression.indices_array(self.file_list);
+      if len(indices) == 0:
+        lookup = {};
+      else:
+        origin = indices.min(axis=0);
+        extent = tuple(indices.max(axis=0) - origin + 1);
+        if np.prod(extent, dtype=float) <= 8 * len(indices) + 1024:
+          grid = np.full(extent, -1, dtype=int);
+          grid[tuple((indices - origin).T)] = np.arange(len(indices));
+          lookup = (origin, grid);
+        else:
+          lookup = {tuple(i) : p for p, i in enumerate(indices.tolist())};
+      self.tables[key] = (indices, lookup);
+    return self.tables[key];
+  
+  def indices(self, expression):
+    """Tag indices of the files as array of shape (n_files, n_tags)."""
+    return self.table(expression)[0];
+  
+  def files(self, expression, indices):
+    """File names for tag indices.
+    
+    Arguments
+    ---------
+    expression : Expression
+      The tag expression of the files.
+    indices : array or list of tuples
+      The tag indices of the files.
+    
+    Returns
+    -------
+    files : list of str
+      The file names, names of files not in the index are generated from the
+      expression.
+    """
+    indices = np.asarray(indices, dtype=int).reshape(-1, expression.ntags());
+    lookup = self.table(expression)[1];
+    if isinstance(lookup, dict):
+      positions = [lookup.get(tuple(i), -1) for i in indices.tolist()];
+    else:
+      origin, grid = lookup;
+      local = indices - origin;
+      valid = np.all((local >= 0) & (local < grid.shape), axis=1);
+      positions = np.full(len(indices), -1, dtype=int);
+      positions[valid] = grid[tuple(local[valid].T)];
+      positions = positions.tolist();
+    return [self.file_list[p] if p >= 0 else expression.string_from_index(tuple(i)) for p, i in zip(positions, indices.tolist())];
+  
+  def shape_list(self, expression, axes_order = None):
+    """Shape of the file list along the tags.
+    
+    Arguments
+    ---------
+    expression : Expression
+      The tag expression of the files.
+    axes_order : list of str or None
+      The ordering of the tag names, if None the order in the expression.
+    
+    Returns
+    -------
+    shape : tuple of ints
+      The number of files along each tag through the first file.
+    """
+    if len(self.file_list) == 0:
+      raise ValueError('Cannot determine dimension of the file list %r without files.!' % expression);
+    tag_names = expression.tag_names();
+    if axes_order is None:
+      axes_order = tag_names;
+    if len(axes_order) == 1:
+      return (len(self.file_list),);
+    indices = self.indices(expression);
+    shape = ();
+    for a in axes_order:
+      other = [i for i, n in enumerate(tag_names) if n != a];
+      shape += (int(np.sum(np.all(indices[:, other] == indices[0, other], axis=1))),);
+    return shape;
+  
+  def shape(self, file = 0):
+    """The shape of the data in a file."""
+    return self.info(file)[0];
+  
+  def dtype(self, file = 0):
+    """The data type of the data in a file."""
+    return self.info(file)[1];
+  
+  def read(self, filename, sink, slicing = None):
+    """Read the data of a file into a sink.
+    
+    Arguments
+    ---------
+    filename : str
+      The file to read.
+    sink : array
+      The array to read the data into.
+    slicing : slice specification or None
+      The slicing of the data in the file.
+    
+    Note
+    ----
+    Files with a data offset are read into contiguous sinks with a single
+    read call if they are read in full, and copied from a memory map 
+    otherwise. Other files are decoded and copied.
+    """
+    info = self.info(filename);
+    if info is None or info[2] is None:
+      sink[...] = io.read(filename, slicing=slicing, processes='serial');
+      return;
+    
+    shape, dtype, offset, order = info;
+    full = slicing is None or all(isinstance(s, slice) and s == slice(None) for s in slc.unpack_slicing(slicing, len(shape)));
+    if full and sink.dtype == dtype and sink.shape == tuple(shape) and (sink.flags.c_contiguous if order == 'C' else sink.flags.f_contiguous):
+      buffer = sink if order == 'C' else sink.T;
+      with open(filename, 'rb') as f:
+        f.seek(offset);
+        n = f.readinto(memoryview(buffer).cast('B'));
+      if n != sink.nbytes:
+        raise IOError('Could only read %d of %d bytes from %s!' % (n, sink.nbytes, filename));
+    else:
+      memmap = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=tuple(shape), order=order);
+      sink[...] = memmap if slicing is None else memmap[slicing];
+  
+  def __len__(self):
+    return len(self.file_list);
+  
+  def __repr__(self):
+    return 'FileIndex<%d>[%s]' % (len(self.file_list), ','.join(self.directories));
+
+
+def file_info(filename):
+  """Shape, data type, data offset and order of the data in a file.
+  
+  Arguments
+  ---------
+  filename : str
+    The file.
+  
+  Returns
+  -------
+  info : tuple
+    The shape, dtype, offset and order of the data, offset and order are 
+    None if the data is not stored contiguously in the file.
+  """
+  source = io.as_source(filename);
+  memmap = None;
+  if isinstance(source, io.tif.Source):
+    memmap = source.memmap;
+  elif isinstance(source, io.mmp.Source):
+    memmap = source.array;
+  offset = order = None;
+  if isinstance(memmap, np.memmap):
+    order = npy.order(memmap);
+    if order in ('C', 'F'):
+      offset = memmap.offset;
+    else:
+      order = None;
+  return tuple(source.shape), np.dtype(source.dtype), offset, order;
+
+
+def directory_stamp(directories):
+  """Modification times of directories."""
+  return tuple(os.stat(d).st_mtime_ns if os.path.isdir(d) else None for d in directories);
+
+
 ###############################################################################
 ### IO Interface
 ###############################################################################
@@ -852,9 +1136,32 @@ def order(expression = None, file_list = None):
   else:
     return None;
 
-#TODO:
-def read(source, slicing = None, axes_order = None, **kwargs):
-  raise NotImplementedError('read for FileList not implemented yet!')
+def read(source, slicing = None, sink = None, axes_order = None, processes = None, **kwargs):
+  """Read data from a file list.
+  
+  Arguments
+  ---------
+  source : str, Expression or Source
+    The file list.
+  slicing : slice specification or None
+    Optional sub-slice to read.
+  sink : array or None
+    Optional array of the sliced shape the files are read into directly.
+  axes_order : list of str or None
+    The ordering of the tags along the axes.
+  processes : int, 'serial' or None
+    The number of threads reading the files.
+  
+  Returns
+  -------
+  data : array
+    The data, the sink if given.
+  """
+  if not isinstance(source, Source):
+    source = Source(source, axes_order=axes_order);
+  if slicing is None:
+    slicing = slice(None);
+  return source.__getitem__(slicing, processes=processes, sink=sink);
 
 def write(sink, data, slicing = None, axes_order = None, processes = None, **kwargs):
   raise NotImplementedError('write for FileList not implemented yet!')
@@ -905,6 +1212,25 @@ def _file_list(expression = None, file_list = None, sort = True, verbose = False
   return fl;
  
 
+def _map(function, files, positions, processes = None):
+  """Apply a function to files in a bounded thread pool."""
+  if processes == 'serial' or processes == 1:
+    for f, p in zip(files, positions):
+      function(f, p);
+    return;
+  
+  with concurrent.futures.ThreadPoolExecutor(processes) as executor:
+    pending = set();
+    for f, p in zip(files, positions):
+      if len(pending) >= 2 * processes:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED);
+        for future in done:
+          future.result();
+      pending.add(executor.submit(function, f, p));
+    for future in pending:
+      future.result();
+
+
 def _first_file(expression):
   fl = _file_list(expression=expression, file_list=None, sort=False, verbose=False);
   if len(fl) > 0:
@@ -1011,7 +1337,7 @@ def convert(source, sink, processes = None, verbose = False):
   sink_virtual = sink.as_virtual();
   
   if processes is None:
-    processes = mp.cpu_count();
+    processes = par.processes();
 
   @ptb.parallel_traceback
   def _convert(filename, index_slicing, sink=sink_virtual, verbose=verbose):
@@ -24,7 +24,6 @@ import pathlib
 
 import numpy as np
 
-import multiprocessing as mp
 import concurrent.futures
 
 
@@ -49,6 +48,9 @@ import concurrent.futures
 import IO.Source as src
 import IO.Slice as slc
 import IO.TIF as tif
+import IO.CHK as chk
+import IO.RLE as rle
+import IO.Occupancy as occ
 #import IO.NRRD as nrrd
 #import IO.CSV as csv
 import IO.NPY as npy
@@ -63,6 +65,8 @@ import Utils.TagExpression as te
 import Utils.Timer as tmr
 
 import ParallelProcessing.ParallelTraceback as ptb
+import ParallelProcessing.Parallelism as par
+import ParallelProcessing.WorkerPool as wp
 
 
 ###############################################################################
@@ -80,13 +84,13 @@ from Utils.utilities import CancelableProcessPoolExecutor
 
 #source_modules = [npy, tif, mmp, sma, fl, nrrd, csv, gt]
 
-source_modules = [npy, tif, mmp, sma, fl]
+source_modules = [npy, tif, mmp, sma, fl, chk, rle]
 """The valid source modules."""
 
 # file_extension_to_module = {"npy": mmp, "tif": tif, "tiff": tif, 'nrrd': nrrd,
 #                             'nrdh': nrrd, 'csv': csv, 'gt': gt}
 
-file_extension_to_module = {"npy": mmp, "tif": tif, "tiff": tif}
+file_extension_to_module = {"npy": mmp, "tif": tif, "tiff": tif, "chk": chk, "rle": rle}
 """Map between file extensions and modules that handle this file type."""        
 
 ###############################################################################
@@ -134,7 +138,9 @@ def location_to_module(location):
   module : module
     The module that handles the IO of the source specified by its location.
   """
-  if fl.is_file_list(location):
+  if isinstance(location, str) and fu.file_extension(location) == chk.extension:
+    return chk;
+  elif fl.is_file_list(location):
     return fl;
   else:
     return filename_to_module(location);
@@ -372,6 +378,27 @@ def memory(source):
     return None;
 
 
+def occupancy(source, create = False, **kwargs):
+  """Returns the occupancy pyramid of a source.
+     
+  Arguments
+  ---------
+  source : str, array or Source
+    The source specification.
+  create : bool
+    If True, compute the pyramid and write its sidecar file if there is 
+    no valid one.
+      
+  Returns
+  -------
+  occupancy : Occupancy or None
+    The foreground counts in bricks, see :mod:`~IO.Occupancy`.
+  """
+  if not isinstance(source, (str, occ.Occupancy)):
+    source = as_source(source);
+  return occ.occupancy(source, create=create, **kwargs);
+
+
 def element_strides(source):
   """Returns the strides of the data array of a source.
   
@@ -760,8 +787,9 @@ def convert_files(filenames, extension = None, path = None, processes = None, ve
     The new file format extension.
   path : str or None
     Optional path speicfication.
-  processes : int, 'serial' or None
-    The number of processes to use for parallel conversion.
+  processes : int, WorkerPool, 'serial' or None
+    The number of processes to use for parallel conversion or a persistent
+    :class:`~ParallelProcessing.WorkerPool.WorkerPool`.
   verbose : bool
     If True, print progress information.
   
@@ -784,8 +812,8 @@ def convert_files(filenames, extension = None, path = None, processes = None, ve
     timer = tmr.Timer()
     print('Converting %d files to %s!' % (n_files, extension));
   
-  if not isinstance(processes, int) and processes != 'serial':
-    processes = mp.cpu_count();
+  if not isinstance(processes, int) and not wp.is_pool(processes) and processes != 'serial':
+    processes = par.processes();
   
   #print(n_files, extension, filenames, sinks)
   _convert = functools.partial(_convert_files, n_files=n_files, extension=extension, verbose=verbose, verify=verify);
@@ -793,8 +821,8 @@ def convert_files(filenames, extension = None, path = None, processes = None, ve
   if processes == 'serial':
     [_convert(source,sink,i) for i,source,sink in zip(range(n_files), filenames, sinks)];
   else:
-    with CancelableProcessPoolExecutor(processes) as executor:
-      executor.map(_convert, filenames, sinks, range(n_files))
+    with wp.executor(processes) as executor:
+      list(executor.map(_convert, filenames, sinks, range(n_files)))
       if workspace is not None:
         workspace.executor = executor
     if workspace is not None:
@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+"""
+Occupancy
+=========
+
+Multi-resolution occupancy pyramid of binary volumes.
+
+The pyramid records the number of foreground voxels in cubic bricks of
+several sizes, by default 32^3, 256^3 and 2048^3 voxels. It is stored in a
+small sidecar file next to the volume together with the modification time
+and size of the volume, so that a stale pyramid is ignored.
+
+Processing steps use the pyramid to skip empty bricks or to crop the volume
+to the bounding box of its foreground without scanning it.
+
+Example
+-------
+>>> import IO.IO as io
+>>> import IO.TIF as tif
+>>> source = tif.convert('binary.tif', 'binary.npy', threshold=0, occupancy=True)
+>>> occupancy = io.occupancy(source)
+>>> occupancy.count(), occupancy.bounding_box()
+>>> cropped = occupancy.crop(source)
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE.txt)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+import os
+import threading
+import concurrent.futures as cf
+
+import numpy as np
+
+import IO.Slice as slc
+
+
+extension = '.occupancy.npz';
+"""Extension appended to the location of a volume for its occupancy file."""
+
+default_bricks = (32, 256, 2048);
+"""Default brick sizes of the levels of the pyramid."""
+
+default_slab_bytes = 2**28;
+"""Default size of the slabs read when computing a pyramid."""
+
+
+###############################################################################
+### Occupancy pyramid
+###############################################################################
+
+class Occupancy(object):
+  """Foreground counts of a volume in bricks of increasing size.
+
+  Arguments
+  ---------
+  shape : tuple of ints
+    The shape of the volume.
+  bricks : tuple of ints
+    The increasing brick sizes of the levels, each a multiple of the first.
+  counts : array or list of arrays
+    The counts of the finest level, or of all levels.
+  stamp : tuple or None
+    The modification time and size of the volume the counts belong to.
+  """
+  def __init__(self, shape, bricks = None, counts = None, stamp = None):
+    self.shape = tuple(int(n) for n in shape);
+    self.bricks = tuple(int(b) for b in (default_bricks if bricks is None else bricks));
+    if any(b % self.bricks[0] != 0 for b in self.bricks):
+      raise ValueError('The brick sizes %r are not multiples of the finest brick size!' % (self.bricks,));
+    self.stamp = None if stamp is None else tuple(int(s) for s in stamp);
+    if counts is None:
+      counts = [np.zeros(self.grid_shape(0), dtype=np.int64)];
+    elif isinstance(counts, np.ndarray):
+      counts = coarsen(counts, self.bricks);
+    self.counts = list(counts);
+    self._lock = threading.Lock();
+
+  @property
+  def n_levels(self):
+    """The number of levels with counts, one until :meth:`finalize` is called."""
+    return len(self.counts);
+
+  def grid_shape(self, level = 0):
+    """The number of bricks along each axis of a level."""
+    b = self.bricks[level];
+    return tuple((n + b - 1) // b for n in self.shape);
+
+  def count(self):
+    """The total number of foreground voxels."""
+    return int(np.sum(self.counts[-1], dtype=np.int64));
+
+  def add(self, data, start = 0):
+    """Add the foreground of a slab along the last axis to the finest level.
+
+    Arguments
+    ---------
+    data : array
+      The slab of the volume, non-zero values are foreground.
+    start : int
+      The position of the slab along the last axis.
+
+    Note
+    ----
+    Slabs can be added from several threads, the coarser levels are updated
+    by :meth:`finalize`.
+    """
+    counts = brick_counts(data, self.bricks[0], start=start);
+    b = self.bricks[0];
+    k0 = start // b;
+    with self._lock:
+      if self.counts[0].dtype != np.int64:
+        self.counts = [self.counts[0].astype(np.int64)];
+      self.counts[0][..., k0:k0 + counts.shape[-1]] += counts;
+
+  def finalize(self):
+    """Compute the coarser levels from the finest one."""
+    self.counts = coarsen(self.counts[0], self.bricks);
+    return self;
+
+  def region(self, level, index):
+    """The region of a brick of a level."""
+    b = self.bricks[level];
+    return tuple((i * b, min((i + 1) * b, n)) for i, n in zip(index, self.shape));
+
+  def nonempty(self, level = 0, region = None):
+    """The regions of the non-empty bricks of a level.
+
+    Arguments
+    ---------
+    level : int
+      The level of the bricks.
+    region : tuple of tuples or None
+      If given, only bricks intersecting this region are returned.
+
+    Returns
+    -------
+    regions : list of tuples
+      The lower and upper bounds of each non-empty brick.
+    """
+    counts = self.counts[level];
+    offset = np.zeros(len(self.shape), dtype=int);
+    if region is not None:
+      window = self._window(level, region);
+      counts = counts[window];
+      offset = np.array([w.start for w in window]);
+    return [self.region(level, tuple(i + offset)) for i in np.argwhere(counts > 0)];
+
+  def is_empty(self, region):
+    """True if there is no foreground in a region.
+
+    Arguments
+    ---------
+    region : tuple of tuples
+      The lower and upper bounds of the region along each axis.
+
+    Returns
+    -------
+    empty : bool
+      True if all bricks intersecting the region are empty.
+
+    Note
+    ----
+    The levels are checked from coarse to fine, the result is exact up to
+    the resolution of the finest level.
+    """
+    if any(hi <= lo for lo, hi in region):
+      return True;
+    for level in range(self.n_levels - 1, -1, -1):
+      if not np.any(self.counts[level][self._window(level, region)]):
+        return True;
+    return False;
+
+  def bounding_box(self, margin = 0):
+    """Bounding box of the foreground at the resolution of the finest level.
+
+    Arguments
+    ---------
+    margin : int
+      Additional margin around the non-empty bricks.
+
+    Returns
+    -------
+    box : tuple of tuples or None
+      The lower and upper bounds of the box along each axis, None if the
+      volume is empty.
+    """
+    counts = self.counts[0];
+    if not np.any(counts):
+      return None;
+    b = self.bricks[0];
+    box = [];
+    for d, n in enumerate(self.shape):
+      axes = tuple(a for a in range(counts.ndim) if a != d);
+      indices = np.flatnonzero(np.any(counts, axis=axes));
+      box.append((max(0, int(indices[0]) * b - margin), min(n, (int(indices[-1]) + 1) * b + margin)));
+    return tuple(box);
+
+  def crop(self, source, margin = 0):
+    """Slice of a source cropped to the bounding box of the foreground.
+
+    Arguments
+    ---------
+    source : Source
+      The volume of this pyramid.
+    margin : int
+      Additional margin around the non-empty bricks.
+
+    Returns
+    -------
+    cropped : Slice or None
+      The cropped source, None if the volume is empty.
+    """
+    box = self.bounding_box(margin=margin);
+    if box is None:
+      return None;
+    return slc.Slice(source=source, slicing=box_slicing(box));
+
+  def _window(self, level, region):
+    b = self.bricks[level];
+    return tuple(slice(max(0, lo) // b, (min(hi, n) + b - 1) // b) for (lo, hi), n in zip(region, self.shape));
+
+  def __repr__(self):
+    return 'Occupancy(%s)<%s>[%d]' % ('x'.join('%d' % n for n in self.shape),
+                                      ','.join('%d' % b for b in self.bricks), self.count());
+
+
+###############################################################################
+### Brick counts
+###############################################################################
+
+def brick_counts(data, brick, start = 0):
+  """Foreground counts of a slab in bricks.
+
+  Arguments
+  ---------
+  data : array
+    The slab, non-zero values are foreground.
+  brick : int
+    The brick size.
+  start : int
+    The position of the slab along the last axis of the volume.
+
+  Returns
+  -------
+  counts : array
+    The counts of the bricks intersecting the slab.
+  """
+  counts = np.asarray(data) != 0;
+  for d in range(counts.ndim - 1):
+    counts = np.add.reduceat(counts, np.arange(0, counts.shape[d], brick), axis=d, dtype=np.int64);
+  n = counts.shape[-1];
+  first = start % brick;
+  edges = np.concatenate([[0], np.arange(brick - first if first > 0 else brick, n, brick)]);
+  return np.add.reduceat(counts, edges, axis=-1, dtype=np.int64);
+
+
+def coarsen(counts, bricks):
+  """Counts of all levels from the counts of the finest level.
+
+  Arguments
+  ---------
+  counts : array
+    The counts of the finest level.
+  bricks : tuple of ints
+    The brick sizes of the levels.
+
+  Returns
+  -------
+  levels : list of arrays
+    The counts of each level in the smallest unsigned data type.
+  """
+  levels = [];
+  for b in bricks:
+    factor = b // bricks[0];
+    level = counts;
+    for d in range(level.ndim):
+      level = np.add.reduceat(level, np.arange(0, level.shape[d], factor), axis=d, dtype=np.int64);
+    levels.append(level.astype(np.min_scalar_type(b ** counts.ndim)));
+  return levels;
+
+
+def box_slicing(box):
+  """Slicing of a bounding box."""
+  return tuple(slice(lo, hi) for lo, hi in box);
+
+
+###############################################################################
+### Computation
+###############################################################################
+
+def compute(source, bricks = None, slab_size = None, processes = None, verbose = False):
+  """Compute the occupancy pyramid of a volume.
+
+  Arguments
+  ---------
+  source : str, array or Source
+    The volume, non-zero values are foreground.
+  bricks : tuple of ints or None
+    The brick sizes. If None, :const:`default_bricks` is used.
+  slab_size : int or None
+    The number of planes along the last axis read at once. If None, slabs
+    of about :const:`default_slab_bytes` aligned to the finest bricks.
+  processes : int or None
+    The number of threads reading the slabs. If None, the number of
+    threads from :mod:`~ParallelProcessing.Parallelism`.
+  verbose : bool
+    Print progress information.
+
+  Returns
+  -------
+  occupancy : Occupancy
+    The occupancy pyramid.
+  """
+  import IO.IO as io
+  import ParallelProcessing.Parallelism as par
+  source = io.as_source(source);
+  occupancy = Occupancy(source.shape, bricks=bricks, stamp=stamp(source));
+
+  n_planes = source.shape[-1];
+  if slab_size is None:
+    plane_bytes = int(np.prod(source.shape[:-1])) * source.dtype.itemsize;
+    slab_size = max(1, default_slab_bytes // max(1, plane_bytes));
+    if slab_size >= occupancy.bricks[0]:
+      slab_size -= slab_size % occupancy.bricks[0];
+  if processes is None:
+    processes = par.threads();
+
+  def add(z0):
+    z1 = min(z0 + slab_size, n_planes);
+    occupancy.add(source[..., z0:z1], start=z0);
+    if verbose:
+      print('Occupancy of planes %d-%d of %d' % (z0, z1, n_planes));
+
+  with cf.ThreadPoolExecutor(max_workers=processes) as executor:
+    for future in [executor.submit(add, z0) for z0 in range(0, n_planes, slab_size)]:
+      future.result();
+
+  return occupancy.finalize();
+
+
+###############################################################################
+### Sidecar file
+###############################################################################
+
+def location(source):
+  """Location of the occupancy file of a source or file name."""
+  location = source if isinstance(source, str) else getattr(source, 'location', None);
+  if not isinstance(location, str):
+    return None;
+  return location + extension;
+
+
+def stamp(source):
+  """Modification time and size of the file of a source, None if it has no file."""
+  location = source if isinstance(source, str) else getattr(source, 'location', None);
+  if not isinstance(location, str) or not os.path.exists(location):
+    return None;
+  status = os.stat(location);
+  return (status.st_mtime_ns, status.st_size);
+
+
+def write(sink, occupancy):
+  """Write an occupancy pyramid atomically.
+
+  Arguments
+  ---------
+  sink : str
+    The occupancy file.
+  occupancy : Occupancy
+    The pyramid.
+  """
+  temporary = sink + '.tmp';
+  levels = {'level_%d' % l : c for l, c in enumerate(occupancy.counts)};
+  with open(temporary, 'wb') as f:
+    np.savez(f, shape=np.array(occupancy.shape, dtype=np.int64), bricks=np.array(occupancy.bricks, dtype=np.int64),
+             stamp=np.array(occupancy.stamp if occupancy.stamp is not None else [], dtype=np.int64), **levels);
+  os.replace(temporary, sink);
+  return sink;
+
+
+def read(source):
+  """Read an occupancy pyramid.
+
+  Arguments
+  ---------
+  source : str
+    The occupancy file.
+
+  Returns
+  -------
+  occupancy : Occupancy
+    The pyramid.
+  """
+  with np.load(source) as f:
+    bricks = tuple(f['bricks']);
+    counts = [f['level_%d' % l] for l in range(len(bricks))];
+    return Occupancy(tuple(f['shape']), bricks=bricks, counts=counts, stamp=tuple(f['stamp']) or None);
+
+
+def occupancy(source, create = False, bricks = None, processes = None, verbose = False):
+  """Occupancy pyramid of a source from its sidecar file.
+
+  Arguments
+  ---------
+  source : str, array or Source
+    The volume.
+  create : bool
+    If True, compute the pyramid if there is no valid sidecar file, and
+    write the sidecar if the source is a file.
+  bricks : tuple of ints or None
+    The brick sizes of a new pyramid.
+  processes : int or None
+    The number of threads to compute a new pyramid.
+  verbose : bool
+    Print progress information.
+
+  Returns
+  -------
+  occupancy : Occupancy or None
+    The pyramid, None if there is no valid sidecar and create is False.
+
+  Note
+  ----
+  A sidecar is only valid if the modification time and size of the volume
+  match the ones recorded in it.
+  """
+  if isinstance(source, Occupancy):
+    return source;
+  sidecar = location(source);
+  if sidecar is not None and os.path.exists(sidecar):
+    result = read(sidecar);
+    if result.stamp is not None and result.stamp == stamp(source):
+      return result;
+  if not create:
+    return None;
+  result = compute(source, bricks=bricks, processes=processes, verbose=verbose);
+  if sidecar is not None and result.stamp is not None:
+    write(sidecar, result);
+  return result;
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import numpy as np
+  import IO.IO as io
+  import IO.Occupancy as occ
+
+  binary = np.zeros((100, 80, 70), dtype=bool, order='F');
+  binary[40:50, 10:20, 33:60] = True;
+  source = io.mmp.create('test_occupancy.npy', shape=binary.shape, dtype=bool, order='F');
+  source[:] = binary;
+
+  occupancy = io.occupancy(source, create=True, bricks=(8, 16, 64));
+  print(occupancy, occupancy.count() == binary.sum(), occupancy.bounding_box())
+  print(occupancy.is_empty(((0, 30), (0, 80), (0, 70))), occ.read(occ.location(source)).count())
@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+"""
+RLE
+===
+
+Run length encoded binary arrays.
+
+Binary masks of vessels consist of long runs along the contiguous axis. The
+run length encoding stores for each line along this axis the starts and
+lengths of its runs as uint32 arrays, together with the offsets of the runs
+of each line. The arrays are memory mapped from the '.rle' file, so that
+counting, bounding boxes, coordinates and the border of a mask are computed
+on the runs without decoding the mask.
+
+Example
+-------
+>>> import IO.IO as io
+>>> import IO.RLE as rle
+>>> io.write('mask.rle', mask)
+>>> source = io.as_source('mask.rle')
+>>> rle.count(source), rle.bounding_box(source)
+>>> border = rle.border(source)
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE.txt)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+import os
+import json
+
+import numpy as np
+
+import IO.Source as src
+import IO.Slice as slc
+
+
+extension = 'rle';
+"""Extension of run length encoded files."""
+
+magic = b'\x93RLE\x01';
+"""Magic bytes at the start of a run length encoded file."""
+
+alignment = 64;
+"""Alignment of the arrays in the file in bytes."""
+
+
+###############################################################################
+### Source class
+###############################################################################
+
+class Source(src.Source):
+  """Run length encoded binary source.
+
+  Arguments
+  ---------
+  location : str or None
+    The file of the run length encoding.
+  offsets, starts, lengths : array or None
+    The run length encoding if not read from the file,
+    see :func:`~ParallelProcessing.DataProcessing.ArrayProcessing.encode_runs`.
+  shape : tuple or None
+    The shape of the encoded array.
+  order : 'C' or 'F'
+    The order of the encoded array, lines run along the contiguous axis.
+  name : str or None
+    The name of the source.
+  """
+  def __init__(self, location = None, offsets = None, starts = None, lengths = None, shape = None, order = 'F', name = None):
+    super(Source, self).__init__(name=name);
+    self._location = location;
+    if offsets is None:
+      if location is None:
+        raise ValueError('Run length encoded source needs a location or the runs!');
+      offsets, starts, lengths, shape, order = _read(location);
+    self._offsets = offsets;
+    self._starts = starts;
+    self._lengths = lengths;
+    self._shape = tuple(shape);
+    self._order = order;
+
+  @property
+  def name(self):
+    return 'RLE-Source';
+
+  @property
+  def shape(self):
+    return self._shape;
+
+  @property
+  def dtype(self):
+    return np.dtype(bool);
+
+  @property
+  def order(self):
+    return self._order;
+
+  @property
+  def location(self):
+    return self._location;
+
+  @property
+  def offsets(self):
+    """The offsets of the runs of each line."""
+    return self._offsets;
+
+  @property
+  def starts(self):
+    """The starts of the runs within their line."""
+    return self._starts;
+
+  @property
+  def lengths(self):
+    """The lengths of the runs."""
+    return self._lengths;
+
+  @property
+  def n_runs(self):
+    return len(self._starts);
+
+  @property
+  def line_axis(self):
+    """The axis along which the runs are encoded."""
+    return 0 if self._order == 'F' else len(self._shape) - 1;
+
+  @property
+  def array(self):
+    return self.__getitem__(Ellipsis);
+
+  def exists(self):
+    return self._location is None or os.path.exists(self._location);
+
+  def __getitem__(self, slicing, processes = None):
+    import ParallelProcessing.DataProcessing.ArrayProcessing as ap
+    region, post = slc.sliced_region(slicing, self._shape);
+    axis = self.line_axis;
+    if all(r == (0, n) for r, n in zip(region, self._shape)):
+      return ap.decode_runs(self._offsets, self._starts, self._lengths, self._shape, order=self._order, processes=processes)[post];
+
+    lower, upper = region[axis];
+    other = [r for d, r in enumerate(region) if d != axis];
+    line_shape = tuple(n for d, n in enumerate(self._shape) if d != axis);
+    coordinates = np.meshgrid(*[np.arange(lo, hi) for lo, hi in other], indexing='ij');
+    lines = np.ravel_multi_index([c.reshape(-1, order=self._order) for c in coordinates], line_shape, order=self._order) \
+            if len(line_shape) > 0 else np.zeros(1, dtype=int);
+
+    array = ap.decode_runs(self._offsets, self._starts, self._lengths, self._shape, order=self._order,
+                           lines=lines, lower=lower, upper=upper, processes=processes);
+    other_shape = tuple(hi - lo for lo, hi in other);
+    if self._order == 'F':
+      array = array.T.reshape((upper - lower,) + other_shape, order='F');
+    else:
+      array = array.reshape(other_shape + (upper - lower,), order='C');
+    return array[post];
+
+  def __setitem__(self, *args):
+    raise NotImplementedError('Run length encoded sources are read only!');
+
+  def as_virtual(self):
+    if self._location is None:
+      return self;
+    return VirtualSource(source=self);
+
+  def as_real(self):
+    return self;
+
+  def as_buffer(self):
+    raise RuntimeError('The run length encoded source %r has no buffer!' % self);
+
+
+class VirtualSource(src.VirtualSource):
+  """Virtual run length encoded source."""
+
+  @property
+  def name(self):
+    return 'Virtual-RLE-Source';
+
+  def as_virtual(self):
+    return self;
+
+  def as_real(self):
+    return Source(location=self.location);
+
+  def as_buffer(self):
+    return self.as_real().as_buffer();
+
+
+###############################################################################
+### Run length operations
+###############################################################################
+
+def encode(source, processes = None, verbose = False):
+  """Run length encode a binary array.
+
+  Arguments
+  ---------
+  source : array or Source
+    The binary array, 'C' or 'F' contiguous.
+  processes : int or None
+    The number of processes.
+  verbose : bool
+    Print progress information.
+
+  Returns
+  -------
+  source : Source
+    The run length encoded source in memory.
+  """
+  import IO.IO as io
+  import ParallelProcessing.DataProcessing.ArrayProcessing as ap
+  source = io.as_source(source);
+  offsets, starts, lengths = ap.encode_runs(source, processes=processes, verbose=verbose);
+  return Source(offsets=offsets, starts=starts, lengths=lengths, shape=source.shape, order=source.order);
+
+
+def count(source):
+  """Number of foreground voxels."""
+  source = _as_rle(source);
+  return int(np.sum(source.lengths, dtype=np.int64));
+
+
+def bounding_box(source):
+  """Bounding box of the foreground.
+
+  Arguments
+  ---------
+  source : str or Source
+    The run length encoded source.
+
+  Returns
+  -------
+  box : tuple of tuples or None
+    The lower and upper bounds of the foreground along each axis, None if
+    there is no foreground.
+  """
+  source = _as_rle(source);
+  if source.n_runs == 0:
+    return None;
+
+  axis = source.line_axis;
+  starts = np.asarray(source.starts, dtype=np.int64);
+  line = (int(starts.min()), int((starts + source.lengths).max()));
+
+  line_shape = tuple(n for d, n in enumerate(source.shape) if d != axis);
+  lines = np.flatnonzero(np.diff(source.offsets));
+  coordinates = np.unravel_index(lines, line_shape, order=source.order);
+  box = [(int(c.min()), int(c.max()) + 1) for c in coordinates];
+  box.insert(axis, line);
+  return tuple(box);
+
+
+def where(source):
+  """Coordinates of the foreground voxels.
+
+  Arguments
+  ---------
+  source : str or Source
+    The run length encoded source.
+
+  Returns
+  -------
+  where : array
+    The coordinates of the foreground voxels as array of shape (n, ndim)
+    ordered as in the array.
+  """
+  source = _as_rle(source);
+  axis = source.line_axis;
+  line_shape = tuple(n for d, n in enumerate(source.shape) if d != axis);
+
+  lengths = np.asarray(source.lengths, dtype=np.int64);
+  n = int(lengths.sum());
+  runs = np.repeat(np.arange(source.n_runs), lengths);
+  run_starts = np.cumsum(lengths) - lengths;
+
+  result = np.zeros((n, len(source.shape)), dtype=int);
+  result[:, axis] = np.asarray(source.starts, dtype=np.int64)[runs] + np.arange(n) - run_starts[runs];
+  lines = np.repeat(np.arange(len(source.offsets) - 1), np.diff(source.offsets))[runs];
+  coordinates = np.unravel_index(lines, line_shape, order=source.order);
+  others = [d for d in range(len(source.shape)) if d != axis];
+  for d, c in zip(others, coordinates):
+    result[:, d] = c;
+  return result;
+
+
+def erode(source, processes = None, verbose = False):
+  """Erosion of the foreground with the 6-neighbourhood as run length encoded source."""
+  return _erode(source, border=False, processes=processes, verbose=verbose);
+
+
+def border(source, processes = None, verbose = False):
+  """Foreground voxels with a 6-neighbour in the background as run length encoded source.
+
+  Note
+  ----
+  Voxels outside the array are considered background.
+  """
+  return _erode(source, border=True, processes=processes, verbose=verbose);
+
+
+def _erode(source, border, processes, verbose):
+  import ParallelProcessing.DataProcessing.ArrayProcessing as ap
+  source = _as_rle(source);
+  offsets, starts, lengths = ap.erode_runs(source.offsets, source.starts, source.lengths, source.shape, order=source.order,
+                                           border=border, processes=processes, verbose=verbose);
+  return Source(offsets=offsets, starts=starts, lengths=lengths, shape=source.shape, order=source.order);
+
+
+def _as_rle(source):
+  if isinstance(source, src.VirtualSource):
+    source = source.as_real();
+  if not isinstance(source, Source):
+    source = Source(source);
+  return source;
+
+
+###############################################################################
+### IO Interface
+###############################################################################
+
+def is_rle(source):
+  """Checks if this source is a run length encoded source."""
+  if isinstance(source, (Source, VirtualSource)):
+    return True;
+  if isinstance(source, str) and os.path.isfile(source):
+    with open(source, 'rb') as f:
+      return f.read(len(magic)) == magic;
+  return False;
+
+
+def read(source, slicing = None, processes = None, **kwargs):
+  """Read the decoded data of a run length encoded source.
+
+  Arguments
+  ---------
+  source : str or Source
+    The run length encoded source.
+  slicing : slice specification or None
+    Optional sub-slice to read.
+  processes : int or None
+    The number of processes to decode the runs.
+
+  Returns
+  -------
+  data : array
+    The decoded binary data.
+  """
+  source = _as_rle(source);
+  if slicing is None:
+    slicing = Ellipsis;
+  return source.__getitem__(slicing, processes=processes);
+
+
+def write(sink, data, processes = None, **kwargs):
+  """Run length encode data and write it to a file.
+
+  Arguments
+  ---------
+  sink : str
+    The file to write to.
+  data : array or Source
+    The binary data, if not run length encoded it is encoded in parallel.
+  processes : int or None
+    The number of processes to encode the data.
+
+  Returns
+  -------
+  sink : str
+    The file.
+  """
+  if not isinstance(data, Source):
+    data = encode(data, processes=processes);
+  _write(sink, data);
+  return sink;
+
+
+def create(location = None, shape = None, dtype = None, order = None, array = None, as_source = True, **kwargs):
+  """Create a run length encoded file.
+
+  Arguments
+  ---------
+  location : str
+    The file of the run length encoding.
+  shape : tuple
+    The shape of the array if no array is given.
+  dtype : dtype
+    Ignored, run length encoded sources are binary.
+  order : 'C', 'F' or None
+    The order of the encoded array.
+  array : array or None
+    The data to encode. If None, an empty mask is created.
+  as_source : bool
+    If True, return as Source class.
+
+  Returns
+  -------
+  source : Source or str
+    The run length encoded source.
+  """
+  if array is None:
+    order = 'F' if order is None else order;
+    size = int(np.prod(shape[1:] if order == 'F' else shape[:-1]));
+    empty = np.zeros(0, dtype=np.uint32);
+    array = Source(offsets=np.zeros(size + 1, dtype=np.intp), starts=empty, lengths=empty, shape=shape, order=order);
+  write(location, array, **kwargs);
+  if as_source:
+    return Source(location);
+  else:
+    return location;
+
+
+###############################################################################
+### File format
+###############################################################################
+
+def _write(location, source):
+  """Write the header and the aligned run arrays."""
+  arrays = [('offsets', np.asarray(source.offsets, dtype='<i8')),
+            ('starts',  np.asarray(source.starts,  dtype='<u4')),
+            ('lengths', np.asarray(source.lengths, dtype='<u4'))];
+  header = dict(shape=list(source.shape), order=source.order, arrays={});
+  position = alignment * 16;
+  offsets = {};
+  for name, array in arrays:
+    offsets[name] = position;
+    header['arrays'][name] = dict(offset=position, size=len(array), dtype=array.dtype.str);
+    position += _aligned(array.nbytes);
+  header = json.dumps(header).encode('utf-8');
+  if len(magic) + 8 + len(header) > alignment * 16:
+    raise ValueError('Header of the run length encoding too large!');
+
+  temporary = location + '.tmp';
+  with open(temporary, 'wb') as f:
+    f.write(magic);
+    f.write(np.uint64(len(header)).tobytes());
+    f.write(header);
+    for name, array in arrays:
+      f.seek(offsets[name]);
+      f.write(array.tobytes());
+    f.truncate(position);
+  os.replace(temporary, location);
+
+
+def _read(location):
+  """Read the header and memory map the run arrays."""
+  with open(location, 'rb') as f:
+    if f.read(len(magic)) != magic:
+      raise ValueError('The file %r is not run length encoded!' % location);
+    size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0]);
+    header = json.loads(f.read(size).decode('utf-8'));
+
+  arrays = [];
+  for name in ('offsets', 'starts', 'lengths'):
+    info = header['arrays'][name];
+    if info['size'] == 0:
+      array = np.zeros(0, dtype=info['dtype']);
+    else:
+      array = np.memmap(location, dtype=info['dtype'], mode='r', offset=info['offset'], shape=(info['size'],));
+    arrays.append(array);
+  offsets, starts, lengths = arrays;
+  offsets = offsets.view(np.intp) if offsets.dtype == np.intp else np.asarray(offsets, dtype=np.intp);
+  return offsets, starts, lengths, tuple(header['shape']), header['order'];
+
+
+def _aligned(size):
+  return int(np.ceil(size / float(alignment))) * alignment;
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import numpy as np
+  import IO.IO as io
+  import IO.RLE as rle
+
+  mask = np.zeros((100, 80, 60), dtype=bool, order='F');
+  mask[20:70, 10:50, 5:40] = True;
+  io.write('test.rle', mask);
+  source = io.as_source('test.rle');
+  print(source, rle.count(source) == mask.sum(), rle.bounding_box(source))
+  print(np.all(source[10:30, 5:20, 30] == mask[10:30, 5:20, 30]))
+  print(rle.count(rle.border(source)))
+
+  # line with many short runs inside a solid block, its border has more 
+  # runs than the line and its neighbours together
+  import scipy.ndimage as ndi
+  mask = np.zeros((40, 10, 10), dtype=bool, order='F');
+  mask[2:38, 2:8, 2:8] = True;
+  mask[2:38, 5, 5] = False;
+  for s in range(4, 34, 4):
+    mask[s:s+3, 5, 5] = True;
+  source = rle.encode(mask);
+  eroded = ndi.binary_erosion(mask, structure=ndi.generate_binary_structure(3, 1), border_value=0);
+  print(np.all(rle.erode(source)[:] == eroded), np.all(rle.border(source)[:] == (mask & ~eroded)))
@@ -7,6 +7,10 @@ Shared memory arrays for parallel processing.
 
 Note
 ----
+Arrays in named shared memory segments are passed to other processes, 
+including spawned ones, as virtual sources that attach the segment by name
+without copying the data.
+
 Usage of this array can help for parallel processing of shared memory
 arrays. However, using memmap sources (:mod:`~ClearMap.IO.MMP`) often enable 
 faster implementations.
@@ -23,6 +27,7 @@ import ParallelProcessing.SharedMemoryArray as sma
 import ParallelProcessing.SharedMemoryManager as smm
 
 import IO.Source as src
+import IO.Slice as slc
 import IO.NPY as npy
 
 from ParallelProcessing.SharedMemoryArray import base, ctype, empty      #analysis:ignore 
@@ -37,9 +42,16 @@ __all__ = sma.__all__;
 class Source(npy.Source):
   """Shared memory source."""
 
-  def __init__(self, array = None, shape = None, dtype = None, order = None, handle = None, name = None):
-    """Shared memory source constructor."""
-    shared = _shared(shape=shape, dtype=dtype, order=order, array=array, handle=handle);
+  def __init__(self, array = None, shape = None, dtype = None, order = None, handle = None, segment = None, name = None):
+    """Shared memory source constructor.
+    
+    Arguments
+    ---------
+    segment : str, True or None
+      If not None, the array is created in a named shared memory segment
+      with this name or a generated name if True.
+    """
+    shared = _shared(shape=shape, dtype=dtype, order=order, array=array, handle=handle, segment=segment);
     super(Source,self).__init__(array=shared, name=name);
     
     self._handle = handle;
@@ -58,6 +70,11 @@ class Source(npy.Source):
       self._handle = smm.insert(self.array);
     return self._handle;
     
+  @property
+  def segment(self):
+    """The name of the shared memory segment or None."""
+    return sma.segment_name(self.array);
+  
   @property
   def memory(self):
     return 'shared'
@@ -67,6 +84,10 @@ class Source(npy.Source):
       smm.free(self._handle);
       self._handle = None;
   
+  def unlink(self):
+    """Remove the name of the shared memory segment of this source."""
+    sma.unlink(self.array);
+  
   def as_virtual(self):
     return VirtualSource(source = self);
   
@@ -78,11 +99,14 @@ class Source(npy.Source):
     
 
 class VirtualSource(src.VirtualSource):
-  def __init__(self, source = None, shape = None, dtype = None, order = None, handle = None, name = None):
+  def __init__(self, source = None, shape = None, dtype = None, order = None, handle = None, segment = None, name = None):
     super(VirtualSource, self).__init__(source=source, shape=shape, dtype=dtype, order=order, name=name);
-    if handle is None and source is not None:
-      handle = source.handle;
+    if segment is None and handle is None and source is not None:
+      segment = source.segment;
+      if segment is None:
+        handle = source.handle;
     self._handle = handle;
+    self._segment = segment;
       
   @property 
   def name(self):
@@ -91,11 +115,17 @@ class VirtualSource(src.VirtualSource):
   @property
   def handle(self):
     return self._handle;
+  
+  @property
+  def segment(self):
+    return self._segment;
     
   def as_virtual(self):
     return self;
   
   def as_real(self):
+    if self._segment is not None:
+      return Source(array=sma.attach(self._segment, shape=self.shape, dtype=self.dtype, order=self.order));
     return Source(handle=self.handle);
   
   def as_buffer(self):
@@ -151,18 +181,80 @@ def as_shared(source):
   else:
     raise ValueError('Source %r cannot be transforemd to a shared array!' % source);
 
-#TODO: read directly into shared memory !
-#read = npy.read;
-#write = npy.write;
+def read(source, slicing = None, segment = True, processes = None, as_source = True, **kwargs):
+  """Read a source into a named shared memory segment.
+  
+  Arguments
+  ---------
+  source : str, array or Source
+    The source to read.
+  slicing : slice specification or None
+    Optional slicing of the source to read.
+  segment : str or True
+    The name of the segment to create, generated if True.
+  processes : int or None
+    Number of processes to read contiguous files in parallel.
+  as_source : bool
+    If True, return the shared array as Source.
+  
+  Returns
+  -------
+  shared : Source or array
+    The data in shared memory.
+  
+  Note
+  ----
+  Contiguous files are read directly into the segment via 
+  :func:`~ClearMap.ParallelProcessing.DataProcessing.ArrayProcessing.read`.
+  """
+  import IO.IO as io
+  import ParallelProcessing.DataProcessing.ArrayProcessing as ap
+  
+  source = io.as_source(source);
+  if slicing is not None:
+    source = slc.Slice(source=source, slicing=slicing);
+  order = source.order if source.order in ('C', 'F') else None;
+  
+  sink = create(shape=source.shape, dtype=source.dtype, order=order, segment=segment);
+  try:
+    offset = source.offset if source.location is not None and order is not None else None;
+  except Exception:
+    offset = None;
+  if offset is not None:
+    ap.read(source, sink=sink, processes=processes);
+  else:
+    sink.array[...] = source.array;
+  
+  return sink if as_source else sink.array;
 
-def read(*args, **kwargs):
-  raise NotImplementedError('read not implemented for SharedMemoryArray!')
 
-def write(*args, **kwargs):
-  raise NotImplementedError('write not implemented for SharedMemoryArray!')
+def write(sink, data, slicing = None, **kwargs):
+  """Write data into a shared memory array.
+  
+  Arguments
+  ---------
+  sink : Source, VirtualSource or array
+    The shared sink.
+  data : array
+    The data to write.
+  slicing : slice specification or None
+    Optional slicing of the sink to write to.
+  
+  Returns
+  -------
+  sink : Source, VirtualSource or array
+    The sink.
+  """
+  shared = sink.as_real() if isinstance(sink, VirtualSource) else sink;
+  if not is_shared(shared):
+    raise ValueError('The sink %r is not a shared array!' % (sink,));
+  if slicing is None:
+    slicing = ();
+  shared.__setitem__(slicing, data);
+  return sink;
 
 
-def create(shape = None, dtype = None, order = None, array = None, handle = None, as_source = True, **kwargs):
+def create(shape = None, dtype = None, order = None, array = None, handle = None, segment = None, as_source = True, **kwargs):
   """Create a shared memory array.
   
   Arguments
@@ -179,6 +271,9 @@ def create(shape = None, dtype = None, order = None, array = None, handle = None
     Optional source with data to fill the memory map with.
   handle : int or None
     Optional handle to an array from which to create this source.
+  segment : str, True or None
+    If not None, create the array in a named shared memory segment with
+    this name or a generated name if True.
   as_source : bool
     If True, wrap shaed array in Source class.
     
@@ -187,7 +282,7 @@ def create(shape = None, dtype = None, order = None, array = None, handle = None
   shared : array
     The shared memory array.
   """
-  array = _shared(shape=shape, dtype=dtype, order=order, array=array, handle=handle);
+  array = _shared(shape=shape, dtype=dtype, order=order, array=array, handle=handle, segment=segment);
   if as_source:
     return Source(array=array);
   else:
@@ -198,14 +293,14 @@ def create(shape = None, dtype = None, order = None, array = None, handle = None
 ### Helpers
 ###############################################################################
 
-def _shared(shape = None, dtype = None, order = None, array=None, handle = None):
+def _shared(shape = None, dtype = None, order = None, array=None, handle = None, segment = None):
   if handle is not None:
     array = smm.get(handle);
   
   if array is None:
-    return sma.array(shape=shape, dtype=dtype, order=order);
+    return sma.array(shape=shape, dtype=dtype, order=order, segment=segment);
   
-  elif is_shared(array):
+  elif is_shared(array) and (segment is None or sma.segment_name(array) is not None):
     if shape is None and dtype is None and order is None:
       return array;
     
@@ -219,7 +314,7 @@ def _shared(shape = None, dtype = None, order = None, array=None, handle = None)
     if np.dtype(dtype) == array.dtype and order == npy.order(array):
       return array;
     else:
-      new = sma.array(shape=shape,dtype=dtype,order=order);
+      new = sma.array(shape=shape,dtype=dtype,order=order,segment=segment);
       new[:] = array;
       return new;
   
@@ -233,7 +328,7 @@ def _shared(shape = None, dtype = None, order = None, array=None, handle = None)
     if shape != array.shape:
       raise ValueError('Shapes do not match!');
     
-    new = sma.array(shape=shape,dtype=dtype,order=order);
+    new = sma.array(shape=shape,dtype=dtype,order=order,segment=segment);
     new[:] = array;
     return new;
   
@@ -248,7 +343,7 @@ def _shared(shape = None, dtype = None, order = None, array=None, handle = None)
 
 def _test():
   #from importlib import reload
-  #import numpy as np  #analysis:ignore
+  import numpy as np
   import IO.SMA as sma
 
   n = 10;
@@ -259,5 +354,11 @@ def _test():
   
   v = s.as_virtual();
   print(v)
-  s2 = v.as_source()
-  
\ No newline at end of file
+  s2 = v.as_real()
+  
+
+  # named segment passed by name
+  s = sma.Source(array=np.arange(6).reshape(2,3), segment=True);
+  v = s.as_virtual();
+  print(v.segment == s.segment, np.all(v.as_real().array == s.array))
+  s.unlink();
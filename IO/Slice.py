@@ -1384,6 +1384,51 @@ def sliced_reduction(slicing, ndim, allow_index_arrays = allow_index_arrays):
 
 
 
+def sliced_region(slicing, shape):
+  """Bounding region of a slicing and the slicing relative to the region.
+  
+  Arguments
+  ---------
+  slicing : slice specification
+    The slice specification.
+  shape : tuple of ints
+    The shape of the sliced source.
+  
+  Returns
+  -------
+  region : list of tuples
+    The lower and upper bounds of the region along each axis.
+  slicing : tuple
+    The slicing of the region that gives the same result as the original 
+    slicing of the source.
+  """
+  slicing = unpack_slicing(slicing, len(shape));
+  region = [];
+  post = [];
+  for s, n in zip(slicing, shape):
+    if isinstance(s, (int, np.integer)):
+      i = range(n)[s];
+      region.append((i, i + 1));
+      post.append(0);
+    elif isinstance(s, slice):
+      r = range(n)[s];
+      if len(r) == 0:
+        region.append((0, 0));
+        post.append(slice(0, 0));
+      else:
+        lo, hi = min(r[0], r[-1]), max(r[0], r[-1]) + 1;
+        stop = r.stop - lo;
+        post.append(slice(r.start - lo, stop if stop >= 0 else None, r.step));
+        region.append((lo, hi));
+    else:
+      i = np.arange(n)[s];
+      lo = int(i.min()) if i.size > 0 else 0;
+      hi = int(i.max()) + 1 if i.size > 0 else 0;
+      region.append((lo, hi));
+      post.append(i - lo);
+  return region, tuple(post);
+
+
 ###############################################################################
 ### Helpers
 ###############################################################################
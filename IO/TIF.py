@@ -12,15 +12,30 @@ __copyright__ = 'Copyright © 2020 by Christoph Kirst'
 __webpage__   = 'http://idisco.info'
 __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 
+import os
+import sys
+import queue
+import threading
+import concurrent.futures as cf
+
 import numpy as np
 import tifffile as tif
 
 import IO.Source as src
+import IO.NPY as npy
 import IO.Slice as slc
+import IO.MMP as mmp
+import IO.Occupancy as occ
+
+import ParallelProcessing.Parallelism as par
 
 from Utils.Lazy import lazyattr
 
 
+native_byteorder = '<' if sys.byteorder == 'little' else '>';
+"""Byte order of tif files that can be memory mapped."""
+
+
 ###############################################################################
 ### Source class
 ###############################################################################
@@ -31,6 +46,8 @@ class Source(src.Source):
   Note
   ----
   Its assumed that the image data is stored in a serregionies of the tif file.
+  Uncompressed contiguous tif files are accessed via a copy on write memory 
+  map without decoding, see :attr:`memmap`.
   """
   def __init__(self, location, series = 0, multi_file = False):
     self._tif = tif.TiffFile(location, multifile = multi_file);
@@ -72,12 +89,70 @@ class Source(src.Source):
   def location(self, value):
     if value != self.location:
       self._tif = tif.TiffFile(value, multifile = False);
+      self.__dict__.pop('memmap', None);
+      self.__dict__.pop('page_offsets', None);
+  
+  @lazyattr
+  def memmap(self):
+    """Memory map to the image data in the file.
+    
+    Returns
+    -------
+    memmap : memmap or None
+      Copy on write memory map of the data in (x,y,z) order if the file 
+      is uncompressed, contiguous and in native byte order, None otherwise.
+      
+    Note
+    ----
+    This map is the read path only, writes to it do not reach the file. 
+    Use :meth:`as_memmap` for a writable map.
+    """
+    if self.multi_file or (self._tif.byteorder != native_byteorder and self.dtype.itemsize > 1):
+      return None;
+    offset = memmap_offset(self._tif, series=self._series, shape=self.tif_shape);
+    if offset is None:
+      return None;
+    memmap = np.memmap(self.location, dtype=self.dtype, mode='c', offset=offset, shape=self.tif_shape, order='C');
+    return array_from_tif(memmap);
+  
+  @lazyattr
+  def page_offsets(self):
+    """The offsets of the pages in the file as array."""
+    return np.array([page.offset for page in self._tif.pages], dtype=np.int64);
+  
+  @property
+  def is_memmappable(self):
+    """True if the image data can be accessed via a memory map."""
+    return self.memmap is not None;
   
   @property
   def array(self, processes = None):
+     if self.memmap is not None:
+       return self.memmap;
      array = self._tif.asarray(maxworkers=processes);
      return array_from_tif(array);
-   
+  
+  @property
+  def order(self):
+    """The contiguous order of the data, 'F' for memmappable files, None otherwise."""
+    if self.memmap is None:
+      return None;
+    return npy.order(self.memmap);
+  
+  @property
+  def offset(self):
+    """The offset of the image data in the file."""
+    if self.memmap is None:
+      raise ValueError('The tif file %s is not contiguous!' % self.location);
+    return self.memmap.offset;
+  
+  @property
+  def strides(self):
+    """The strides of the image data in the file in bytes."""
+    if self.memmap is not None:
+      return self.memmap.strides;
+    return self.as_memmap().strides;
+  
   @property
   def element_strides(self):
     """The strides of the array elements.
@@ -91,10 +166,13 @@ class Source(src.Source):
     ----
     The strides of the elements module itemsize instead of bytes.
     """
-    memmap = self.as_memmap()
+    memmap = self.memmap if self.memmap is not None else self.as_memmap()
     return tuple(s // memmap.itemsize for s in memmap.strides)
   
   def __getitem__(self, slicing, processes=None):
+    if self.memmap is not None:
+      return self.memmap[slicing];
+    
     ndim = self.ndim
     if ndim >= 3:
       slicing = slc.unpack_slicing(slicing, ndim)
@@ -118,6 +196,7 @@ class Source(src.Source):
   def __setitem__(self, *args):
     memmap = self.as_memmap()
     memmap.__setitem__(*args)
+    memmap.flush()
    
   
   def metadata(self, info = None):
@@ -199,6 +278,10 @@ class Source(src.Source):
 
   
   def as_memmap(self):
+    """Writable memory map to the image data in the file."""
+    if self.memmap is not None:
+      memmap = np.memmap(self.location, dtype=self.dtype, mode='r+', offset=self.offset, shape=self.tif_shape, order='C');
+      return array_from_tif(memmap);
     try :
       return array_from_tif(tif.memmap(self.location));
     except:
@@ -255,16 +338,62 @@ class Source(src.Source):
 
 
 class VirtualSource(src.VirtualSource):
-  def __init__(self, source = None, shape = None, dtype = None, order = None, location = None, name = None):
+  """Picklable tif source pointer for parallel processing.
+  
+  Note
+  ----
+  The virtual source only carries the location, the offsets of the pages and
+  the shape and data type. Reading a slice opens the file lazily in each 
+  worker thread and decodes only the pages in the requested z-range, or 
+  memory maps the data if the file is uncompressed and contiguous.
+  """
+  def __init__(self, source = None, shape = None, dtype = None, order = None, location = None, name = None, 
+               series = 0, multi_file = False, page_offsets = None, data_offset = None, stamp = None):
     super(VirtualSource, self).__init__(source=source, shape=shape, dtype=dtype, order=order, location=location, name=name);
+    self.series = series;
+    self.multi_file = multi_file;
+    self.page_offsets = page_offsets;
+    self.data_offset = data_offset;
+    self.stamp = stamp;
     if isinstance(source, Source):
       self.multi_file = source.multi_file;
       self.series = source._series;
+      if not self.multi_file:
+        self.stamp = file_stamp(source.location);
+        if source.memmap is not None:
+          self.data_offset = source.offset;
+        elif source.ndim == 3 and source._tif.pages[0].ndim == 2:
+          self.page_offsets = source.page_offsets;
   
   @property 
   def name(self):
     return 'Virtual-Tif-Source';
   
+  def __getitem__(self, slicing, processes = None):
+    if self.data_offset is not None:
+      memmap = np.memmap(self.location, dtype=self.dtype, mode='c', offset=self.data_offset, shape=shape_to_tif(self.shape), order='C');
+      return array_from_tif(memmap)[slicing];
+    
+    if self.page_offsets is None:
+      return self.as_real().__getitem__(slicing);
+    
+    slicing = slc.unpack_slicing(slicing, self.ndim);
+    slicing_z = slicing[-1];
+    n_pages = len(self.page_offsets);
+    if isinstance(slicing_z, (int, np.integer)):
+      indices = [range(n_pages)[slicing_z]];
+    elif isinstance(slicing_z, slice):
+      indices = range(n_pages)[slicing_z];
+    else:
+      indices = np.arange(n_pages)[slicing_z];
+    
+    array = read_pages(self.location, self.page_offsets, indices, stamp=self.stamp, processes=processes);
+    array = array_from_tif(array);
+    
+    if isinstance(slicing_z, (int, np.integer)):
+      return array[slicing[0], slicing[1], 0];
+    return array[slicing[0], slicing[1], :];
+  
   def as_virtual(self):
     return self;
   
@@ -293,6 +422,137 @@ def is_tif(source):
   return False;
  
 
+def memmap_offset(tif_file, series = 0, shape = None):
+  """Offset of the image data if it can be memory mapped.
+  
+  Arguments
+  ---------
+  tif_file : TiffFile
+    The open tif file.
+  series : int
+    The series of the image data.
+  shape : tuple or None
+    The expected shape of the data in tif axes order. If given the series 
+    needs to have the same number of elements.
+  
+  Returns
+  -------
+  offset : int or None
+    The offset of the uncompressed contiguous data in the file, None if the
+    data is compressed, tiled or not contiguous.
+  """
+  try:
+    series = tif_file.series[series];
+    offset = series.offset;
+    if offset is None or not series.pages[0].is_memmappable:
+      return None;
+  except Exception:
+    return None;
+  if shape is not None and int(np.prod(shape)) != int(np.prod(series.shape)):
+    return None;
+  return offset;
+
+
+def file_stamp(location):
+  """Modification time and size of a file to detect changes."""
+  stat = os.stat(location);
+  return (stat.st_mtime_ns, stat.st_size);
+
+
+_files = threading.local();
+"""Thread local cache of open tif files."""
+
+def tif_file(location, stamp = None):
+  """Open tif file cached per thread.
+  
+  Arguments
+  ---------
+  location : str
+    The tif file.
+  stamp : tuple or None
+    The file stamp, a changed stamp reopens the file.
+  
+  Returns
+  -------
+  tif_file : TiffFile
+    The open tif file.
+  
+  Note
+  ----
+  Files inherited by forked worker processes are reopened as they share the
+  file position with the parent.
+  """
+  files = getattr(_files, 'files', None);
+  if files is None:
+    files = _files.files = {};
+  
+  key = (stamp, os.getpid());
+  cached = files.get(location);
+  if cached is not None and cached[0] == key:
+    return cached[1];
+  if cached is not None and cached[0][1] == key[1]:
+    cached[1].close();
+  
+  tif_file = tif.TiffFile(location);
+  tif_file.filehandle.lock = True;
+  files[location] = (key, tif_file);
+  return tif_file;
+
+
+def read_pages(location, page_offsets, indices, stamp = None, processes = None):
+  """Decode pages of a tif file given the offsets of the pages.
+  
+  Arguments
+  ---------
+  location : str
+    The tif file.
+  page_offsets : array
+    The offsets of all pages in the file.
+  indices : list of int
+    The pages to read.
+  stamp : tuple or None
+    The file stamp to validate the cached open file.
+  processes : int or None
+    Number of threads to decode compressed pages. If None, use the number of 
+    threads from :mod:`~ParallelProcessing.Parallelism`.
+  
+  Returns
+  -------
+  array : array
+    The pages stacked along the first axis.
+  
+  Note
+  ----
+  The pages are parsed directly at their offsets without walking the page
+  chain of the file.
+  """
+  tif_file_ = tif_file(location, stamp=stamp);
+  fh = tif_file_.filehandle;
+  pages = [];
+  with fh.lock:
+    for i in indices:
+      fh.seek(int(page_offsets[i]));
+      pages.append(tif.TiffPage(tif_file_, index=int(i)));
+  
+  keyframe = tif_file_.pages[0];
+  array = np.empty((len(pages),) + keyframe.shape, dtype=keyframe.dtype);
+  
+  def read_page(k):
+    array[k] = pages[k].asarray();
+  
+  if processes is None:
+    processes = par.threads();
+  processes = min(processes, len(pages));
+  if processes > 1 and keyframe.compression != 1:
+    with cf.ThreadPoolExecutor(processes) as executor:
+      list(executor.map(read_page, range(len(pages))));
+  else:
+    for k in range(len(pages)):
+      read_page(k);
+  
+  return array;
+
+
 def read(source, slicing = None, sink = None, **args):
   """Read data from a tif file.
   
@@ -316,20 +576,42 @@ def read(source, slicing = None, sink = None, **args):
     return source.__getitem__(slicing);
 
 
-def write(sink, data, **args):
+def write(sink, data, dtype = None, slab_size = None, compression = None, bigtiff = None, occupancy = False, verbose = False, **args):
   """Write data to a tif file
   
   Arguments
   ---------
   sink : str
     The name of the tif file.
+  data : array or Source
+    The data to write.
+  dtype : dtype or None
+    Optional data type to convert the data to.
+  slab_size, compression, bigtiff, occupancy, verbose
+    Parameter for streaming sources page by page, see :func:`write_stream`.
   
   Returns
   -------
   sink : str
     The name of the tif file.
+  
+  Note
+  ----
+  Three dimensional sources, e.g. memmaps or block sinks, are 
+  written page by page without loading them into memory.
   """ 
+  if isinstance(data, src.Source) and data.ndim == 3 and not args:
+    return write_stream(sink, data, dtype=dtype, slab_size=slab_size, compression=compression, 
+                        bigtiff=bigtiff, occupancy=occupancy, verbose=verbose);
+  if isinstance(data, src.Source):
+    data = data.array;
+  if dtype is not None:
+    data = np.asarray(data, dtype=dtype);
+  if compression is not None:
+    args['compress'] = compression;
   tif.imsave(sink, array_to_tif(data), **args)
+  if occupancy:
+    occ.occupancy(sink, create=True);
   return sink;
 
 
@@ -372,6 +654,210 @@ def create(location = None, shape = None, dtype = None, mode = None, as_source =
 
 
 
+###############################################################################
+### Streaming
+###############################################################################
+
+default_slab_bytes = 2**26;
+"""Default size of a slab of pages in bytes when streaming tif files."""
+
+
+def convert(source, sink, threshold = None, dtype = None, slab_size = None, occupancy = False, processes = None, verbose = False):
+  """Stream a tif stack in slabs of pages into an array sink.
+  
+  Arguments
+  ---------
+  source : str or Source
+    The tif file.
+  sink : str, Source or array
+    The sink, a new fortran ordered memmap is created for a file name.
+  threshold : number or None
+    If not None, the sink is the binary image source > threshold.
+  dtype : dtype or None
+    The data type of the sink. If None, bool for a threshold and the 
+    type of the source otherwise.
+  slab_size : int or None
+    The number of pages per slab. If None, slabs of about 
+    :const:`default_slab_bytes` are used.
+  occupancy : bool
+    If True, count the foreground of the slabs in bricks and write the 
+    occupancy pyramid next to the sink, see :mod:`~IO.Occupancy`.
+  processes : int or None
+    The number of threads decoding, converting and writing slabs. 
+    If None, the number of threads from :mod:`~ParallelProcessing.Parallelism`.
+  verbose : bool
+    Print progress information.
+  
+  Returns
+  -------
+  sink : Source or array
+    The sink.
+  
+  Note
+  ----
+  At most twice the number of threads slabs are in memory at any time. 
+  Each thread opens the tif file separately, so that decoding of 
+  compressed pages and writing run in parallel.
+  """
+  if not isinstance(source, Source):
+    source = Source(source);
+  location = source.location;
+  shape = source.shape;
+  if dtype is None:
+    dtype = bool if threshold is not None else source.dtype;
+  if isinstance(sink, str):
+    sink = mmp.create(location=sink, shape=shape, dtype=dtype, order='F');
+  if len(shape) < 3:
+    data = source.array;
+    sink[:] = data > threshold if threshold is not None else data;
+    if occupancy:
+      _write_occupancy(sink, occ.compute(sink));
+    return sink;
+  
+  n_pages = shape[-1];
+  if slab_size is None:
+    page_bytes = np.prod(shape[:-1]) * np.dtype(source.dtype).itemsize;
+    slab_size = int(max(1, default_slab_bytes // max(1, page_bytes)));
+  if processes is None:
+    processes = par.threads();
+  slabs = [(z, min(z + slab_size, n_pages)) for z in range(0, n_pages, slab_size)];
+  pyramid = occ.Occupancy(shape) if occupancy else None;
+  
+  local = threading.local();
+  def convert_slab(slab):
+    if not hasattr(local, 'source'):
+      local.source = Source(location, series=source._series, multi_file=source.multi_file);
+    z0, z1 = slab;
+    data = local.source[..., z0:z1];
+    if threshold is not None:
+      data = data > threshold;
+    sink[..., z0:z1] = data;
+    if pyramid is not None:
+      pyramid.add(data, start=z0);
+    if verbose:
+      print('Converted pages %d-%d of %d from %s' % (z0, z1, n_pages, location));
+  
+  with cf.ThreadPoolExecutor(max_workers=processes) as executor:
+    pending = set();
+    for slab in slabs:
+      if len(pending) >= 2 * processes:
+        done, pending = cf.wait(pending, return_when=cf.FIRST_COMPLETED);
+        for future in done:
+          future.result();
+      pending.add(executor.submit(convert_slab, slab));
+    for future in pending:
+      future.result();
+  
+  if pyramid is not None:
+    _write_occupancy(sink, pyramid.finalize());
+  
+  return sink;
+
+
+def _write_occupancy(sink, pyramid):
+  """Write the occupancy pyramid of a converted sink with a file."""
+  location = occ.location(sink);
+  if location is None:
+    return;
+  memmap = getattr(sink, 'array', sink);
+  if isinstance(memmap, np.memmap):
+    memmap.flush();
+  pyramid.stamp = occ.stamp(sink);
+  occ.write(location, pyramid);
+
+
+def write_stream(sink, source, dtype = None, slab_size = None, compression = None, bigtiff = None, occupancy = False, verbose = False):
+  """Write a source to a tif file page by page in slabs.
+  
+  Arguments
+  ---------
+  sink : str
+    The name of the tif file.
+  source : Source or array
+    The data to write, the last axis is written as pages.
+  dtype : dtype or None
+    Optional data type to convert the data to, e.g. uint8 for binary data.
+  slab_size : int or None
+    The number of pages read at once. If None, slabs of about 
+    :const:`default_slab_bytes` are used.
+  compression : int, str or None
+    Optional compression of the pages, e.g. 6 for zlib level 6.
+  bigtiff : bool or None
+    Write a BigTIFF file. If None, BigTIFF is used for data above 4GB.
+  occupancy : bool
+    If True, count the foreground of the slabs in bricks and write the 
+    occupancy pyramid next to the tif file, see :mod:`~IO.Occupancy`.
+  verbose : bool
+    Print progress information.
+  
+  Returns
+  -------
+  sink : str
+    The name of the tif file.
+  
+  Note
+  ----
+  The slabs are read in a background thread while the pages are compressed
+  and written in the calling thread, so that memory stays at a few slabs and
+  reading overlaps with writing.
+  """
+  shape = source.shape;
+  dtype = np.dtype(source.dtype if dtype is None else dtype);
+  n_pages = shape[-1];
+  page_bytes = int(np.prod(shape[:-1])) * dtype.itemsize;
+  if slab_size is None:
+    slab_size = int(max(1, default_slab_bytes // max(1, page_bytes)));
+  if bigtiff is None:
+    bigtiff = page_bytes * n_pages > 2**32 - 2**25;
+  
+  pyramid = occ.Occupancy(shape) if occupancy else None;
+  
+  slabs = queue.Queue(maxsize=2);
+  stop = threading.Event();
+  def read_slabs():
+    try:
+      for z0 in range(0, n_pages, slab_size):
+        z1 = min(z0 + slab_size, n_pages);
+        data = np.asarray(source[..., z0:z1], dtype=dtype);
+        if pyramid is not None:
+          pyramid.add(data, start=z0);
+        slab = np.ascontiguousarray(array_to_tif(data));
+        while not stop.is_set():
+          try:
+            slabs.put(slab, timeout=0.1);
+            break;
+          except queue.Full:
+            pass;
+        if stop.is_set():
+          return;
+        if verbose:
+          print('Writing pages %d-%d of %d to %s' % (z0, z1, n_pages, sink));
+    except BaseException as error:
+      slabs.put(error);
+  
+  def pages():
+    for z0 in range(0, n_pages, slab_size):
+      slab = slabs.get();
+      if isinstance(slab, BaseException):
+        raise slab;
+      for page in slab:
+        yield page;
+  
+  thread = threading.Thread(target=read_slabs, daemon=True);
+  thread.start();
+  try:
+    with tif.TiffWriter(sink, bigtiff=bigtiff) as writer:
+      writer.save(pages(), shape=(n_pages,) + tuple(shape[-2::-1]), dtype=dtype, compress=compression);
+  finally:
+    stop.set();
+    thread.join();
+  
+  if pyramid is not None:
+    _write_occupancy(sink, pyramid.finalize());
+  
+  return sink;
+
+
 ################################################################################
 #### Array axes order
 ################################################################################
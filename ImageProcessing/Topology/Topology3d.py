@@ -18,7 +18,12 @@ __license__   = 'MIT License <http://www.opensource.org/licenses/mit-license.php
 __copyright__ = 'Copyright (c) 2019 by Christoph Kirst, The Rockefeller University, New York City'
 
 import tempfile
+import concurrent.futures
+
 import numpy as np
+import scipy.ndimage as ndi
+import scipy.sparse as sparse
+import scipy.sparse.csgraph as csgraph
 
 import IO.IO as io
 import ParallelProcessing.DataProcessing.ArrayProcessing as ap
@@ -430,6 +435,333 @@ def check_border(data, value = 0):
     return False;
   return True;
 
+###############################################################################
+### Cavities
+###############################################################################
+
+_bit_counts = np.array([bin(i).count('1') for i in range(256)], dtype='uint8');
+"""Number of set bits in each byte value."""
+
+_one = np.uint64(1);
+_last_bit = np.uint64(63);
+_fill_shifts = [np.uint64(2**k) for k in range(6)];
+
+
+def count_cavities(source, sink = None, connectivity = 1, slab_size = None, processes = None, verbose = False):
+  """Count the cavities in a binary 3d source via flood filling the outside background.
+  
+  Arguments
+  ---------
+  source : array or Source
+    The binary 3d source. Non-zero values are foreground.
+  sink : array, Source or None
+    If not None, the hole filled binary is written to this sink.
+  connectivity : 1, 2 or 3
+    Connectivity of the background, 1=6, 2=18 and 3=26 neighbours.
+  slab_size : int or None
+    Number of z-planes to process at once. If None, the bit packed
+    background is kept in memory, otherwise it is stored in temporary 
+    memory maps and processed slab by slab.
+  processes : int, 'serial' or None
+    Number of threads for the sweeps. If None, use number of cpus.
+  verbose : bool
+    If True, print progress information.
+  
+  Returns
+  -------
+  n_cavities : int
+    The number of cavities.
+  n_voxels : int
+    The total number of voxels in the cavities.
+    
+  Note
+  ----
+  Cavities are the background voxels not reachable from the border. The 
+  background is packed into 64 bit words along the first axis and the outside
+  is grown from the faces by alternating sweeps along all axes until no 
+  further voxel is reached. Only the cavity voxels are labeled to count them.
+  """
+  processes, timer = ap.initialize_processing(processes=processes, verbose=verbose, function='count_cavities');
+  
+  source = io.as_source(source);
+  if source.ndim != 3:
+    raise ValueError('The source dimension is %d, 3 is required!' % source.ndim);
+  if connectivity not in (1, 2, 3):
+    raise ValueError('Connectivity %r not in (1, 2, 3)!' % (connectivity,));
+  
+  shape = source.shape;
+  nx, ny, nz = shape;
+  n_words = (nx + 63) // 64;
+  if slab_size is None or slab_size >= nz:
+    slab_size = nz;
+  slabs = [(z, min(z + slab_size, nz)) for z in range(0, nz, slab_size)];
+  
+  #packed background and reached outside
+  delete_files = [];
+  if len(slabs) == 1:
+    background = np.zeros((nz, ny, n_words), dtype='uint64');
+    outside = np.zeros((nz, ny, n_words), dtype='uint64');
+  else:
+    stores = [];
+    for i in range(2):
+      location = tempfile.mktemp() + '.npy';
+      stores.append(np.lib.format.open_memmap(location, mode='w+', shape=(nz, ny, n_words), dtype='uint64'));
+      delete_files.append(location);
+    background, outside = stores;
+  
+  for z0, z1 in slabs:
+    m = _pack_slab(np.logical_not(source[:, :, z0:z1]), n_words);
+    background[z0:z1] = m;
+    outside[z0:z1] = _border_seeds(m, nx, z0, z1, nz);
+  
+  #grow outside by alternating sweeps until nothing changes
+  n_rounds = 0;
+  changed = True;
+  while changed:
+    changed = False;
+    for forward in (True, False):
+      carry = None;
+      for z0, z1 in (slabs if forward else slabs[::-1]):
+        m = np.asarray(background[z0:z1]);
+        r = np.array(outside[z0:z1]);
+        r_start = r.copy();
+        carry = _sweep_z(r, m, carry, forward=forward, connectivity=connectivity, processes=processes);
+        _sweep_slab(_sweep_y, r, m, connectivity=connectivity, processes=processes);
+        _sweep_slab(_sweep_x, r, m, connectivity=connectivity, processes=processes);
+        carry = r[-1] if forward else r[0];
+        if not np.array_equal(r, r_start):
+          outside[z0:z1] = r;
+          changed = True;
+    n_rounds += 1;
+    if verbose:
+      timer.print_elapsed_time('count_cavities: sweep round %d' % n_rounds);
+  
+  #collect cavities
+  if sink is not None:
+    sink = io.initialize(sink, shape=shape, dtype=bool);
+  n_voxels = 0;
+  indices = [];
+  for z0, z1 in slabs:
+    m = np.asarray(background[z0:z1]);
+    r = np.asarray(outside[z0:z1]);
+    cavities = m & ~r;
+    n = int(_bit_counts[cavities.view('uint8')].sum());
+    if n > 0:
+      z, y, x = np.nonzero(_unpack_slab(cavities, nx).transpose((2,1,0)));
+      indices.append(x + nx * (y + ny * (z + z0)));
+    n_voxels += n;
+    if sink is not None:
+      sink[:, :, z0:z1] = np.logical_not(_unpack_slab(r, nx));
+  
+  for f in delete_files:
+    io.delete_file(f);
+  
+  indices = np.concatenate(indices) if len(indices) > 0 else np.zeros(0, dtype=int);
+  n_cavities = _count_components(indices, shape, connectivity);
+  
+  if verbose:
+    print('count_cavities: %d cavities with %d voxels' % (n_cavities, n_voxels));
+  ap.finalize_processing(verbose=verbose, function='count_cavities', timer=timer);
+  
+  return n_cavities, n_voxels;
+
+
+def fill_holes(source, sink = None, connectivity = 1, slab_size = None, processes = None, verbose = False):
+  """Fill the cavities in a binary 3d source.
+  
+  Arguments
+  ---------
+  source : array or Source
+    The binary 3d source.
+  sink : array, Source or None
+    The sink for the hole filled binary. If None, a new array is created.
+  connectivity : 1, 2 or 3
+    Connectivity of the background, 1=6, 2=18 and 3=26 neighbours.
+  slab_size : int or None
+    Number of z-planes to process at once, see :func:`count_cavities`.
+  processes : int, 'serial' or None
+    Number of threads for the sweeps. If None, use number of cpus.
+  verbose : bool
+    If True, print progress information.
+  
+  Returns
+  -------
+  sink : Source
+    The hole filled binary.
+  """
+  source = io.as_source(source);
+  sink = io.initialize(sink, shape=source.shape, dtype=bool, order='F' if sink is None else None);
+  count_cavities(source, sink=sink, connectivity=connectivity, slab_size=slab_size, processes=processes, verbose=verbose);
+  return sink;
+
+
+def _pack_slab(binary, n_words):
+  """Pack a binary (x,y,z) slab into (z,y,words) 64 bit words along x."""
+  binary = np.asarray(binary, dtype=bool).transpose((2,1,0));
+  packed = np.packbits(binary, axis=-1, bitorder='little');
+  words = np.zeros(packed.shape[:-1] + (8 * n_words,), dtype='uint8');
+  words[..., :packed.shape[-1]] = packed;
+  return words.view('uint64');
+
+
+def _unpack_slab(words, nx):
+  """Unpack (z,y,words) 64 bit words into a binary (x,y,z) slab."""
+  words = np.ascontiguousarray(words);
+  bits = np.unpackbits(words.view('uint8'), axis=-1, count=nx, bitorder='little');
+  return bits.view(bool).transpose((2,1,0));
+
+
+def _border_seeds(m, nx, z0, z1, nz):
+  """Background words on the faces of the full volume."""
+  r = np.zeros_like(m);
+  r[:, [0,-1], :] = m[:, [0,-1], :];
+  r[..., 0] |= m[..., 0] & _one;
+  r[..., -1] |= m[..., -1] & (_one << np.uint64((nx - 1) % 64));
+  if z0 == 0:
+    r[0] = m[0];
+  if z1 == nz:
+    r[-1] = m[-1];
+  return r;
+
+
+def _shift_up(r):
+  """Shift packed bits by one towards larger x."""
+  s = r << _one;
+  s[..., 1:] |= r[..., :-1] >> _last_bit;
+  return s;
+
+
+def _shift_down(r):
+  """Shift packed bits by one towards smaller x."""
+  s = r >> _one;
+  s[..., :-1] |= r[..., 1:] << _last_bit;
+  return s;
+
+
+def _dilate_x(r):
+  return r | _shift_up(r) | _shift_down(r);
+
+
+def _dilate_y(r):
+  s = r.copy();
+  s[..., 1:, :] |= r[..., :-1, :];
+  s[..., :-1, :] |= r[..., 1:, :];
+  return s;
+
+
+def _dilate_plane(r, connectivity):
+  """In plane part of the neighbourhood of the next plane along z."""
+  if connectivity == 1:
+    return r;
+  elif connectivity == 2:
+    return _dilate_x(r) | _dilate_y(r);
+  else:
+    return _dilate_y(_dilate_x(r));
+
+
+def _sweep_z(r, m, carry, forward, connectivity, processes):
+  """Propagate the reached background along z through a slab."""
+  n = r.shape[0];
+  if forward:
+    order = range(n);
+  else:
+    order = range(n-1, -1, -1);
+  
+  def sweep(y0, y1, carry):
+    for k in order:
+      if carry is not None:
+        r[k, y0:y1] |= _dilate_plane(carry, connectivity) & m[k, y0:y1];
+      carry = r[k, y0:y1];
+  
+  if connectivity == 1 and processes > 1 and r.shape[1] > processes:
+    ranges = np.array(np.linspace(0, r.shape[1], processes + 1), dtype=int);
+    with concurrent.futures.ThreadPoolExecutor(processes) as executor:
+      futures = [executor.submit(sweep, y0, y1, None if carry is None else carry[y0:y1]) for y0, y1 in zip(ranges[:-1], ranges[1:])];
+      [f.result() for f in futures];
+  else:
+    sweep(0, r.shape[1], carry);
+  
+  return r[order[-1]];
+
+
+def _sweep_y(r, m, connectivity):
+  """Propagate the reached background along y in both directions."""
+  ny = r.shape[1];
+  for j in range(1, ny):
+    prev = r[:, j-1] if connectivity == 1 else _dilate_x(r[:, j-1]);
+    r[:, j] |= prev & m[:, j];
+  for j in range(ny-2, -1, -1):
+    prev = r[:, j+1] if connectivity == 1 else _dilate_x(r[:, j+1]);
+    r[:, j] |= prev & m[:, j];
+
+
+def _sweep_x(r, m, connectivity):
+  """Propagate the reached background along x in both directions."""
+  n_words = r.shape[-1];
+  for w in range(n_words):
+    g = r[..., w];
+    if w > 0:
+      g |= m[..., w] & (r[..., w-1] >> _last_bit);
+    r[..., w] = _fill(g, m[..., w], up=True);
+  for w in range(n_words-1, -1, -1):
+    g = r[..., w];
+    if w < n_words - 1:
+      g |= m[..., w] & ((r[..., w+1] & _one) << _last_bit);
+    r[..., w] = _fill(g, m[..., w], up=False);
+
+
+def _fill(g, p, up):
+  """Occluded fill of the bits g inside the runs of p within 64 bit words."""
+  p = p.copy();
+  for s in _fill_shifts:
+    if up:
+      g |= p & (g << s);
+      p &= p << s;
+    else:
+      g |= p & (g >> s);
+      p &= p >> s;
+  return g;
+
+
+def _sweep_slab(sweep, r, m, connectivity, processes):
+  """Run a sweep in parallel on sub-slabs along z."""
+  n = r.shape[0];
+  if processes > 1 and n > 1:
+    ranges = np.array(np.linspace(0, n, min(n, processes) + 1), dtype=int);
+    with concurrent.futures.ThreadPoolExecutor(processes) as executor:
+      futures = [executor.submit(sweep, r[z0:z1], m[z0:z1], connectivity) for z0, z1 in zip(ranges[:-1], ranges[1:])];
+      [f.result() for f in futures];
+  else:
+    sweep(r, m, connectivity);
+
+
+def _count_components(indices, shape, connectivity):
+  """Number of connected components of voxels given by sorted linear indices away from the border."""
+  n = len(indices);
+  if n == 0:
+    return 0;
+  
+  strides = (1, shape[0], shape[0] * shape[1]);
+  structure = ndi.generate_binary_structure(3, connectivity);
+  offsets = [np.dot(np.array(o) - 1, strides) for o in zip(*np.where(structure))];
+  offsets = [o for o in offsets if o > 0];
+  
+  rows, cols = [], [];
+  for o in offsets:
+    target = indices + o;
+    position = np.minimum(np.searchsorted(indices, target), n - 1);
+    valid = indices[position] == target;
+    rows.append(np.nonzero(valid)[0]);
+    cols.append(position[valid]);
+  rows = np.concatenate(rows);
+  cols = np.concatenate(cols);
+  
+  graph = sparse.coo_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n, n));
+  n_components, _ = csgraph.connected_components(graph, directed=False);
+  
+  return n_components;
+
+
 ###############################################################################
 ### Printing 
 ###############################################################################
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+VolumeMetrics
+=============
+
+Streaming quality metrics for large binary volumes.
+
+The volume is read once in slabs along the last axis. For each slab a worker
+computes partial results (voxel count, 2x2x2 configuration histogram for the
+Euler characteristic, labels of foreground and background components
+touching the slab boundaries) which are merged in the main process.
+
+Example
+-------
+>>> import numpy as np
+>>> import ImageProcessing.Topology.VolumeMetrics as vm
+>>> binary = np.zeros((20,20,20), dtype=bool);
+>>> binary[5:15,5:15,5:15] = True;
+>>> binary[8:12,8:12,8:12] = False;
+>>> vm.analyze(binary, slab_size=4, processes='serial')
+{'voxels': 936, 'components': 1, 'euler_6': 2, 'euler_26': 2, 'cavities': 1, 'cavity_voxels': 64}
+"""
+__author__    = 'Christoph Kirst <ckirst@rockefeller.edu>'
+__license__   = 'MIT License <http://www.opensource.org/licenses/mit-license.php>'
+__copyright__ = 'Copyright (c) 2019 by Christoph Kirst, The Rockefeller University, New York City'
+
+
+import functools as ft
+import itertools as it
+
+import numpy as np
+import scipy.ndimage as ndi
+import scipy.sparse as sparse
+import scipy.sparse.csgraph as csgraph
+
+import IO.IO as io
+import IO.Slice as slc
+import IO.Occupancy as occ
+
+import ParallelProcessing.ParallelTraceback as ptb
+import ParallelProcessing.DataProcessing.ArrayProcessing as ap
+
+from Utils.utilities import CancelableProcessPoolExecutor
+
+
+###############################################################################
+### Euler characteristic
+###############################################################################
+
+def _euler_lookup_tables():
+  """Contribution of each 2x2x2 configuration to the Euler characteristic.
+
+  Returns
+  -------
+  lut_6, lut_26 : arrays
+    Eight times the contribution of a 2x2x2 window for 6-connected and
+    26-connected foreground.
+
+  Note
+  ----
+  The configuration index of a window is sum_{i,j,k} 2**(i + 2*j + 4*k) b[i,j,k].
+  For 26-connectivity voxels are closed unit cubes and the window counts the
+  cells of the cubical complex incident to its center vertex. For
+  6-connectivity voxels are vertices of a cubical complex and the window
+  counts its vertices, edges, squares and cube weighted by the number of
+  windows sharing them.
+  """
+  corners = list(it.product(range(2), repeat=3));
+  edges = [(a, b) for a, b in it.combinations(corners, 2) if sum(abs(x - y) for x, y in zip(a, b)) == 1];
+  faces = [[c for c in corners if c[d] == v] for d in range(3) for v in range(2)];
+
+  lut_6  = np.zeros(256, dtype=int);
+  lut_26 = np.zeros(256, dtype=int);
+  for index in range(256):
+    b = {c : bool(index >> (c[0] + 2*c[1] + 4*c[2]) & 1) for c in corners};
+
+    #6: vertices 1/8, edges 1/4, squares 1/2, cube 1
+    v = sum(b[c] for c in corners);
+    e = sum(b[x] and b[y] for x, y in edges);
+    f = sum(all(b[c] for c in face) for face in faces);
+    c = all(b.values());
+    lut_6[index] = v - 2 * e + 4 * f - 8 * c;
+
+    #26: center vertex 1, its 6 edges 1/2, its 12 faces 1/4, its 8 cubes 1/8
+    v = any(b.values());
+    e = sum(any(b[c] for c in corners if c[d] == x) for d in range(3) for x in range(2));
+    f = sum(any(b[c] for c in corners if c[d1] == x1 and c[d2] == x2)
+            for d1, d2 in [(0,1), (0,2), (1,2)] for x1 in range(2) for x2 in range(2));
+    c = sum(b.values());
+    lut_26[index] = 8 * v - 4 * e + 2 * f - c;
+
+  return lut_6, lut_26;
+
+
+_lut_6, _lut_26 = _euler_lookup_tables();
+
+
+def _configuration_histogram(planes):
+  """Histogram of the 2x2x2 configurations of a zero padded stack of planes."""
+  nx, ny, nz = planes.shape;
+  padded = np.zeros((nx + 2, ny + 2, nz), dtype='uint8');
+  padded[1:-1, 1:-1] = planes;
+  index = np.zeros((nx + 1, ny + 1, nz - 1), dtype='uint8');
+  for i, j, k in it.product(range(2), repeat=3):
+    index |= padded[i:i+nx+1, j:j+ny+1, k:k+nz-1] << np.uint8(i + 2*j + 4*k);
+  return np.bincount(index.ravel(), minlength=256);
+
+
+def euler_characteristic(histogram, connectivity = 1):
+  """Euler characteristic from a histogram of 2x2x2 configurations.
+  
+  Arguments
+  ---------
+  histogram : array
+    The number of occurences of each of the 256 configurations.
+  connectivity : 1 or 3
+    Foreground connectivity, 1=6 and 3=26 neighbours.
+  
+  Returns
+  -------
+  euler : int
+    The Euler characteristic.
+  """
+  if connectivity == 1:
+    lut = _lut_6;
+  elif connectivity == 3:
+    lut = _lut_26;
+  else:
+    raise ValueError('Connectivity %r not in (1, 3)!' % (connectivity,));
+  return int(np.dot(histogram, lut)) // 8;
+
+
+###############################################################################
+### Slab processing
+###############################################################################
+
+@ptb.parallel_traceback
+def _analyze_slab(source, z0, z1, connectivity, box = None, offset = 0, nz = None):
+  """Partial metrics of the planes z0:z1 of a binary volume or its box.
+  
+  The source may hold only the planes from offset on of a volume with nz planes.
+  """
+  source = io.as_source(source);
+  if box is not None:
+    source = slc.Slice(source=source, slicing=occ.box_slicing(box));
+  nx, ny = source.shape[:2];
+  if nz is None:
+    nz = source.shape[2] + offset;
+  
+  r0 = max(z0 - 1, 0);
+  planes = np.asarray(source[:, :, r0 - offset:z1 - offset]).reshape((nx, ny, z1 - r0)) > 0;
+  data = planes[:, :, z0 - r0:];
+  
+  #euler: windows between planes z-1 and z for z in z0:z1 (and nz)
+  if z0 == 0:
+    planes = np.concatenate([np.zeros((nx, ny, 1), dtype=bool), planes], axis=2);
+  if z1 == nz:
+    planes = np.concatenate([planes, np.zeros((nx, ny, 1), dtype=bool)], axis=2);
+  histogram = _configuration_histogram(planes);
+  del planes;
+  
+  #foreground components
+  labels, n_labels = ndi.label(data, structure=np.ones((3,3,3), dtype=bool));
+  foreground = (n_labels, labels[:, :, 0].copy(), labels[:, :, -1].copy());
+  del labels;
+  
+  #background components
+  labels, n_labels = ndi.label(np.logical_not(data), structure=ndi.generate_binary_structure(3, connectivity));
+  counts = np.bincount(labels.ravel(), minlength=n_labels + 1)[1:];
+  border = np.zeros(n_labels + 1, dtype=bool);
+  for plane in (labels[0], labels[-1], labels[:, 0], labels[:, -1]):
+    border[plane] = True;
+  if z0 == 0:
+    border[labels[:, :, 0]] = True;
+  if z1 == nz:
+    border[labels[:, :, -1]] = True;
+  background = (n_labels, labels[:, :, 0].copy(), labels[:, :, -1].copy(), counts, border[1:]);
+  
+  return int(data.sum()), histogram, foreground, background;
+
+
+def _plane_offsets(connectivity):
+  """In plane offsets of the neighbours in the next plane."""
+  return [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if abs(dx) + abs(dy) + 1 <= connectivity];
+
+
+def _plane_edges(first, second, offsets):
+  """Pairs of labels in adjacent planes that are neighbours."""
+  nx, ny = first.shape;
+  edges = [];
+  for dx, dy in offsets:
+    a = first[max(0, -dx):nx - max(0, dx), max(0, -dy):ny - max(0, dy)];
+    b = second[max(0, dx):nx - max(0, -dx), max(0, dy):ny - max(0, -dy)];
+    valid = np.logical_and(a > 0, b > 0);
+    edges.append(np.stack([a[valid], b[valid]], axis=1));
+  edges = np.concatenate(edges).astype('int64');
+  return np.unique(edges, axis=0);
+
+
+def _merge_components(slabs, connectivity):
+  """Merge component labels of consecutive slabs.
+  
+  Returns
+  -------
+  n_components : int
+    The number of global components.
+  components : array
+    The global component of each slab label, labels of slab k start at the 
+    sum of the label numbers of the previous slabs.
+  """
+  offsets = _plane_offsets(connectivity);
+  n_total = 0;
+  edges = [];
+  last = None;
+  for n_labels, first_plane, last_plane in slabs:
+    if last is not None:
+      e = _plane_edges(last, first_plane, offsets);
+      e[:, 0] += n_total - last_n - 1;
+      e[:, 1] += n_total - 1;
+      edges.append(e);
+    last = last_plane;
+    last_n = n_labels;
+    n_total += n_labels;
+  
+  if n_total == 0:
+    return 0, np.zeros(0, dtype=int);
+  
+  edges = np.concatenate(edges) if len(edges) > 0 else np.zeros((0,2), dtype='int64');
+  graph = sparse.coo_matrix((np.ones(len(edges), dtype=bool), (edges[:,0], edges[:,1])), shape=(n_total, n_total));
+  return csgraph.connected_components(graph, directed=False);
+
+
+def _merge(results, connectivity):
+  """Merge the partial metrics of the slabs of a volume."""
+  voxels = sum(r[0] for r in results);
+  histogram = np.sum([r[1] for r in results], axis=0);
+  
+  n_components, _ = _merge_components([r[2] for r in results], connectivity=3);
+  
+  n, components = _merge_components([r[3][:3] for r in results], connectivity=connectivity);
+  counts = np.concatenate([r[3][3] for r in results]);
+  border = np.concatenate([r[3][4] for r in results]);
+  touching = np.bincount(components, weights=border, minlength=n) > 0;
+  cavities = np.logical_not(touching[components]);
+  
+  return dict(voxels = int(voxels),
+              components = int(n_components),
+              euler_6 = euler_characteristic(histogram, connectivity=1),
+              euler_26 = euler_characteristic(histogram, connectivity=3),
+              cavities = int(n - np.sum(touching)),
+              cavity_voxels = int(np.sum(counts[cavities])));
+
+
+###############################################################################
+### Analysis
+###############################################################################
+
+default_slab_size = 64;
+"""Default number of planes per slab."""
+
+
+def analyze_sources(sources, slab_size = None, connectivity = 1, occupancy = None, processes = None, verbose = False):
+  """Compute quality metrics of several binary volumes in a single pass each.
+  
+  Arguments
+  ---------
+  sources : list of str, array or Source
+    The volumes to analyze. Non-zero values are foreground.
+  slab_size : int or None
+    Number of planes along the last axis processed by one worker.
+    If None, use default_slab_size.
+  connectivity : 1, 2 or 3
+    Background connectivity used to detect cavities, 1=6, 2=18 and 3=26.
+  occupancy : True, list of Occupancy or None
+    If given, each volume is cropped to the bounding box of its non-empty
+    bricks, which does not change the metrics. If True, the occupancy 
+    pyramids are read from the sidecar files of the sources and volumes 
+    without one are analyzed in full, see :mod:`~IO.Occupancy`.
+  processes : int, 'serial' or None
+    Number of processes, the slabs of all volumes share the same workers.
+  verbose : bool
+    If True, print progress information.
+  
+  Returns
+  -------
+  metrics : list of dict
+    For each source the number of foreground voxels, the number of 
+    26-connected components, the Euler characteristic for 6- and 
+    26-connected foreground and the number and volume of the cavities.
+  """
+  processes, timer = ap.initialize_processing(processes=processes, verbose=verbose, function='analyze');
+  if slab_size is None:
+    slab_size = default_slab_size;
+  
+  tasks = [];
+  for s, source in enumerate(sources):
+    source = io.as_source(source);
+    if source.ndim != 3:
+      raise ValueError('The source dimension is %d, 3 is required!' % source.ndim);
+    box = None;
+    if occupancy is not None and occupancy is not False:
+      pyramid = io.occupancy(source) if occupancy is True else occupancy[s];
+      if pyramid is not None:
+        box = pyramid.bounding_box() or ((0, 1),) * 3;
+    nz = source.shape[2] if box is None else box[2][1] - box[2][0];
+    slabs = [(z0, min(z0 + slab_size, nz)) for z0 in range(0, nz, slab_size)];
+    if processes > 1 and isinstance(source.location, str):
+      tasks.extend((s, source.location, z0, z1, dict(box=box)) for z0, z1 in slabs);
+    elif processes > 1:
+      #ship only the planes of each slab to the workers
+      data = source if box is None else slc.Slice(source=source, slicing=occ.box_slicing(box));
+      for z0, z1 in slabs:
+        r0 = max(z0 - 1, 0);
+        tasks.append((s, np.asarray(data[:, :, r0:z1]), z0, z1, dict(offset=r0, nz=nz)));
+    else:
+      tasks.extend((s, source, z0, z1, dict(box=box)) for z0, z1 in slabs);
+  
+  analyze_slab = ft.partial(_analyze_slab, connectivity=connectivity);
+  if processes == 1:
+    results = [analyze_slab(*t[1:4], **t[4]) for t in tasks];
+  else:
+    with CancelableProcessPoolExecutor(processes) as executor:
+      futures = [executor.submit(analyze_slab, *t[1:4], **t[4]) for t in tasks];
+      results = [f.result() for f in futures];
+  
+  metrics = [];
+  for s in range(len(sources)):
+    metrics.append(_merge([r for t, r in zip(tasks, results) if t[0] == s], connectivity=connectivity));
+    if verbose:
+      print('analyze: %r: %r' % (sources[s] if isinstance(sources[s], str) else s, metrics[-1]));
+  
+  ap.finalize_processing(verbose=verbose, function='analyze', timer=timer);
+  
+  return metrics;
+
+
+def analyze(source, slab_size = None, connectivity = 1, occupancy = None, processes = None, verbose = False):
+  """Compute quality metrics of a binary volume in a single pass.
+  
+  See :func:`analyze_sources` for the arguments and returned metrics.
+  """
+  if isinstance(occupancy, occ.Occupancy):
+    occupancy = [occupancy];
+  return analyze_sources([source], slab_size=slab_size, connectivity=connectivity, occupancy=occupancy, 
+                         processes=processes, verbose=verbose)[0];
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import numpy as np
+  import scipy.ndimage as ndi
+  import ImageProcessing.Topology.Topology3d as t3d
+  import ImageProcessing.Topology.VolumeMetrics as vm
+  
+  binary = np.random.rand(30,40,50) > 0.6;
+  metrics = vm.analyze(binary, slab_size=7, processes='serial');
+  
+  print(metrics['voxels'] == binary.sum())
+  print(metrics['components'] == ndi.label(binary, structure=np.ones((3,3,3)))[1])
+  print((metrics['cavities'], metrics['cavity_voxels']) == t3d.count_cavities(binary, connectivity=1))
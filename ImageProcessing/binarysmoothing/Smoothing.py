@@ -30,6 +30,7 @@ import IO.FileUtils as fu
 import ImageProcessing.Topology.Topology3d as t3d
 
 import ParallelProcessing.BlockProcessing as bp
+import ParallelProcessing.Parallelism as par
 import ParallelProcessing.DataProcessing.ArrayProcessing as ap
 
 import Utils.Timer as tmr
@@ -286,7 +287,7 @@ def generate_lookup_table(function = index_to_smoothing, verbose = True, process
     print('Smoothing: Generating look-up table!')
     
   if processes is None:
-    processes = mp.cpu_count();
+    processes = par.processes();
   
   if processes == 'serial':
     lut = [function(i) for i in range(2**27)];
@@ -294,8 +295,8 @@ def generate_lookup_table(function = index_to_smoothing, verbose = True, process
     #import concurrent.futures as cf
     #with cf.ProcessPoolExecutor(max_workers=processes) as executor:
     #  lut = executor.map(function, range(2**27));
-    pool = mp.Pool(mp.cpu_count());
-    lut = pool.map(function, range(2**27), chunksize=2**27//8//mp.cpu_count());
+    pool = mp.Pool(processes);
+    lut = pool.map(function, range(2**27), chunksize=2**27//8//processes);
   
   return np.array(lut, dtype = bool);
 
@@ -304,7 +305,7 @@ smooth_by_configuration_filename = "Smoothing.npy";
 """Filename for the look up table mapping a cube configuration to the smoothing action for the center pixel."""
 
 
-def initialize_lookup_table(function = index_to_smoothing, filename = smooth_by_configuration_filename, verbose = True, processes = None):
+def initialize_lookup_table(function = index_to_smoothing, filename = smooth_by_configuration_filename, verbose = True, processes = None, mmap_mode = None):
   """Initialize the lookup table"""
   
   filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename);
@@ -316,7 +317,7 @@ def initialize_lookup_table(function = index_to_smoothing, filename = smooth_by_
   if os.path.exists(filename):
     if verbose:
       print('Smoothing: Loading look-up table from %s!' % filename)
-    return np.load(filename);
+    return np.load(filename, mmap_mode=mmap_mode);
   else:
     if verbose:
       print('Smoothing: Look-up table does not exists! Pre-calculating it!')
@@ -325,6 +326,33 @@ def initialize_lookup_table(function = index_to_smoothing, filename = smooth_by_
     return lut;
 
 
+_lookup_table = None;
+"""Cached look-up table of the current process."""
+
+def lookup_table(verbose = False):
+  """Cached memory mapped look-up table for the smoothing action.
+  
+  Note
+  ----
+  The table is loaded once per process and memory mapped so workers share
+  the pages of the file.
+  """
+  global _lookup_table;
+  if _lookup_table is None:
+    _lookup_table = initialize_lookup_table(verbose=verbose, mmap_mode='r');
+  return _lookup_table;
+
+
+def initialize_worker():
+  """Load the look-up table when a worker of a pool starts."""
+  lookup_table();
+
+
+worker_modules = ['ImageProcessing.binarysmoothing.Smoothing'];
+"""Modules to initialize in a :class:`~ParallelProcessing.WorkerPool.WorkerPool` for smoothing."""
+
+
+@bp.memory_footprint(bytes_per_voxel=17, overhead=2**27)
 def smooth_by_configuration_block(source, iterations = 1, verbose = False):
   """Smooth a binary source using the local configuration around each pixel.
   
@@ -341,6 +369,12 @@ def smooth_by_configuration_block(source, iterations = 1, verbose = False):
   -------
   smoothed : array
     The smoothed binary array.
+  
+  Note
+  ----
+  The uint32 index volumes of the correlations need about 17 bytes per 
+  voxel of the block, the look-up table adds 128MB per worker. This is 
+  declared for the memory budget of block processing.
   """
   try:
     if isinstance(source, io.src.Source):
@@ -350,7 +384,7 @@ def smooth_by_configuration_block(source, iterations = 1, verbose = False):
     smoothed = np.asarray(smoothed, dtype='uint32');
     ndim = smoothed.ndim;
 
-    lut = np.asarray(initialize_lookup_table(verbose=verbose), dtype='uint32');
+    lut = lookup_table(verbose=verbose);
 
     for i in range(iterations):
       # index
@@ -370,7 +404,7 @@ def smooth_by_configuration_block(source, iterations = 1, verbose = False):
 
 
 def smooth_by_configuration(source, sink = None, iterations = 1, 
-                            processing_parameter = None,
+                            processing_parameter = None, exchange_halos = False,
                             processes = None, verbose = False):
   """Smooth a binary source using the local configuration around each pixel.
   
@@ -385,8 +419,14 @@ def smooth_by_configuration(source, sink = None, iterations = 1,
   processing_parameter : None or dict
     The parameter passed to 
     :func:`ClearMap.ParallelProcessing.BlockProcessing.process`.
-  processes : int or None
-    number of processes to use.
+  exchange_halos : bool
+    If True, run one iteration at a time on blocks with a 1 voxel halo 
+    exchanged after each iteration, see 
+    :func:`~ParallelProcessing.BlockProcessing.iterate`. This avoids the
+    overlap growing with the number of iterations.
+  processes : int, WorkerPool or None
+    number of processes to use or a persistent worker pool, see
+    :mod:`~ParallelProcessing.WorkerPool`.
   verbose : bool
     If True, print progress information.
     
@@ -407,11 +447,24 @@ def smooth_by_configuration(source, sink = None, iterations = 1,
   #smoothing function
   smooth = functools.partial(smooth_by_configuration_block, iterations=iterations, verbose=False);
   smooth.__name__ = 'smooth_by_configuration'
+  smooth.halo = 1 + iterations;
   
   #initialize sources and sinks
   source = io.as_source(source);
   sink   = io.initialize(sink, shape=source.shape, dtype=bool, order=source.order); 
   
+  if exchange_halos:
+    step = functools.partial(smooth_by_configuration_block, iterations=1, verbose=False);
+    step.__name__ = 'smooth_by_configuration';
+    iterate_parameter = dict(axes=bp.block_axes(source), processes=processes, verbose=verbose);
+    iterate_parameter.update({k : v for k,v in (processing_parameter or {}).items() 
+                              if k in ('axes', 'size_max', 'size_min', 'optimization', 'optimization_fix', 'as_memory', 
+                                       'buffer_directory', 'processes', 'backend', 'until_stable', 'statistics')});
+    bp.iterate(step, source, sink, iterations=iterations, halo=1, **iterate_parameter);
+    if verbose:
+      timer.print_elapsed_time('Binary smoothing: done');
+    return sink;
+  
   #block processing parameter
   block_processing_parameter = dict(axes = bp.block_axes(source), 
                                     as_memory=True, 
@@ -27,6 +27,7 @@ import ImageProcessing.Topology.Topology3d as t3d
  
 import ParallelProcessing.DataProcessing.ArrayProcessing as ap
 import ParallelProcessing.DataProcessing.ConvolvePointList as cpl
+import ParallelProcessing.Parallelism as par
 
 import Utils.Timer as tmr
 
@@ -237,8 +238,9 @@ def match_non_removable(index, verbose = True):
 def generate_lookup_table(function = match_index, verbose = True):
   """Generates lookup table for templates"""
    
-  pool = mp.Pool(mp.cpu_count());
-  lut = pool.map(function, range(2**26),chunksize=2**26/8/mp.cpu_count());
+  processes = par.processes();
+  pool = mp.Pool(processes);
+  lut = pool.map(function, range(2**26),chunksize=2**26//8//processes);
   
   return np.array(lut, dtype = bool);
 
@@ -30,6 +30,7 @@ __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 import numpy as np
 
 import IO.IO as io
+import IO.Occupancy as occ
 
 import ParallelProcessing.DataProcessing.ArrayProcessing as ap
 
@@ -41,7 +42,7 @@ import Utils.Timer as tmr
 ### Skeletonization
 ###############################################################################
 
-def skeletonize(source, sink = None, points = None, method = 'PK12i', steps = None, in_place = False, verbose = True, **kwargs):
+def skeletonize(source, sink = None, points = None, method = 'PK12i', steps = None, in_place = False, occupancy = None, verbose = True, **kwargs):
   """Skeletonize 3d binary arrays.
   
   Arguments
@@ -58,6 +59,10 @@ def skeletonize(source, sink = None, points = None, method = 'PK12i', steps = No
     Number of maximal iteration steps. If None, maximal thinning.
   in_place : bool
     If True, the skeletonization is done directly on the input array.
+  occupancy : Occupancy, True or None
+    If given, only the bounding box of the non-empty bricks is thinned.
+    If True, the occupancy pyramid is read from the sidecar file of the 
+    source, see :mod:`~IO.Occupancy`.
     
   Returns
   -------
@@ -74,12 +79,32 @@ def skeletonize(source, sink = None, points = None, method = 'PK12i', steps = No
     if not in_place:
       binary_buffer = np.array(binary_buffer);
   
-  if method == 'PK12':
+  box = None;
+  if occupancy is not None and occupancy is not False:
+    if any(kwargs.get(k) for k in ('removals', 'radii', 'return_points')):
+      raise ValueError('Skeletonization of the occupied box only returns the skeleton!');
+    occupancy = io.occupancy(source) if occupancy is True else occupancy;
+    if occupancy is not None:
+      box = occ.box_slicing(occupancy.bounding_box(margin=1) or ((0, 0),) * binary_buffer.ndim);
+      full_buffer = binary_buffer;
+      binary_buffer = np.array(full_buffer[box], order='K');
+      if points is not None:
+        order = 'F' if full_buffer.flags.f_contiguous and not full_buffer.flags.c_contiguous else 'C';
+        coordinates = np.unravel_index(points, full_buffer.shape, order=order);
+        points = np.ravel_multi_index([c - b.start for c, b in zip(coordinates, box)], binary_buffer.shape, order=order);
+  
+  if box is not None and binary_buffer.size == 0:
+    result = binary_buffer;
+  elif method == 'PK12':
     result = PK12.skeletonize(binary_buffer, points=points, steps=steps, verbose=verbose, **kwargs)  # prange
   elif method == 'PK12i':
     result = PK12.skeletonize_index(binary_buffer, points=points, steps=steps, verbose=verbose, **kwargs)  # prange
   else:
     raise RuntimeError('Skeletonizaton method %r is not valid!' % method);
+  
+  if box is not None:
+    full_buffer[box] = result;
+    result = full_buffer;
                       
   if verbose:
     timer.print_elapsed_time(head='Skeletonization');
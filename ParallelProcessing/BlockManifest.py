@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+BlockManifest
+=============
+
+On-disk record of the finished blocks of a block processing run.
+
+The manifest is a small json file next to the sink that is rewritten
+atomically while blocks finish. A rerun of
+:func:`ParallelProcessing.BlockProcessing.process` with the same parameters
+skips the finished blocks, a run with different parameters starts anew.
+
+For incremental processing the hashes of the input blocks including their
+halo are kept next to the sink in a :class:`BlockHashes` file, and only
+blocks whose input changed are processed again.
+
+Both files store the block layout of the run, so that a rerun with the same
+user parameters splits the source in the same way even if the layout was 
+derived from the available memory, and the identity of the sink file, so 
+that the records of a deleted or recreated sink are not used.
+
+Example
+-------
+>>> import ParallelProcessing.BlockProcessing as bp
+>>> bp.process(function, source, sink, manifest=True, retries=2)
+>>> bp.process(function, edited_source, sink, incremental=True)
+"""
+__author__    = 'Christoph Kirst <ckirst@rockefeller.edu>'
+__license__   = 'MIT License <http://www.opensource.org/licenses/mit-license.php>'
+__copyright__ = 'Copyright (c) 2019 by Christoph Kirst, The Rockefeller University, New York City'
+
+
+import os
+import json
+import time
+import hashlib
+
+import numpy as np
+
+
+extension = '.manifest.json';
+"""Extension appended to the sink location for the manifest file."""
+
+hash_extension = '.hashes.json';
+"""Extension appended to the sink location for the block hashes file."""
+
+default_interval = 1.0;
+"""Minimal time in seconds between two writes of the manifest."""
+
+
+###############################################################################
+### Manifest
+###############################################################################
+
+class Manifest(object):
+  """Set of finished blocks of a run stored in a json file.
+
+  Arguments
+  ---------
+  location : str
+    The file of the manifest.
+  parameter : str
+    Hash of the parameters of the run, see :func:`parameter_hash`.
+  n_blocks : int
+    The number of blocks of the run.
+  layout : dict or None
+    The block layout of the run stored with the manifest, see :func:`stored_layout`.
+  sink : tuple or None
+    The identity of the sink file, see :func:`sink_identity`.
+  interval : float or None
+    Minimal time between writes of the file when marking blocks.
+    If None, :const:`default_interval` is used.
+
+  Note
+  ----
+  A manifest on disk with a different parameter hash, number of blocks or 
+  sink identity is ignored and overwritten.
+  """
+  def __init__(self, location, parameter, n_blocks, layout = None, sink = None, interval = None):
+    self.location = location;
+    self.parameter = parameter;
+    self.n_blocks = n_blocks;
+    self.layout = layout;
+    self.sink = sink;
+    self.interval = default_interval if interval is None else interval;
+    self.finished = set();
+    self.saved = 0;
+    self.load();
+
+  def load(self):
+    """Read the finished blocks if the file matches this run."""
+    if not os.path.exists(self.location):
+      return;
+    try:
+      with open(self.location, 'r') as f:
+        content = json.load(f);
+    except (OSError, ValueError):
+      return;
+    if _matches(content, self.parameter, self.n_blocks, self.sink):
+      self.finished = set(content.get('finished', []));
+
+  def save(self):
+    """Write the manifest atomically."""
+    content = dict(parameter=self.parameter, n_blocks=self.n_blocks, layout=self.layout, sink=self.sink, finished=sorted(self.finished));
+    write(self.location, content);
+    self.saved = time.time();
+
+  def mark(self, indices):
+    """Mark blocks as finished and save if the last write is old enough."""
+    self.finished.update(indices);
+    if time.time() - self.saved >= self.interval:
+      self.save();
+
+  def pending(self, indices = None):
+    """The blocks not finished yet."""
+    if indices is None:
+      indices = range(self.n_blocks);
+    return [i for i in indices if i not in self.finished];
+
+  def remove(self):
+    """Remove the manifest file."""
+    if os.path.exists(self.location):
+      os.remove(self.location);
+
+  def __repr__(self):
+    return 'Manifest(%d/%d)[%s]' % (len(self.finished), self.n_blocks, self.location);
+
+
+class BlockHashes(object):
+  """Hashes of the input blocks from which the sink blocks were computed.
+
+  Arguments
+  ---------
+  location : str
+    The file of the hashes.
+  parameter : str
+    Hash of the parameters of the run, see :func:`parameter_hash`.
+  n_blocks : int
+    The number of blocks of the run.
+  layout : dict or None
+    The block layout of the run stored with the hashes, see :func:`stored_layout`.
+  sink : tuple or None
+    The identity of the sink file, see :func:`sink_identity`.
+  interval : float or None
+    Minimal time between writes of the file when updating blocks.
+    If None, :const:`default_interval` is used.
+
+  Note
+  ----
+  The hashes on disk are only used if the parameter hash, the number of 
+  blocks and the sink identity match, otherwise all blocks are considered 
+  changed.
+  """
+  def __init__(self, location, parameter, n_blocks, layout = None, sink = None, interval = None):
+    self.location = location;
+    self.parameter = parameter;
+    self.n_blocks = n_blocks;
+    self.layout = layout;
+    self.sink = sink;
+    self.interval = default_interval if interval is None else interval;
+    self.hashes = [None] * n_blocks;
+    self.saved = 0;
+    self.load();
+
+  def load(self):
+    """Read the hashes if the file matches this run."""
+    if not os.path.exists(self.location):
+      return;
+    try:
+      with open(self.location, 'r') as f:
+        content = json.load(f);
+    except (OSError, ValueError):
+      return;
+    if _matches(content, self.parameter, self.n_blocks, self.sink):
+      self.hashes = content.get('hashes', self.hashes);
+
+  def save(self):
+    """Write the hashes atomically."""
+    content = dict(parameter=self.parameter, n_blocks=self.n_blocks, layout=self.layout, sink=self.sink, hashes=self.hashes);
+    write(self.location, content);
+    self.saved = time.time();
+
+  def changed(self, hashes, indices = None):
+    """The blocks whose input hash differs from the stored one.
+    
+    The stored hashes of these blocks are invalidated and saved, so that 
+    a block interrupted while being written is always processed again.
+    """
+    if indices is None:
+      indices = range(self.n_blocks);
+    changed = [i for i in indices if self.hashes[i] is None or self.hashes[i] != hashes[i]];
+    for i in changed:
+      self.hashes[i] = None;
+    self.save();
+    return changed;
+
+  def update(self, indices, hashes):
+    """Store the input hashes of processed blocks."""
+    for i in indices:
+      self.hashes[i] = hashes[i];
+    if time.time() - self.saved >= self.interval:
+      self.save();
+
+  def __repr__(self):
+    n_valid = sum(h is not None for h in self.hashes);
+    return 'BlockHashes(%d/%d)[%s]' % (n_valid, self.n_blocks, self.location);
+
+
+###############################################################################
+### Helpers
+###############################################################################
+
+def block_hash(sources):
+  """Hash of the data of the source blocks including their halo.
+
+  Arguments
+  ---------
+  sources : list of Blocks
+    The source blocks.
+
+  Returns
+  -------
+  hash : str
+    The hex digest of the block data, shapes and data types.
+  """
+  h = hashlib.blake2b(digest_size=16);
+  for source in sources:
+    array = np.ascontiguousarray(source.array);
+    h.update(repr((array.shape, str(array.dtype))).encode('utf-8'));
+    h.update(memoryview(array.reshape(-1)).cast('B'));
+  return h.hexdigest();
+
+
+def stored_layout(locations, user):
+  """The block layout stored in a manifest or hashes file for the same user parameters.
+
+  Arguments
+  ---------
+  locations : list of str or None
+    The manifest and hashes files to look in.
+  user : str
+    Hash of the user parameters of the run, see :func:`parameter_hash`.
+
+  Returns
+  -------
+  layout : dict or None
+    The stored layout, a dict with the user parameter hash under 'user' and
+    the parameters of the block splitting, or None if no file matches.
+  """
+  for location in locations:
+    if location is None or not os.path.exists(location):
+      continue;
+    try:
+      with open(location, 'r') as f:
+        layout = json.load(f).get('layout');
+    except (OSError, ValueError, AttributeError):
+      continue;
+    if isinstance(layout, dict) and layout.get('user') == user:
+      return layout;
+  return None;
+
+
+def sink_identity(location):
+  """Device, inode and size of a sink file or None if there is no file."""
+  if location is None or not os.path.isfile(location):
+    return None;
+  stat = os.stat(location);
+  return [stat.st_dev, stat.st_ino, stat.st_size];
+
+
+def discard(location):
+  """Remove the manifest and hashes files of a sink location."""
+  for e in (extension, hash_extension):
+    if os.path.exists(location + e):
+      os.remove(location + e);
+
+
+def _matches(content, parameter, n_blocks, sink):
+  """True if the content of a file belongs to the run."""
+  return (content.get('parameter') == parameter and content.get('n_blocks') == n_blocks and 
+          (sink is None or content.get('sink') == sink));
+
+
+def write(location, content):
+  """Write json content to a file atomically."""
+  temporary = location + '.tmp';
+  with open(temporary, 'w') as f:
+    json.dump(content, f);
+    f.flush();
+    os.fsync(f.fileno());
+  os.replace(temporary, location);
+
+
+def manifest_location(sink, extension = extension):
+  """Location of the manifest of a sink."""
+  location = getattr(sink, 'location', None);
+  if location is None:
+    raise ValueError('The sink %r has no location for a manifest!' % (sink,));
+  return location + extension;
+
+
+def parameter_hash(*parameter):
+  """Hash of the representations of the parameters of a run."""
+  h = hashlib.sha1();
+  for p in parameter:
+    h.update(repr(p).encode('utf-8'));
+  return h.hexdigest();
+
+
+def function_name(function):
+  """Name of a function including the arguments of partial functions."""
+  args = ();
+  while hasattr(function, 'func'):
+    args += (function.args, sorted(function.keywords.items()));
+    function = function.func;
+  name = '%s.%s' % (getattr(function, '__module__', None), getattr(function, '__qualname__', repr(function)));
+  return name + (repr(args) if args else '');
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import numpy as np
+  import IO.IO as io
+  import ParallelProcessing.BlockProcessing as bp
+
+  source = io.as_source(np.asarray(np.random.rand(20,30,40), order='F'));
+  sink = io.mmp.create('test_manifest.npy', shape=source.shape, dtype=float, order='F');
+
+  def fail_once(source, state = {}):
+    state['calls'] = state.get('calls', 0) + 1;
+    if state['calls'] == 3:
+      raise RuntimeError('test');
+    return 2 * source;
+
+  bp.process(fail_once, source, sink, size_max=10, axes=[2], overlap=0, processes='serial', manifest=True, retries=1);
+  print(np.all(sink.array == 2 * source.array))
+
+  #incremental
+  source = io.as_source(np.asarray(np.random.rand(20,30,40), order='F'));
+  def double(source):
+    return 2 * source;
+  bp.process(double, source, sink, size_max=10, axes=[2], overlap=2, processes='serial', incremental=True);
+  source[:,:,5] = 0;
+  bp.process(double, source, sink, size_max=10, axes=[2], overlap=2, processes='serial', incremental=True, verbose=True);
+  print(np.all(sink.array == 2 * source.array))
@@ -53,25 +53,46 @@ True
 >>>            processes = None, size_max = 10, size_min = 6, overlap = 3, axes = 'all',
 >>>            optimization = True, verbose = True);
 
+>>> def count(block):
+>>>   return int(np.sum(block.valid.array));
+>>>
+>>> bp.reduce(count, source > 0.5, combine = lambda a, b: a + b, function_type = 'block',
+>>>           size_max = 10, size_min = 6, overlap = 3, axes = [2])
+
 """
 __author__    = 'Christoph Kirst <ckirst@rockefeller.edu>'
 __license__   = 'MIT License <http://www.opensource.org/licenses/mit-license.php>'
 __copyright__ = 'Copyright 2020 by Christoph Kirst'
 
 
-import functools as ft
+import os
+import pickle
 import multiprocessing as mp
+import shutil
+import tempfile
+import contextlib
+import functools as ft
+import queue
+import threading
+import time
 import concurrent.futures as cf
 import warnings
 
 import numpy as np
+import scipy.ndimage as ndi
+import psutil
 import gc
 
 import ParallelProcessing.Block as blk
+import ParallelProcessing.BlockManifest as bm
+import ParallelProcessing.Parallelism as par
 import ParallelProcessing.ParallelTraceback as ptb
+import ParallelProcessing.WorkerPool as wp
 
 import IO.IO as io
+import IO.MMP as mmp
 import IO.SMA as sma
+import IO.Slice as slc
 import Utils.Timer as tmr;
 
 
@@ -81,7 +102,6 @@ import Utils.Timer as tmr;
 ###############################################################################
 ### Default parameter
 ###############################################################################
-from Utils.utilities import CancelableProcessPoolExecutor
 
 default_size_max = None
 """Default maximal size of a block.
@@ -125,8 +145,9 @@ def process(function, source, sink = None,
             axes = None, size_max = None, size_min = None, overlap = None,  
             optimization = True, optimization_fix = 'all', neighbours = False,
             function_type = None, as_memory = False, return_result = False,
-            return_blocks = False,
-            processes = None, verbose = False, workspace=None,
+            return_blocks = False, cost = None, split_outliers = None, in_flight = None, timings = None,
+            memory_limit = None, prefetch = None, manifest = None, retries = 0, incremental = None, occupancy = None,
+            layout = 'blocks', processes = None, backend = 'processes', verbose = False, workspace=None,
             **kwargs):
   """Create blocks and process a function on them in parallel.
   
@@ -139,9 +160,11 @@ def process(function, source, sink = None,
   sink : str, Source, list, or None
     The sink or list of sinks to write the result to.
     If None, return single array.
-  axes : int, list of ints, or None
+  axes : int, list of ints, 'optimal' or None
     Axes along which to split the source. If None, the 
     splitting is determined automaticlly from the order of the array.
+    If 'optimal', the axes and block sizes are chosen to minimize the 
+    processed volume including the overlaps, see :func:`optimal_block_shape`.
   size_max : int, list of ints or None
     Maximal size of a block along the axes. 
     If None, :const:`default_size_max` is used.
@@ -177,8 +200,89 @@ def process(function, source, sink = None,
     If True, return the results of the proceessing functions.
   return_blocks : bool
     If True, return the block information used to distribute the processing.
-  processes : int, None
+  cost : None, 'foreground', function, dict or list
+    Estimated processing cost of each block. If not None, blocks are 
+    submitted in order of decreasing cost with at most in_flight blocks
+    pending, so that expensive blocks do not end up in the tail of the run.
+    
+    * 'foreground'
+      Number of non-zero voxels of the first source in a subsample 
+      of the valid region of each block.
+    * function
+      Called with the Block of the first source to return its cost.
+    * dict
+      The timings of a previous run keyed by block range, see timings.
+      Blocks without a timing get the summed timings of the ranges they 
+      contain, e.g. blocks split in the previous run, or the mean timing.
+    * list
+      The cost of each block in the order of the blocks of this run.
+    
+  split_outliers : float or None
+    If not None, blocks with a cost larger than this factor times the mean 
+    cost are split further along their largest split axis.
+  in_flight : int or None
+    Maximal number of submitted blocks not yet finished. If None and cost is
+    given, twice the number of processes is used, otherwise all blocks 
+    are submitted at once.
+  timings : dict or None
+    If a dict, it is filled with the processing time of each block keyed 
+    by its range, see :func:`block_range`, which can be passed as cost to 
+    a later run, also if the blocks were split differently.
+  memory_limit : int or None
+    Memory budget in bytes for all workers. If None and the function 
+    declares its footprint via :func:`memory_footprint`, the available 
+    memory is used. The maximal block sizes and the number of processes 
+    are reduced to stay within this budget, see :func:`memory_block_sizes`.
+  prefetch : int or None
+    If not None, each worker processes a sequence of blocks as a pipeline,
+    reading up to this many blocks ahead in a thread while the current 
+    block is computed, and writing results back in a second thread.
+    The pipelines pull the next pending block in the scheduled order from 
+    a common queue, so the load is balanced over the workers.
+    The depth is reduced to fit into the memory budget, 
+    see :func:`prefetch_depth`. Blocks are always loaded into memory.
+  manifest : bool, str or None
+    If True or a file name, finished blocks are recorded in a manifest, by
+    default next to the first sink, see 
+    :mod:`~ParallelProcessing.BlockManifest`. A rerun with the same 
+    parameters skips the finished blocks. The manifest is removed when all
+    blocks are finished. The block layout is stored with the manifest and
+    reused by a rerun with the same parameters, also if it was derived from
+    the available memory, and the records are discarded if the sink is 
+    created anew.
+  retries : int
+    Number of times a failed block is resubmitted before the run aborts.
+    A broken process pool, e.g. after a worker was killed, is not retried
+    but the run can be resumed with a manifest.
+  incremental : bool, str or None
+    If True or a file name, the hashes of the source blocks including their
+    halo are stored, by default next to the first sink, and only blocks 
+    whose input hash changed are processed, see 
+    :class:`~ParallelProcessing.BlockManifest.BlockHashes`. The parameter
+    hash covers the function, its arguments and the block layout, so that
+    any change of these processes all blocks again. The sink has to keep 
+    the results of the previous run, the hashes are bound to the identity 
+    of the sink file. The block layout is reused as for the manifest.
+  occupancy : Occupancy, True or None
+    If given, blocks whose first source has no foreground including the 
+    overlap are not processed and the valid regions of their sinks are set 
+    to zero, so the function has to map empty blocks to zero. If True, the 
+    occupancy pyramid is read from the sidecar file of the first source and 
+    all blocks are processed if there is none, see :mod:`~IO.Occupancy`.
+  layout : 'blocks' or 'table'
+    If 'table', the blocks are described by a compact table, see 
+    :func:`block_table`, instead of Block objects. Each task gets a chunk of
+    table rows together with the virtual sources and sinks, which the worker
+    opens once and slices locally. Use this for many small blocks. Supports
+    the manifest, retries and timings options.
+  processes : int, WorkerPool, 'serial' or None
     The number of parallel processes, if 'serial', use serial processing.
+    If a :class:`~ParallelProcessing.WorkerPool.WorkerPool` is passed, its
+    workers are used and the pool is not shut down.
+  backend : 'processes' or 'threads'
+    If 'threads', blocks are processed in threads as views on the sources
+    and sinks, which avoids pickling and reopening them in each worker.
+    Use this for block functions that release the GIL.
   verbose : bool
     Print information on sub-stack generation.
       
@@ -192,11 +296,14 @@ def process(function, source, sink = None,
   This implementation only supports processing into sinks with the same shape as the source.
   """
   #sources and sinks
+  if backend not in ('processes', 'threads'):
+    raise ValueError("backend %r not 'processes' or 'threads'!" % backend);
+
   if isinstance(source, list):
     sources = source;
   else:
     sources = [source];
-  sources = [io.as_source(s).as_virtual() for s in sources];
+  sources = [_as_block_source(s, backend) for s in sources];
 
   #if sink is None:
   #  sink = sma.Source(shape=sources[0].shape, dtype=sources[0].dtype, order=sources[0].order);
@@ -207,12 +314,89 @@ def process(function, source, sink = None,
   else:
     sinks = [sink];
 
+  new_sinks = [isinstance(s, str) and not os.path.exists(s) for s in sinks];
   sinks = [io.initialize(s, hint=sources[0]) for s in sinks];
-  sinks = [io.as_source(s).as_virtual() for s in sinks];
-
+  sinks = [_as_block_source(s, backend) for s in sinks];
+
+  #resumable runs reuse the block layout stored with the manifest or hashes
+  stored = None;
+  if manifest or incremental:
+    for s, new in zip(sinks, new_sinks):
+      if new and s.location is not None:
+        bm.discard(s.location);
+    if manifest is True:
+      manifest = bm.manifest_location(sinks[0] if len(sinks) > 0 else None);
+    if incremental is True:
+      incremental = bm.manifest_location(sinks[0] if len(sinks) > 0 else None, extension=bm.hash_extension);
+    user = bm.parameter_hash(bm.function_name(function), function_type, sorted(kwargs.items()),
+                             [(getattr(s, 'location', None), s.shape, str(s.dtype), s.order) for s in sources + sinks],
+                             axes, size_max, size_min, overlap, optimization, optimization_fix, neighbours, memory_limit, layout);
+    stored = bm.stored_layout([manifest or None, incremental or None], user);
+    sink_identity = bm.sink_identity(sinks[0].location if len(sinks) > 0 else None);
+
+  optimal = axes == 'optimal';
+  if optimal:
+    axes = 'all';
   axes = block_axes(sources[0], axes=axes);
 
-  split = ft.partial(split_into_blocks, processes=processes, axes=axes,
+  #memory budget
+  bytes_per_voxel = _declared(function, 'bytes_per_voxel');
+  if overlap is None and _declared(function, 'halo') is not None:
+    overlap = 2 * _declared(function, 'halo');
+  if bytes_per_voxel is not None or memory_limit is not None:
+    if bytes_per_voxel is None:
+      bytes_per_voxel = sum(s.dtype.itemsize for s in sources + sinks);
+    n_processes = 1 if processes == 'serial' else wp.n_processes(processes);
+    if not isinstance(n_processes, int):
+      n_processes = par.processes();
+    size_max, n_processes = memory_block_sizes(sources[0].shape, axes=axes, processes=n_processes,
+                                               bytes_per_voxel=bytes_per_voxel, overhead=_declared(function, 'overhead') or 0,
+                                               overlap=overlap, size_max=size_max, memory_limit=memory_limit, verbose=verbose);
+    if isinstance(processes, int) or processes is None:
+      processes = n_processes;
+  
+  #block shape
+  if optimal:
+    n_processes = 1 if processes == 'serial' else wp.n_processes(processes);
+    block_voxels_max = None if bytes_per_voxel is None else np.prod(size_max);
+    axes, size_max = optimal_block_shape(sources[0].shape, processes=n_processes, overlap=overlap, 
+                                         block_voxels_max=block_voxels_max, order=sources[0].order, verbose=verbose);
+    size_min = None;
+    optimization = False;
+  
+  split_processes = wp.n_processes(processes);
+  if manifest or incremental:
+    if stored is not None:
+      axes, size_max, size_min = stored['axes'], stored['size_max'], stored['size_min'];
+      optimization, split_processes = stored['optimization'], stored['processes'];
+      if verbose:
+        print('Reusing the stored block layout %r.' % (stored,));
+    block_layout = dict(user=user, axes=_as_json(axes), size_max=_as_json(size_max), size_min=_as_json(size_min),
+                        optimization=_as_json(optimization), processes=_as_json(split_processes));
+    parameter = bm.parameter_hash(user, sorted(block_layout.items()));
+  
+  if layout == 'table':
+    for name, value in [('neighbours', neighbours), ('cost', cost), ('prefetch', prefetch), ('incremental', incremental),
+                        ('occupancy', occupancy), ('return_result', return_result)]:
+      if value:
+        raise ValueError('%s is not supported with a table layout!' % name);
+    table = block_table(sources[0], processes=split_processes, axes=axes,
+                        size_max=size_max, size_min=size_min,
+                        overlap=overlap, optimization=optimization,
+                        optimization_fix=optimization_fix, verbose=False);
+    if manifest:
+      manifest = bm.Manifest(manifest, parameter=parameter, n_blocks=len(table), layout=block_layout, sink=sink_identity);
+    _process_table(function, sources, sinks, table, function_type=function_type, as_memory=as_memory,
+                   manifest=manifest, retries=retries, timings=timings, processes=processes, backend=backend, 
+                   verbose=verbose, workspace=workspace, **kwargs);
+    ret = sink;
+    if return_blocks:
+      ret = (ret, table);
+    return ret;
+  elif layout != 'blocks':
+    raise ValueError("layout %r not 'blocks' or 'table'!" % layout);
+
+  split = ft.partial(split_into_blocks, processes=split_processes, axes=axes,
                      size_max=size_max, size_min=size_min,
                      overlap=overlap, optimization=optimization,
                      optimization_fix=optimization_fix, neighbours=neighbours,
@@ -224,9 +408,17 @@ def process(function, source, sink = None,
 
   source_blocks = [[blocks[i] for blocks in source_blocks] for i in range(n_blocks)];
   sink_blocks =  [[blocks[i] for blocks in sink_blocks] for i in range(n_blocks)];
+  
+  if verbose:
+    print('Split source into %d blocks with redundancy %.3f.' % (n_blocks, redundancy([b[0] for b in source_blocks])));
 
   if function_type is None:
     function_type = 'array';
+  if prefetch is not None:
+    if function_type not in ('array', 'source', 'block'):
+      raise ValueError("function type %r not 'array', 'source', 'block' or None!");
+    if return_result:
+      raise ValueError('Results cannot be returned when prefetching blocks!');
   if function_type == 'block':
     func = ft.partial(process_block_block, function=function, as_memory=as_memory, return_result=return_result, verbose=verbose, **kwargs);
   elif function_type == 'source':
@@ -234,54 +426,1199 @@ def process(function, source, sink = None,
   elif function_type == 'array':
     func = ft.partial(process_block_source, function=function, as_memory=as_memory, as_array=True, verbose=verbose, **kwargs);
   else:
-    raise ValueError("function type %r not 'array', 'source', 'block' or None!");
+    raise ValueError("function type %r not 'array', 'source', 'block' or None!");
+
+  if not isinstance(processes, int) and not wp.is_pool(processes) and processes != "serial":
+    processes = par.processes();
+
+  #scheduling
+  order = None;
+  if cost is not None:
+    source_blocks, sink_blocks, costs = block_costs(source_blocks, sink_blocks, cost=cost, split_outliers=split_outliers, axes=axes, verbose=verbose);
+    n_blocks = len(source_blocks);
+    order = list(np.argsort(-np.asarray(costs), kind='stable'));
+    if in_flight is None and processes != "serial":
+      in_flight = 2 * wp.n_processes(processes);
+  #resume
+  if manifest:
+    manifest = bm.Manifest(manifest, parameter=parameter, n_blocks=n_blocks, layout=block_layout, sink=sink_identity);
+    order = manifest.pending(order);
+    if verbose:
+      print('Resuming with %d of %d blocks finished.' % (n_blocks - len(order), n_blocks));
+  
+  #incremental
+  if incremental:
+    hashes = block_hashes(source_blocks, processes=processes, backend=backend);
+    incremental = bm.BlockHashes(incremental, parameter=parameter, n_blocks=n_blocks, layout=block_layout, sink=sink_identity);
+    n_pending = n_blocks if order is None else len(order);
+    order = incremental.changed(hashes, order);
+    if verbose:
+      print('Incremental processing of %d of %d blocks with changed input.' % (len(order), n_pending));
+  
+  #empty blocks
+  if occupancy is not None and occupancy is not False:
+    empty = empty_blocks(source_blocks, sink_blocks, occupancy=occupancy);
+    n_pending = n_blocks if order is None else len(order);
+    order = [i for i in (range(n_blocks) if order is None else order) if i not in empty];
+    if verbose:
+      print('Skipping %d of %d blocks without foreground.' % (n_pending - len(order), n_pending));
+  
+  if prefetch is not None:
+    n_processes = 1 if processes == 'serial' else wp.n_processes(processes);
+    depth = prefetch_depth(source_blocks, sink_blocks, prefetch=prefetch, processes=n_processes, 
+                           memory_limit=memory_limit, verbose=verbose);
+    func = ft.partial(process_block_pipeline, function=function, function_type=function_type, 
+                      prefetch=depth, verbose=verbose, **kwargs);
+  elif timings is not None:
+    func = ft.partial(_timed, function=func);
+  
+  done = None;
+  if manifest or incremental:
+    def done(i):
+      if manifest:
+        manifest.mark([i]);
+      if incremental:
+        incremental.update([i], hashes);
+
+  if verbose:
+    timer = tmr.Timer();
+    print("Processing %d blocks with function %r." % (n_blocks, function.__name__))
+
+  if processes != "serial":
+    #from bounded_pool_executor import BoundedProcessPoolExecutor
+    #with BoundedProcessPoolExecutor(max_workers=processes) as executor:
+    #   executor.map(function, source_blocks, sink_blocks)
+    with block_executor(processes, backend=backend) as executor, _finishing(manifest, incremental):
+      if workspace is not None:
+        workspace.executor = executor
+      if prefetch is not None:
+        result = _run_pipelines(executor, func, source_blocks, sink_blocks, order=order, n_pipelines=n_processes,
+                                retries=retries, done=done, shared=backend != 'threads');
+      elif order is None and in_flight is None and done is None and retries == 0:
+        futures = [executor.submit(func, *args) for args in zip(source_blocks, sink_blocks)]
+        # res = executor.map(func, source_blocks, sink_blocks)
+        result = [f.result() for f in futures]  # To prevent keeping references to futures to avoid mem leaks
+        # result = list(res)
+      else:
+        result = _submit_bounded(executor, func, source_blocks, sink_blocks, order=order, in_flight=in_flight,
+                                 retries=retries, done=done);
+      if workspace is not None:
+        workspace.executor = None
+  elif prefetch is not None:
+    with _finishing(manifest, incremental):
+      result = _run_pipelines(None, func, source_blocks, sink_blocks, order=order, retries=retries, done=done);
+  else:
+    if order is None:
+      order = range(len(source_blocks));
+    result = [None] * len(source_blocks);
+    with _finishing(manifest, incremental):
+      for i in order:
+        result[i] = _retry(func, source_blocks[i], sink_blocks[i], retries=retries, index=i);
+        if done is not None:
+          done(i);
+  
+  if prefetch is not None and timings is None:
+    result = [None] * n_blocks;
+  
+  if timings is not None:
+    timings.clear();
+    timings.update({block_range(b[0]) : r[0] for b, r in zip(source_blocks, result) if r is not None});
+    result = [None if r is None else r[1] for r in result];
+
+  if verbose:
+    timer.print_elapsed_time("Processed %d blocks with function %r" % (n_blocks, function.__name__))
+
+  #gc.collect();
+
+  if return_result:
+    ret = result;
+  else:
+    ret = sink;
+  if return_blocks:
+    ret = (ret, [source_blocks, sink_blocks]);
+  return ret;
+
+
+def _process_table(function, sources, sinks, table, function_type = None, as_memory = False, 
+                   manifest = None, retries = 0, timings = None, processes = None, backend = 'processes', 
+                   verbose = False, workspace = None, **kwargs):
+  """Process the blocks of a table layout, see :func:`process`."""
+  if function_type is None:
+    function_type = 'array';
+  if function_type not in ('array', 'source', 'block'):
+    raise ValueError("function type %r not 'array', 'source', 'block' or None!" % function_type);
+  if not isinstance(processes, int) and not wp.is_pool(processes) and processes != "serial":
+    processes = par.processes();
+  n_blocks = len(table);
+  
+  order = None;
+  if manifest:
+    if not isinstance(manifest, bm.Manifest):
+      if manifest is True:
+        manifest = bm.manifest_location(sinks[0] if len(sinks) > 0 else None);
+      parameter = bm.parameter_hash(bm.function_name(function), function_type, sorted(kwargs.items()),
+                                    [(getattr(s, 'location', None), s.shape, str(s.dtype), s.order) for s in sources + sinks],
+                                    bm.parameter_hash(table.tobytes()));
+      manifest = bm.Manifest(manifest, parameter=parameter, n_blocks=n_blocks);
+    order = manifest.pending();
+    if verbose:
+      print('Resuming with %d of %d blocks finished.' % (n_blocks - len(order), n_blocks));
+  
+  n_processes = 1 if processes == 'serial' else wp.n_processes(processes);
+  tasks = _table_tasks(n_blocks, n_processes, order=order);
+  task_tables = [table[t] for t in tasks];
+  
+  func = ft.partial(process_block_table, sources=sources, sinks=sinks, function=function, 
+                    function_type=function_type, as_memory=as_memory, verbose=verbose, **kwargs);
+  func = ft.partial(_call_first, function=func);
+  done = None;
+  if manifest:
+    done = lambda i: manifest.mark([int(j) for j in tasks[i]]);
+  
+  if verbose:
+    timer = tmr.Timer();
+    print("Processing %d blocks in %d tasks with function %r." % (n_blocks, len(tasks), function.__name__))
+  
+  empty = [None] * len(tasks);
+  if processes != "serial":
+    with block_executor(processes, backend=backend) as executor, _finishing(manifest):
+      if workspace is not None:
+        workspace.executor = executor
+      result = _submit_bounded(executor, func, task_tables, empty, retries=retries, done=done);
+      if workspace is not None:
+        workspace.executor = None
+  else:
+    result = [None] * len(tasks);
+    with _finishing(manifest):
+      for i in range(len(tasks)):
+        result[i] = _retry(func, task_tables[i], None, retries=retries, index=i);
+        if done is not None:
+          done(i);
+  
+  if timings is not None:
+    timings.clear();
+    for t, r in zip(tasks, result):
+      for i, time_block in zip(t, r):
+        timings[tuple(tuple(v) for v in table[i]['valid'].tolist())] = time_block;
+  
+  if verbose:
+    timer.print_elapsed_time("Processed %d blocks with function %r" % (n_blocks, function.__name__))
+
+
+def _call_first(*args, function = None):
+  """Call a function with the first argument only."""
+  return function(args[0]);
+
+
+def reduce(function, source, combine,
+           initial = None, axes = None, size_max = None, size_min = None, overlap = None,  
+           optimization = True, optimization_fix = 'all', neighbours = False,
+           function_type = None, as_memory = False, return_blocks = False,
+           processes = None, backend = 'processes', verbose = False, workspace=None,
+           **kwargs):
+  """Create blocks, process a function on them in parallel and combine the results.
+  
+  Arguments
+  ---------
+  function : function
+    The function computing a block result, e.g. a count or histogram.
+  source : str, Source, or list
+    The source or list of sources to apply the function to.
+  combine : function
+    Associative function combining two results into one. Results of adjacent
+    blocks are combined in block order, ``combine(left, right)``.
+  initial : object
+    The result returned if there are no blocks.
+  axes : int, list of ints, or None
+    Axes along which to split the source. If None, the 
+    splitting is determined automaticlly from the order of the array.
+  size_max : int, list of ints or None
+    Maximal size of a block along the axes. 
+    If None, :const:`default_size_max` is used.
+  size_min : int or list of ints
+    Minial size of a block along the axes. 
+    If None, :const:`default_size_min` is used.
+  overlap : int, list of ints or None
+    Minimal overlap between blocks along the axes.
+    If None, :const:`default_overlap` is used.
+  optimization : bool or list of bools
+    If True, optimize block sizes to best fit number of processes.
+  optimization_fix : 'increase', 'decrease', 'all' or None or list
+    Increase, decrease or optimally change the block size when optimization 
+    is active.
+  neighbours : bool
+    If True, also include information about the neighbourhood in the blocks.
+  function_type : 'array', 'source', 'block' or None
+    The function type passed. If None, 'array' is used.
+    
+    * 'array'
+      The function gets passed the full blocks as numpy arrays.
+    * 'source' 
+      The function gets passed the full blocks as Source classes.
+    * 'block' 
+      The function gets passed the Block classes, e.g. to restrict the 
+      statistics to the valid region via block.valid.
+    
+  as_memory : bool
+    If True, load full blocks into memory before applying the function.
+  return_blocks : bool
+    If True, return the block information used to distribute the processing.
+  processes : int, WorkerPool, 'serial' or None
+    The number of parallel processes, if 'serial', use serial processing.
+    If a :class:`~ParallelProcessing.WorkerPool.WorkerPool` is passed, its
+    workers are used and the pool is not shut down.
+  backend : 'processes' or 'threads'
+    If 'threads', blocks are processed in threads as views on the sources
+    and sinks, which avoids pickling and reopening them in each worker.
+    Use this for block functions that release the GIL.
+  verbose : bool
+    Print information on sub-stack generation.
+      
+  Returns
+  -------
+  result : object
+    The combined result of all blocks.
+  
+  Note
+  ----
+  Only the block results are sent back from the workers, no sink is allocated.
+  Results are combined as soon as the results of adjacent blocks are 
+  available, so the combination forms a tree over the blocks and the 
+  order of the blocks is preserved. The pairs are combined in the workers
+  unless combine cannot be pickled for the process backend.
+  """
+  #sources
+  if backend not in ('processes', 'threads'):
+    raise ValueError("backend %r not 'processes' or 'threads'!" % backend);
+
+  if isinstance(source, list):
+    sources = source;
+  else:
+    sources = [source];
+  sources = [_as_block_source(s, backend) for s in sources];
+
+  axes = block_axes(sources[0], axes=axes);
+
+  split = ft.partial(split_into_blocks, processes=wp.n_processes(processes), axes=axes,
+                     size_max=size_max, size_min=size_min,
+                     overlap=overlap, optimization=optimization,
+                     optimization_fix=optimization_fix, neighbours=neighbours,
+                     verbose=False);
+
+  source_blocks = [split(s) for s in sources];
+  n_blocks = len(source_blocks[0]);
+  source_blocks = [[blocks[i] for blocks in source_blocks] for i in range(n_blocks)];
+
+  if function_type is None:
+    function_type = 'array';
+  if function_type not in ('array', 'source', 'block'):
+    raise ValueError("function type %r not 'array', 'source', 'block' or None!" % function_type);
+  func = ft.partial(reduce_block, function=function, function_type=function_type, as_memory=as_memory, verbose=verbose, **kwargs);
+
+  if not isinstance(processes, int) and not wp.is_pool(processes) and processes != "serial":
+    processes = par.processes();
+
+  if verbose:
+    timer = tmr.Timer();
+    print("Reducing %d blocks with function %r." % (n_blocks, function.__name__))
+
+  if processes != "serial":
+    with block_executor(processes, backend=backend) as executor:
+      if workspace is not None:
+        workspace.executor = executor
+      futures = {executor.submit(func, blocks) : (i, i + 1) for i, blocks in enumerate(source_blocks)};
+      results = _AdjacentCombiner(combine, executor=executor if backend == 'threads' or _picklable(combine) else None, pending=futures);
+      while len(futures) > 0:
+        done, _ = cf.wait(list(futures), return_when=cf.FIRST_COMPLETED);
+        for future in done:
+          start, end = futures.pop(future);
+          results.add(start, end, future.result());
+      if workspace is not None:
+        workspace.executor = None
+  else:
+    results = _AdjacentCombiner(combine);
+    for i, blocks in enumerate(source_blocks):
+      results.add(i, i + 1, func(blocks));
+
+  if verbose:
+    timer.print_elapsed_time("Reduced %d blocks with function %r" % (n_blocks, function.__name__))
+
+  ret = results.result(initial=initial);
+  if return_blocks:
+    ret = (ret, source_blocks);
+  return ret;
+
+
+###############################################################################
+### Iterative processing
+###############################################################################
+
+def iterate(function, source, sink = None, iterations = 1, halo = 1, until_stable = False, statistics = None,
+            axes = None, size_max = None, size_min = None,
+            optimization = True, optimization_fix = 'all', as_memory = True,
+            buffer_directory = None, processes = None, backend = 'processes', verbose = False,
+            **kwargs):
+  """Iterate a stencil function on blocks exchanging their halos after each step.
+  
+  Arguments
+  ---------
+  function : function
+    One iteration of the stencil, called with an array of a block including
+    its halo and returning an array of the same shape.
+  source : str, Source or array
+    The source to iterate on.
+  sink : str, Source, array or None
+    The sink to write the result to. If None, return an array.
+  iterations : int or None
+    The number of iterations, or the maximal number if until_stable is True.
+    If None, iterate until stable.
+  halo : int
+    The range of the stencil of a single iteration.
+  until_stable : bool
+    If True, iterate until no block changes. After the first step only 
+    blocks that changed in the previous step and their neighbours are
+    processed.
+  statistics : list or None
+    If a list, it is filled with a dict for each step with the number of
+    'active' and 'changed' blocks and the elapsed 'time'.
+  axes, size_max, size_min, optimization, optimization_fix
+    Block splitting parameter, see :func:`split_into_blocks`.
+  as_memory : bool
+    If True, load the blocks into memory before applying the function.
+  buffer_directory : str or None
+    Directory of the two buffers holding the volume between iterations. 
+    If None, /dev/shm is used if it exists, otherwise the temporary directory.
+  processes : int, WorkerPool, 'serial' or None
+    The number of parallel processes, or a persistent pool.
+  backend : 'processes' or 'threads'
+    The executor type, see :func:`process`.
+  verbose : bool
+    Print progress information.
+    
+  Returns
+  -------
+  sink : Source or array
+    The result after the iterations.
+  
+  Note
+  ----
+  The blocks overlap by twice the halo only. Each step reads the blocks with 
+  their halos from one buffer and writes the valid regions into the other, 
+  the buffers are swapped after all blocks finished the step. Thus the halos 
+  are exchanged between neighbouring blocks through the shared buffers and 
+  the total work is close to iterations times the volume, while processing 
+  all iterations in one call of :func:`process` needs an overlap growing 
+  with the number of iterations.
+  
+  When iterating until stable, a block is skipped if neither it nor any of 
+  its neighbours changed in the previous step. Its input and thus its result 
+  is then unchanged, and both buffers already agree on its valid region. 
+  The function needs to be deterministic and its halo smaller than the 
+  valid regions of the neighbouring blocks.
+  """
+  source = io.as_source(source);
+  if iterations is None:
+    until_stable = True;
+  
+  directory = tempfile.mkdtemp(prefix='iterate_', dir=_buffer_directory(buffer_directory));
+  try:
+    buffers = [mmp.create(location=os.path.join(directory, 'buffer%d.npy' % i), 
+                          shape=source.shape, dtype=source.dtype, order=source.order) for i in range(2)];
+    _copy(source, buffers[0]);
+    if until_stable:
+      _copy(source, buffers[1]);
+    
+    if processes is None:
+      processes = par.processes();
+    n_processes = 1 if processes == 'serial' else wp.n_processes(processes);
+    split = ft.partial(split_into_blocks, processes=n_processes, axes=axes, 
+                       size_max=size_max, size_min=size_min, overlap=2 * halo,
+                       optimization=optimization, optimization_fix=optimization_fix);
+    blocks = [split(_as_block_source(b, backend)) for b in buffers];
+    n_blocks = len(blocks[0]);
+    blocks_shape = tuple(np.max([b.index for b in blocks[0]], axis=0) + 1);
+    func = ft.partial(iterate_block, function=function, as_memory=as_memory, **kwargs);
+    
+    if verbose:
+      timer = tmr.Timer();
+      print('Iterating %r %s times on %d blocks with redundancy %.3f.' % 
+            (getattr(function, '__name__', function), 'until stable' if iterations is None else iterations, 
+             n_blocks, redundancy(blocks[0])));
+    
+    if statistics is None:
+      statistics = [];
+    statistics[:] = [];
+    active = np.arange(n_blocks);
+    step = 0;
+    with block_executor(processes, backend=backend) if processes != 'serial' else contextlib.nullcontext() as executor:
+      while (iterations is None or step < iterations) and len(active) > 0:
+        start = time.perf_counter();
+        step_blocks = [(blocks[step % 2][i], blocks[(step + 1) % 2][i]) for i in active];
+        if executor is None:
+          changed = [func(source_block, sink_block) for source_block, sink_block in step_blocks];
+        else:
+          futures = [executor.submit(func, source_block, sink_block) for source_block, sink_block in step_blocks];
+          changed = [future.result() for future in futures];
+        changed = active[np.asarray(changed, dtype=bool)];
+        statistics.append(dict(step=step, active=len(active), changed=len(changed), time=time.perf_counter() - start));
+        step += 1;
+        
+        if verbose:
+          timer.print_elapsed_time('Iteration %d: %d/%d blocks active, %d changed' % (step, len(active), n_blocks, len(changed)));
+        
+        if until_stable:
+          active = _dirty_blocks(changed, blocks_shape);
+    
+    if verbose and until_stable:
+      print('Iterations %s after %d steps.' % ('stable' if len(active) == 0 else 'stopped', step));
+    
+    result = buffers[step % 2];
+    if sink is None:
+      sink = np.array(result.array);
+    else:
+      sink = io.initialize(sink, hint=source);
+      _copy(result, sink);
+  finally:
+    shutil.rmtree(directory, ignore_errors=True);
+  
+  return sink;
+
+
+@ptb.parallel_traceback
+def iterate_block(source, sink, function, as_memory = True, **kwargs):
+  """Process one iteration of a block and write its valid region.
+  
+  Arguments
+  ---------
+  source : Block
+    The block with its halo to read from.
+  sink : Block
+    The block to write the valid region to.
+  function  func : function
+    The function to call.
+  
+  Returns
+  -------
+  changed : bool
+    True if the valid region of the block changed.
+  """
+  array = source.as_memory() if as_memory else source.array;
+  result = function(array, **kwargs);
+  valid = source.valid.slicing;
+  result = result[valid];
+  changed = not np.array_equal(result, array[valid]);
+  sink.valid[:] = result;
+  return changed;
+
+
+def _dirty_blocks(changed, blocks_shape):
+  """Indices of the changed blocks and their neighbours including diagonals."""
+  dirty = np.zeros(int(np.prod(blocks_shape)), dtype=bool);
+  dirty[changed] = True;
+  dirty = ndi.binary_dilation(dirty.reshape(blocks_shape), structure=np.ones((3,) * len(blocks_shape), dtype=bool));
+  return np.nonzero(dirty.reshape(-1))[0];
+
+
+def empty_blocks(source_blocks, sink_blocks = None, occupancy = True):
+  """Blocks without foreground in the first source including the overlap.
+  
+  Arguments
+  ---------
+  source_blocks : list of lists of Blocks
+    The source blocks of each block.
+  sink_blocks : list of lists of Blocks or None
+    If given, the valid regions of the sinks of the empty blocks are set 
+    to zero.
+  occupancy : Occupancy or True
+    The occupancy pyramid of the first source. If True, it is read from the
+    sidecar file of the first source.
+  
+  Returns
+  -------
+  empty : set of ints
+    The indices of the empty blocks.
+  """
+  if len(source_blocks) == 0:
+    return set();
+  base = source_blocks[0][0].base;
+  occupancy = io.occupancy(base) if occupancy is True else io.occupancy(occupancy);
+  if occupancy is None:
+    return set();
+  if occupancy.shape != tuple(base.shape):
+    raise ValueError('The occupancy shape %r does not match the source shape %r!' % (occupancy.shape, base.shape));
+  
+  empty = set(i for i, blocks in enumerate(source_blocks) 
+              if occupancy.is_empty(slc.sliced_region(blocks[0].base_slicing, blocks[0].base_shape)[0]));
+  if sink_blocks is not None:
+    for i in empty:
+      for sink in sink_blocks[i]:
+        sink.valid[:] = 0;
+  return empty;
+
+
+def _buffer_directory(directory = None):
+  """Directory for shared buffers, preferably in memory."""
+  if directory is None and os.path.isdir('/dev/shm'):
+    directory = '/dev/shm';
+  return directory;
+
+
+def _copy(source, sink, size = 2**28):
+  """Copy a source into a sink in slabs along the slowest axis."""
+  axis = len(source.shape) - 1 if source.order == 'F' else 0;
+  n = source.shape[axis];
+  slab = max(1, int(size // max(1, np.prod(source.shape) * source.dtype.itemsize // max(1, n))));
+  for lo in range(0, n, slab):
+    slicing = tuple(slice(lo, lo + slab) if d == axis else slice(None) for d in range(len(source.shape)));
+    sink[slicing] = source[slicing];
+
+
+###############################################################################
+### Memory budget
+###############################################################################
+
+def memory_footprint(bytes_per_voxel, halo = None, overhead = 0):
+  """Decorator declaring the memory footprint of a block function.
+  
+  Arguments
+  ---------
+  bytes_per_voxel : float
+    Peak memory used per voxel of a block including temporary arrays.
+  halo : int or None
+    Border needed around the valid region of a block. If not None and 
+    no overlap is given, the overlap between blocks is twice the halo.
+  overhead : int
+    Memory used per worker independent of the block size, e.g. for 
+    look-up tables.
+  
+  Example
+  -------
+  >>> @bp.memory_footprint(bytes_per_voxel=17, halo=2)
+  >>> def smooth(source):
+  >>>   ...
+  """
+  def decorator(function):
+    function.bytes_per_voxel = bytes_per_voxel;
+    function.halo = halo;
+    function.overhead = overhead;
+    return function;
+  return decorator;
+
+
+def _declared(function, name):
+  """Footprint attribute declared by a function or the function wrapped by a partial."""
+  while function is not None:
+    value = getattr(function, name, None);
+    if value is not None:
+      return value;
+    function = getattr(function, 'func', None);
+  return None;
+
+
+def memory_block_sizes(shape, axes, processes, bytes_per_voxel, overhead = 0, overlap = None,
+                       size_max = None, memory_limit = None, verbose = False):
+  """Maximal block sizes and number of processes within a memory budget.
+  
+  Arguments
+  ---------
+  shape : tuple of ints
+    The shape of the source.
+  axes : list of ints
+    The axes along which the source is split.
+  processes : int
+    The desired number of processes.
+  bytes_per_voxel : float
+    Peak memory per voxel of a block.
+  overhead : int
+    Memory per worker independent of the block size.
+  overlap : int, list of ints or None
+    The overlap between blocks along the axes.
+  size_max : int, list of ints or None
+    The maximal block sizes along the axes requested by the user.
+  memory_limit : int or None
+    The memory budget in bytes. If None, the available memory is used.
+  verbose : bool
+    Print information on the block sizes.
+  
+  Returns
+  -------
+  size_max : list of ints
+    The maximal block sizes along the axes.
+  processes : int
+    The number of processes that fit into the budget.
+  
+  Note
+  ----
+  The blocks are made as cubic as possible along the split axes. If the 
+  smallest useful blocks, i.e. twice the overlap plus one, do not fit for 
+  the given number of processes, the number of processes is reduced.
+  """
+  if memory_limit is None:
+    memory_limit = psutil.virtual_memory().available;
+  n_axes = len(axes);
+  size_max = _unpack(size_max, n_axes);
+  overlap = [o or 0 for o in _unpack(overlap, n_axes)];
+  
+  sizes = [shape[a] if s is None else min(s, shape[a]) for a, s in zip(axes, size_max)];
+  size_min = [min(2 * o + 1, s) for o, s in zip(overlap, sizes)];
+  other = np.prod([shape[d] for d in range(len(shape)) if d not in axes]);
+  
+  def block_voxels(processes):
+    return (memory_limit / processes - overhead) / bytes_per_voxel / other;
+  
+  processes = max(1, processes);
+  if block_voxels(processes) < np.prod(size_min):
+    processes_max = int(memory_limit // (overhead + bytes_per_voxel * other * np.prod(size_min)));
+    if processes_max < 1:
+      warnings.warn('Memory limit of %d bytes too small for the minimal block size %r!' % (memory_limit, size_min));
+      processes_max = 1;
+    processes = min(processes, processes_max);
+  
+  #distribute the voxels starting with the shortest axis
+  voxels = max(block_voxels(processes), np.prod(size_min));
+  result = list(sizes);
+  remaining = sorted(range(n_axes), key=lambda i: sizes[i]);
+  while remaining:
+    edge = voxels ** (1.0 / len(remaining));
+    i = remaining.pop(0);
+    result[i] = int(max(size_min[i], min(sizes[i], np.floor(edge))));
+    voxels /= result[i];
+  
+  if verbose:
+    print('Memory limit %.2f GB: block sizes %r with %d processes.' % (memory_limit / 1e9, result, processes));
+  
+  return result, processes;
+
+
+###############################################################################
+### Helpers
+###############################################################################
+
+def block_costs(source_blocks, sink_blocks, cost = 'foreground', split_outliers = None, axes = None, sample = 4, verbose = False):
+  """Estimate the processing cost of blocks and split outliers.
+  
+  Arguments
+  ---------
+  source_blocks : list of lists of Blocks
+    The source blocks for each block to process.
+  sink_blocks : list of lists of Blocks
+    The sink blocks for each block to process.
+  cost : 'foreground', function, dict or list
+    The cost specification, see :func:`process`.
+  split_outliers : float or None
+    If not None, split blocks with cost larger than this factor times the 
+    mean cost.
+  axes : list of ints or None
+    The axes along which the blocks were split and can be split further.
+    If None, all axes are used.
+  sample : int
+    Subsampling step used to count the foreground.
+  verbose : bool
+    Print information on the costs.
+  
+  Returns
+  -------
+  source_blocks, sink_blocks : list of lists of Blocks
+    The blocks to process with outliers replaced by their sub-blocks.
+  costs : list of floats
+    The estimated cost of each block.
+  """
+  if isinstance(cost, str):
+    if cost != 'foreground':
+      raise ValueError("Cost %r not 'foreground', a function or a list!" % cost);
+    cost = ft.partial(foreground_cost, sample=sample);
+  if callable(cost):
+    costs = [float(cost(blocks[0])) for blocks in source_blocks];
+  elif isinstance(cost, dict):
+    costs = range_costs([block_range(blocks[0]) for blocks in source_blocks], cost);
+  else:
+    costs = [float(c) for c in cost];
+  if len(costs) != len(source_blocks):
+    raise ValueError('Number of costs %d does not match number of blocks %d!' % (len(costs), len(source_blocks)));
+  
+  if split_outliers is not None and len(costs) > 0:
+    mean = np.mean(costs);
+    split_sources, split_sinks, split_costs = [], [], [];
+    for sources, sinks, c in zip(source_blocks, sink_blocks, costs):
+      n = int(np.ceil(c / (split_outliers * mean))) if mean > 0 else 1;
+      axis, n = _split_axis(sources[0], n, axes=axes);
+      if n > 1:
+        sources = [split_block(b, axis=axis, n=n) for b in sources];
+        sinks = [split_block(b, axis=axis, n=n) for b in sinks];
+        split_sources.extend([[b[i] for b in sources] for i in range(n)]);
+        split_sinks.extend([[b[i] for b in sinks] for i in range(n)]);
+        split_costs.extend([c / n] * n);
+        if verbose:
+          print('Splitting block %s with cost %r into %d blocks along axis %d.' % (sources[0][0].info(), c, n, axis));
+      else:
+        split_sources.append(sources);
+        split_sinks.append(sinks);
+        split_costs.append(c);
+    source_blocks, sink_blocks, costs = split_sources, split_sinks, split_costs;
+  
+  if verbose and len(costs) > 0:
+    print('Block costs: min=%r, mean=%r, max=%r' % (np.min(costs), np.mean(costs), np.max(costs)));
+  
+  return source_blocks, sink_blocks, costs;
+
+
+def block_range(block):
+  """The valid region of a block in the coordinates of its source.
+  
+  Arguments
+  ---------
+  block : Block
+    The block.
+  
+  Returns
+  -------
+  range : tuple
+    The lower and upper bound of the valid region along each axis.
+  """
+  ndim = block.source.ndim;
+  slicing = slc.unpack_slicing(block.slicing, ndim);
+  valid = slc.unpack_slicing(block.valid.slicing, ndim);
+  ranges = ();
+  for s, v, n in zip(slicing, valid, block.source.shape):
+    lo, hi, _ = s.indices(n);
+    v_lo, v_hi, _ = v.indices(hi - lo);
+    ranges += ((lo + v_lo, lo + v_hi),);
+  return ranges;
+
+
+def range_costs(ranges, timings):
+  """Costs of block ranges from the timings of a previous run.
+  
+  Arguments
+  ---------
+  ranges : list of tuples
+    The ranges of the blocks, see :func:`block_range`.
+  timings : dict
+    The timings of a previous run keyed by block range.
+  
+  Returns
+  -------
+  costs : list of floats
+    The timing of each range, the summed timings of the ranges it contains
+    if it was not timed, or the mean timing if no timed range is contained.
+  """
+  costs = [];
+  for r in ranges:
+    c = timings.get(r);
+    if c is None:
+      contained = [t for k, t in timings.items() 
+                   if len(k) == len(r) and all(lo >= r_lo and hi <= r_hi for (lo, hi), (r_lo, r_hi) in zip(k, r))];
+      c = sum(contained) if len(contained) > 0 else None;
+    costs.append(c);
+  known = [c for c in costs if c is not None];
+  mean = float(np.mean(known)) if len(known) > 0 else 1.0;
+  return [mean if c is None else float(c) for c in costs];
+
+
+def foreground_cost(block, sample = 4):
+  """Number of non-zero voxels in a subsample of the valid region of a block."""
+  slicing = (slice(None, None, sample),) * block.ndim;
+  return np.count_nonzero(block.valid[slicing]);
+
+
+def split_block(block, axis, n):
+  """Split a block into sub-blocks with the same halo along an axis.
+  
+  Arguments
+  ---------
+  block : Block
+    The block to split.
+  axis : int
+    The axis along which to split the valid region.
+  n : int
+    The number of sub-blocks.
+  
+  Returns
+  -------
+  blocks : list of Blocks
+    The sub-blocks, their valid regions partition the valid region of the block.
+  """
+  ndim = block.source.ndim;
+  slicing = list(slc.unpack_slicing(block.slicing, ndim));
+  valid = slc.unpack_slicing(block.valid.slicing, ndim);
+  
+  lo, hi, _ = slicing[axis].indices(block.source.shape[axis]);
+  v_lo, v_hi, _ = valid[axis].indices(hi - lo);
+  halo = max(v_lo, hi - lo - v_hi);
+  
+  valid = list(valid);
+  borders = np.array(np.round(np.linspace(lo + v_lo, lo + v_hi, n + 1)), dtype=int);
+  blocks = [];
+  for b_lo, b_hi in zip(borders[:-1], borders[1:]):
+    s_lo, s_hi = max(lo, b_lo - halo), min(hi, b_hi + halo);
+    slicing[axis] = slice(s_lo, s_hi);
+    valid[axis] = slice(b_lo - s_lo, (b_hi - s_hi) or None);
+    blocks.append(blk.Block(source=block.source, slicing=tuple(slicing), valid_slicing=tuple(valid), 
+                            index=block.index, blocks_shape=block.blocks_shape));
+  return blocks;
+
+
+def _split_axis(block, n, axes = None):
+  """Axis with the largest valid extent and the feasible number of sub-blocks."""
+  shape = block.valid.shape;
+  if axes is None:
+    axes = range(len(shape));
+  axis = max(axes, key=lambda a: shape[a]);
+  return axis, max(1, min(n, shape[axis]));
+
+
+def _timed(*args, function = None):
+  """Call a function and return the elapsed time with the result."""
+  start = time.perf_counter();
+  result = function(*args);
+  return time.perf_counter() - start, result;
+
+
+def _submit_bounded(executor, func, source_blocks, sink_blocks, order = None, in_flight = None, retries = 0, done = None):
+  """Submit blocks in order keeping at most in_flight blocks pending.
+  
+  Failed blocks are resubmitted up to retries times and done is called 
+  with the index of each finished block.
+  """
+  n_blocks = len(source_blocks);
+  if order is None:
+    order = range(n_blocks);
+  if in_flight is None:
+    in_flight = n_blocks;
+  order = iter(order);
+  result = [None] * n_blocks;
+  failures = {};
+  pending = {};
+  
+  def submit(i):
+    pending[executor.submit(func, source_blocks[i], sink_blocks[i])] = i;
+  
+  for i in order:
+    submit(i);
+    if len(pending) >= in_flight:
+      break;
+  while pending:
+    finished, _ = cf.wait(pending, return_when=cf.FIRST_COMPLETED);
+    for future in finished:
+      i = pending.pop(future);
+      try:
+        result[i] = future.result();
+      except cf.BrokenExecutor:
+        raise;
+      except Exception as error:
+        failures[i] = failures.get(i, 0) + 1;
+        if failures[i] > retries:
+          raise;
+        warnings.warn('Block %d failed with %r, retry %d/%d!' % (i, error, failures[i], retries));
+        submit(i);
+        continue;
+      if done is not None:
+        done(i);
+      i = next(order, None);
+      if i is not None:
+        submit(i);
+  return result;
+
+
+def _retry(func, *args, retries = 0, index = None):
+  """Call a function and retry it if it fails."""
+  for attempt in range(retries + 1):
+    try:
+      return func(*args);
+    except Exception as error:
+      if attempt == retries:
+        raise;
+      warnings.warn('Block %r failed with %r, retry %d/%d!' % (index, error, attempt + 1, retries));
+
+
+@contextlib.contextmanager
+def _finishing(manifest, hashes = None):
+  """Save the manifest if processing fails and remove it when it succeeds."""
+  try:
+    yield;
+  except BaseException:
+    if manifest:
+      manifest.save();
+    if hashes:
+      hashes.save();
+    raise;
+  if manifest:
+    manifest.remove();
+  if hashes:
+    hashes.save();
+
+
+def block_hashes(source_blocks, processes = None, backend = 'processes'):
+  """Hashes of the data of all source blocks including their halo.
+  
+  Arguments
+  ---------
+  source_blocks : list of lists of Blocks
+    The source blocks for each block to process.
+  processes : int, WorkerPool, 'serial' or None
+    The number of parallel processes to read the blocks.
+  backend : 'processes' or 'threads'
+    The executor type.
+  
+  Returns
+  -------
+  hashes : list of str
+    The hash of each block, see :func:`~ParallelProcessing.BlockManifest.block_hash`.
+  """
+  if processes == 'serial':
+    return [bm.block_hash(sources) for sources in source_blocks];
+  with block_executor(processes, backend=backend) as executor:
+    return list(executor.map(bm.block_hash, source_blocks));
+
+
+def _run_pipelines(executor, func, source_blocks, sink_blocks, order = None, n_pipelines = 1, retries = 0, done = None, shared = True):
+  """Run pipelines that pull the blocks to process from a common queue.
+  
+  Each pipeline reads the next pending block in order as soon as it has room,
+  so faster pipelines process more blocks. The pipelines report each written
+  block in a second queue and blocks left unfinished by failed pipelines 
+  are queued again up to retries times.
+  """
+  n_blocks = len(source_blocks);
+  pending = list(range(n_blocks)) if order is None else list(order);
+  result = [None] * n_blocks;
+  manager = mp.Manager() if executor is not None and shared else None;
+  try:
+    for attempt in range(retries + 1):
+      blocks = manager.Queue() if manager is not None else queue.Queue();
+      finished = manager.Queue() if manager is not None else queue.Queue();
+      for i in pending:
+        blocks.put(i);
+      n = max(1, min(n_pipelines, len(pending)));
+      
+      errors = [];
+      if executor is None:
+        for p in range(n):
+          try:
+            func(source_blocks, sink_blocks, blocks=blocks, finished=finished);
+          except Exception as error:
+            errors.append(error);
+      else:
+        futures = [executor.submit(func, source_blocks, sink_blocks, blocks=blocks, finished=finished) for p in range(n)];
+        for future in cf.as_completed(futures):
+          try:
+            future.result();
+          except cf.BrokenExecutor:
+            raise;
+          except Exception as error:
+            errors.append(error);
+      
+      for i, t in _block_indices(finished, None):
+        result[i] = (t, None);
+        if done is not None:
+          done(i);
+      pending = [i for i in pending if result[i] is None];
+      if len(errors) == 0:
+        break;
+      if attempt == retries:
+        raise errors[0];
+      warnings.warn('%d pipelines failed with %r, retrying %d blocks %d/%d!' % (len(errors), errors[0], len(pending), attempt + 1, retries));
+  finally:
+    if manager is not None:
+      manager.shutdown();
+  return result;
+
+
+def _block_indices(blocks, n_blocks):
+  """Indices of the blocks to process from a queue or all blocks."""
+  if blocks is None:
+    yield from range(n_blocks);
+    return;
+  while True:
+    try:
+      yield blocks.get_nowait();
+    except queue.Empty:
+      return;
+
+
+def prefetch_depth(source_blocks, sink_blocks, prefetch = 2, processes = 1, memory_limit = None, verbose = False):
+  """Number of blocks to read ahead in each pipeline within a memory budget.
+  
+  Arguments
+  ---------
+  source_blocks : list of lists of Blocks
+    The source blocks for each block to process.
+  sink_blocks : list of lists of Blocks
+    The sink blocks for each block to process.
+  prefetch : int
+    The requested number of blocks to read ahead.
+  processes : int
+    The number of pipelines running in parallel.
+  memory_limit : int or None
+    The memory budget in bytes. If None, the available memory is used.
+  verbose : bool
+    Print information on the depth.
+  
+  Returns
+  -------
+  depth : int
+    The number of blocks read ahead and waiting to be written in each 
+    pipeline, at least 1.
+  
+  Note
+  ----
+  Each pipeline holds the block it computes plus up to depth blocks in the
+  read and depth results in the write queue.
+  """
+  if memory_limit is None:
+    memory_limit = psutil.virtual_memory().available;
+  block_bytes = 0;
+  for sources, sinks in zip(source_blocks, sink_blocks):
+    nbytes = sum(np.prod(b.shape) * b.dtype.itemsize for b in sources + sinks);
+    block_bytes = max(block_bytes, nbytes);
+  
+  depth = max(1, int(prefetch));
+  if block_bytes > 0:
+    fit = int(memory_limit // (processes * block_bytes)) - 1;
+    depth = max(1, min(depth, fit // 2));
+  
+  if verbose:
+    print('Prefetching %d blocks of %.2f MB in %d pipelines.' % (depth, block_bytes / 1e6, processes));
+  
+  return depth;
+
+
+def _as_block_source(source, backend):
+  """Source to split into blocks, virtual for processes and real for threads."""
+  source = io.as_source(source);
+  if backend == 'processes':
+    source = source.as_virtual();
+  return source;
+
+
+@contextlib.contextmanager
+def block_executor(processes, backend = 'processes'):
+  """Executor to process blocks.
+  
+  Arguments
+  ---------
+  processes : int or WorkerPool
+    The number of processes or threads, or a persistent pool.
+  backend : 'processes' or 'threads'
+    The executor type.
+  
+  Returns
+  -------
+  executor : Executor
+    The executor.
+  
+  Note
+  ----
+  For threads the default number of processes of the cython kernels in
+  :mod:`~ParallelProcessing.DataProcessing.ArrayProcessing` is reduced 
+  so that the threads and the kernels do not oversubscribe the cores.
+  """
+  if backend == 'threads':
+    import ParallelProcessing.DataProcessing.ArrayProcessing as ap
+    threads = wp.n_processes(processes);
+    with cf.ThreadPoolExecutor(max_workers=threads) as executor, ap.processes_per_thread(threads):
+      yield executor;
+  else:
+    with wp.executor(processes) as executor:
+      yield executor;
 
-  if not isinstance(processes, int) and processes != "serial":
-    processes = mp.cpu_count();
 
+@ptb.parallel_traceback
+def reduce_block(sources, function, function_type = 'array', as_memory = False, verbose = False, **kwargs):
+  """Compute the result of a function on a block with full traceback.
+  
+  Arguments
+  ---------
+  sources :  source specifications
+    Block sources passed to the function.
+  function  func : function
+    The function to call.
+  function_type : 'array', 'source' or 'block'
+    The type of the arguments passed to the function.
+  
+  Returns
+  -------
+  result : object
+    The result of the function.
+  """
   if verbose:
     timer = tmr.Timer();
-    print("Processing %d blocks with function %r." % (n_blocks, function.__name__))
+    print('Reducing block %s' % (sources[0].info(),));
+  
+  sources_input = sources;
+  if function_type == 'block':
+    if as_memory:
+      sources = [s.as_memory_block() for s in sources];
+  else:
+    if as_memory:
+      sources = [s.as_memory() for s in sources];
+    if function_type == 'array':
+      sources = [s.array for s in sources];
+  
+  result = function(*sources, **kwargs);
+  
+  if verbose:
+    timer.print_elapsed_time('Reducing block %s' % (sources_input[0].info(),));
+  
+  return result;
 
-  print(f"[DEBUG] processes 参数: {processes} (type={type(processes)})", flush=True)
 
-  if isinstance(processes, int):
-    #from bounded_pool_executor import BoundedProcessPoolExecutor
-    #with BoundedProcessPoolExecutor(max_workers=processes) as executor:
-    #   executor.map(function, source_blocks, sink_blocks)
-    print(f"[DEBUG] processes 参数: {processes} (type={type(processes)})", flush=True)
-    with CancelableProcessPoolExecutor(max_workers=processes) as executor:
-      if workspace is not None:
-        workspace.executor = executor
-      print(f"[DEBUG] processes 参数: {processes} (type={type(processes)})", flush=True)
-      futures = [executor.submit(func, *args) for args in zip(source_blocks, sink_blocks)]
-      # res = executor.map(func, source_blocks, sink_blocks)
-      print(f"[DEBUG] 已提交 {len(futures)} 个任务", flush=True)
-      result = [f.result() for f in futures]  # To prevent keeping references to futures to avoid mem leaks
-      # result = list(res)
-      if workspace is not None:
-        workspace.executor = None
-  else:
-    print(f"[DEBUG] 已提交 {len(futures)} 个任务", flush=True)
-    result = [func(*args) for args in zip(source_blocks, sink_blocks)]  #analysis:ignore
+class _AdjacentCombiner(object):
+  """Combines results of consecutive block ranges as soon as they are available.
+  
+  With an executor each pair of adjacent results is combined in a worker and 
+  the future of the combined range is added to pending, so the results are 
+  reduced as a parallel tree. Otherwise pairs are combined in this process.
+  """
+  def __init__(self, combine, executor = None, pending = None):
+    self.combine = combine;
+    self.executor = executor;
+    self.pending = pending if pending is not None else {};
+    self.starts = {};
+    self.ends = {};
+  
+  def add(self, start, end, result):
+    if start in self.ends:
+      left_start = self.ends.pop(start);
+      left = self.starts.pop(left_start)[1];
+      self._merge(left_start, end, left, result);
+    elif end in self.starts:
+      right_end, right = self.starts.pop(end);
+      del self.ends[right_end];
+      self._merge(start, right_end, result, right);
+    else:
+      self.starts[start] = (end, result);
+      self.ends[end] = start;
+  
+  def _merge(self, start, end, left, right):
+    if self.executor is None:
+      self.add(start, end, self.combine(left, right));
+    else:
+      self.pending[self.executor.submit(self.combine, left, right)] = (start, end);
+  
+  def result(self, initial = None):
+    if len(self.starts) == 0:
+      return initial;
+    if len(self.starts) > 1:
+      raise RuntimeError('Results of %d block ranges not combined!' % len(self.starts));
+    return list(self.starts.values())[0][1];
 
-  if verbose:
-    timer.print_elapsed_time("Processed %d blocks with function %r" % (n_blocks, function.__name__))
 
-  #gc.collect();
+def _as_json(value):
+  """Block layout parameter as json compatible value."""
+  if value is None or isinstance(value, str):
+    return value;
+  return np.asarray(value).tolist();
 
-  if return_result:
-    ret = result;
-  else:
-    ret = sink;
-  if return_blocks:
-    ret = (ret, [source_blocks, sink_blocks]);
-  return ret;
 
+def _picklable(function):
+  """True if a function can be sent to worker processes."""
+  try:
+    pickle.dumps(function);
+    return True;
+  except Exception:
+    return False;
 
-###############################################################################
-### Helpers
-###############################################################################
 
 @ptb.parallel_traceback
 def process_block_source(sources, sinks, function, as_memory = False, as_array = False, verbose = False, **kwargs):
@@ -305,7 +1642,7 @@ def process_block_source(sources, sinks, function, as_memory = False, as_array =
   if as_memory:
     sources = [s.as_memory() for s in sources];
   if as_array:
-    sources = [s.array for s in sources];
+    sources = [s if isinstance(s, np.ndarray) else s.array for s in sources];
   
   results = function(*sources, **kwargs);
   if not isinstance(results, (list, tuple)):
@@ -365,6 +1702,140 @@ def process_block_block(sources, sinks, function, as_memory = False, return_resu
     return None;
 
 
+@ptb.parallel_traceback
+def process_block_pipeline(source_blocks, sink_blocks, function, function_type = 'array', prefetch = 1, blocks = None, finished = None, verbose = False, **kwargs):
+  """Process a sequence of blocks reading ahead and writing back in threads.
+  
+  Arguments
+  ---------
+  source_blocks : list of lists of Blocks
+    Sources passed to the function for each block.
+  sink_blocks : list of lists of Blocks
+    Sinks where data is written to for each block.
+  function  func : function
+    The function to call.
+  function_type : 'array', 'source' or 'block'
+    The type of the arguments passed to the function.
+  prefetch : int
+    Maximal number of blocks in the read and in the write queue.
+  blocks : queue or None
+    Queue of the indices of the blocks to process, shared by several 
+    pipelines. If None, all blocks are processed in order.
+  finished : queue or None
+    Queue to put the index and the compute time of each written block to.
+  
+  Returns
+  -------
+  timings : list of tuples
+    The index and the compute time of each processed block.
+  """
+  stop = threading.Event();
+  reads = queue.Queue(maxsize=prefetch);
+  writes = queue.Queue(maxsize=prefetch);
+  
+  def put(q, item):
+    while not stop.is_set():
+      try:
+        q.put(item, timeout=0.1);
+        return True;
+      except queue.Full:
+        pass;
+    return False;
+  
+  def get(q):
+    while not stop.is_set():
+      try:
+        return q.get(timeout=0.1);
+      except queue.Empty:
+        pass;
+    return None;
+  
+  def read():
+    try:
+      for i in _block_indices(blocks, len(source_blocks)):
+        sources, sinks = source_blocks[i], sink_blocks[i];
+        if function_type == 'block':
+          item = ([s.as_memory_block() for s in sources], [s.as_memory_block() for s in sinks]);
+        else:
+          item = ([s.as_memory() for s in sources], None);
+        if not put(reads, (i, item)):
+          return;
+      put(reads, None);
+    except BaseException as error:
+      put(reads, error);
+  
+  def write():
+    try:
+      while True:
+        item = get(writes);
+        if item is None:
+          return;
+        i, t, sinks, sources, results = item;
+        for sink, source, result in zip(sinks, sources, results):
+          sink.valid[:] = result[source.valid.slicing];
+        if finished is not None:
+          finished.put((i, t));
+    except BaseException as error:
+      errors.append(error);
+      stop.set();
+  
+  errors = [];
+  reader = threading.Thread(target=read, daemon=True);
+  writer = threading.Thread(target=write, daemon=True);
+  reader.start();
+  writer.start();
+  
+  timings = [];
+  try:
+    while True:
+      item = get(reads);
+      if item is None:
+        break;
+      if isinstance(item, BaseException):
+        raise item;
+      i, (sources, sinks_memory) = item;
+      sources_input, sinks = source_blocks[i], sink_blocks[i];
+      
+      if verbose:
+        timer = tmr.Timer();
+        print('Processing block %s' % (sources_input[0].info(),));
+      
+      start = time.perf_counter();
+      if function_type == 'block':
+        function(*(sources + sinks_memory), **kwargs);
+        results = [s.array for s in sinks_memory];
+        valid = sinks_memory;
+      else:
+        if function_type == 'source':
+          sources = [io.as_source(s) for s in sources];
+        results = function(*sources, **kwargs);
+        if not isinstance(results, (list, tuple)):
+          results = [results];
+        valid = sources_input + [sources_input[0]] * (len(sinks) - len(sources_input));
+      timings.append((i, time.perf_counter() - start));
+      
+      if verbose:
+        timer.print_elapsed_time('Processing block %s' % (sources_input[0].info(),));
+      
+      if not put(writes, timings[-1] + (sinks, valid, results)):
+        break;
+  except BaseException:
+    stop.set();
+    raise;
+  finally:
+    put(writes, None);
+    writer.join();
+    stop.set();
+    reader.join();
+  
+  if errors:
+    raise errors[0];
+  
+  gc.collect();
+  
+  return timings;
+
+
 ###############################################################################
 ### Source splitting into blocks
 ###############################################################################
@@ -413,7 +1884,7 @@ def block_sizes(size, processes = None,
   time.
   """
   if processes is None:
-    processes = mp.cpu_count();
+    processes = par.processes();
   if not isinstance(processes, int):
     processes = 1;
   if processes <= 0:
@@ -564,6 +2035,105 @@ def block_sizes(size, processes = None,
   return n_blocks, block_ranges, valid_ranges;
 
 
+def optimal_block_shape(shape, processes = None, overlap = None, block_voxels_max = None, order = 'F', verbose = False):
+  """Split axes and block sizes minimizing the processed volume including overlaps.
+  
+  Arguments
+  ---------
+  shape : tuple of ints
+    The shape of the source.
+  processes : int or None
+    The number of processes. If None, use the number of cpus.
+  overlap : int, list of ints or None
+    The overlap between blocks along each axis.
+  block_voxels_max : int or None
+    Maximal number of voxels of a block including the overlap, e.g. from 
+    a memory budget.
+  order : 'C' or 'F'
+    The memory order of the source. On ties blocks that are contiguous in
+    memory, i.e. split along the slowest axes, are preferred.
+  verbose : bool
+    Print information on the chosen blocks.
+  
+  Returns
+  -------
+  axes : list of ints
+    The axes to split.
+  size_max : list of ints
+    The block sizes along these axes.
+  
+  Note
+  ----
+  All splittings into slabs, pencils or cubes are scored by the time to 
+  process them, i.e. the number of rounds of blocks over the processes 
+  times the block volume, and then by the total processed volume. 
+  The redundancy is the processed volume divided by the source volume.
+  """
+  if processes is None:
+    processes = par.processes();
+  if not isinstance(processes, int) or processes < 1:
+    processes = 1;
+  ndim = len(shape);
+  overlap = [o or 0 for o in _unpack(overlap, ndim)];
+  volume = float(np.prod(shape));
+  
+  n_max = [max(1, (s - o) // (o + 1)) for s, o in zip(shape, overlap)];
+  blocks_min = 1 if block_voxels_max is None else int(np.ceil(volume / block_voxels_max));
+  total_max = max(8 * processes, 4 * blocks_min);
+  
+  if order == 'F':
+    preference = list(range(ndim))[::-1];
+  else:
+    preference = list(range(ndim));
+  
+  best = None;
+  for counts in _block_counts(n_max, total_max):
+    sizes = [int(np.ceil(float(s + (n - 1) * o) / n)) for s, o, n in zip(shape, overlap, counts)];
+    block_volume = float(np.prod(sizes));
+    if block_voxels_max is not None and block_volume > block_voxels_max:
+      continue;
+    n_blocks = int(np.prod(counts));
+    score = (np.ceil(n_blocks / processes) * block_volume, n_blocks * block_volume, 
+             [counts[d] for d in preference[::-1]]);
+    if best is None or score < best[0]:
+      best = (score, counts, sizes);
+  
+  if best is None:
+    warnings.warn('No block shape within %r voxels, using the smallest blocks!' % block_voxels_max);
+    counts = n_max;
+    sizes = [int(np.ceil(float(s + (n - 1) * o) / n)) for s, o, n in zip(shape, overlap, counts)];
+  else:
+    _, counts, sizes = best;
+  
+  axes = [d for d in range(ndim) if counts[d] > 1];
+  if len(axes) == 0:
+    axes = [preference[0]];
+  size_max = [sizes[d] for d in axes];
+  
+  if verbose:
+    n_blocks = int(np.prod(counts));
+    print('Optimal blocks: %r blocks of shape %r, redundancy %.3f.' % (tuple(counts), tuple(sizes), n_blocks * np.prod(sizes) / volume));
+  
+  return axes, size_max;
+
+
+def _block_counts(n_max, total_max):
+  """All numbers of blocks along the axes with a bounded product."""
+  if len(n_max) == 0:
+    yield [];
+    return;
+  for n in range(1, min(n_max[0], total_max) + 1):
+    for rest in _block_counts(n_max[1:], total_max // n):
+      yield [n] + rest;
+
+
+def redundancy(blocks):
+  """Ratio between the processed volume of the blocks and the source volume."""
+  if len(blocks) == 0:
+    return 1.0;
+  return float(np.sum([np.prod(b.shape) for b in blocks])) / np.prod(blocks[0].source.shape);
+
+
 def block_axes(source, axes=None):
   """
   Determine the axes for block processing from source order.
@@ -621,8 +2191,9 @@ def split_into_blocks(source, processes = None, axes = None,
     Source to divide into blocks.
   processes : int
     Number of parallel processes to use.
-  axes : int or list of ints or None
+  axes : int or list of ints, 'optimal' or None
     Axes along which to split the source. If None, all axes are split.
+    If 'optimal', the axes and sizes are chosen by :func:`optimal_block_shape`.
   size_max : int or list of ints
     Maximal size of a block along the axes.
   size_min : int or list of ints
@@ -643,9 +2214,59 @@ def split_into_blocks(source, processes = None, axes = None,
   blocks : list of Blocks
     List of Block classes dividing the source.
   """
+  ndim = len(source.shape);
+  blocks_shape, blocks_block_ranges, blocks_valid_ranges = \
+    _block_ranges(source, processes=processes, axes=axes, 
+                  size_max=size_max, size_min=size_min, overlap=overlap,
+                  optimization=optimization, optimization_fix=optimization_fix, verbose=verbose);
+  blocks_offsets = [[(v[0]-b[0], b[1]-v[1]) if b != (None, None) else (None, None) for b,v in zip(block_ranges, valid_ranges)]
+                    for block_ranges, valid_ranges in zip(blocks_block_ranges, blocks_valid_ranges)];
+  
+  #create blocks
+  blocks_size = np.prod(blocks_shape);  
+  blocks = [];
+  index_to_block = {};
+  for i in range(blocks_size):
+    index = np.unravel_index(i, blocks_shape);
+    slicing = tuple(slice(b[0], b[1]) for b in [blocks_block_ranges[d][index[d]] for d in range(ndim)]);
+    offsets = [(o[0], o[1]) for o in [blocks_offsets[d][index[d]] for d in range(ndim)]];   
+    block = blk.Block(source=source, slicing=slicing, offsets=offsets, index=index, blocks_shape=blocks_shape);
+    blocks.append(block);
+    
+    if neighbours:
+      index_to_block[index] = block;
+  
+  
+  if neighbours:
+    for b in blocks:
+      index = np.array(b.index);
+      nbs = {};
+      for d,i in enumerate(index):
+        if i > 0:
+          ii = index.copy(); ii[d] -= 1; ii = tuple(ii);
+          nbs[ii] = index_to_block[ii];
+        if i < blocks_shape[d] - 1:
+          ii = index.copy(); ii[d] += 1; ii = tuple(ii);
+          nbs[ii] = index_to_block[ii];
+      b._neighbours = nbs;
+  
+  if verbose:
+    print("Redundancy   : %.3f" % redundancy(blocks));
+  
+  return blocks;
+
+
+def _block_ranges(source, processes = None, axes = None, 
+                  size_max = None, size_min = None, overlap = None,  
+                  optimization = True, optimization_fix = 'all', verbose = False):
+  """Block and valid ranges along each axis, (None, None) for axes not split."""
   shape = source.shape;
   ndim = len(shape);  
   
+  if axes == 'optimal':
+    axes, size_max = optimal_block_shape(shape, processes=processes, overlap=overlap, order=source.order, verbose=verbose);
+    size_min = None;
+    optimization = False;
   axes = block_axes(source, axes=axes);
   n_axes = len(axes);
   
@@ -659,7 +2280,7 @@ def split_into_blocks(source, processes = None, axes = None,
   #calculate block shapes
   blocks_shape = tuple();
   blocks_block_ranges = [];
-  blocks_offsets = [];
+  blocks_valid_ranges = [];
   a = 0;
   for d in range(ndim):
     if d in axes:
@@ -674,42 +2295,178 @@ def split_into_blocks(source, processes = None, axes = None,
       block_ranges = [(None, None)];
       valid_ranges = [(None, None)];
     #print(d, block_ranges, valid_ranges) 
-    
-    offsets = [(v[0]-b[0], b[1]-v[1]) if b != (None, None) else (None, None) for b,v in zip(block_ranges, valid_ranges)];     
      
     blocks_shape += (n_blocks,);
     blocks_block_ranges.append(block_ranges);
-    blocks_offsets.append(offsets);
+    blocks_valid_ranges.append(valid_ranges);
   
-  #create blocks
-  blocks_size = np.prod(blocks_shape);  
-  blocks = [];
-  index_to_block = {};
-  for i in range(blocks_size):
-    index = np.unravel_index(i, blocks_shape);
-    slicing = tuple(slice(b[0], b[1]) for b in [blocks_block_ranges[d][index[d]] for d in range(ndim)]);
-    offsets = [(o[0], o[1]) for o in [blocks_offsets[d][index[d]] for d in range(ndim)]];   
-    block = blk.Block(source=source, slicing=slicing, offsets=offsets, index=index, blocks_shape=blocks_shape);
-    blocks.append(block);
-    
-    if neighbours:
-      index_to_block[index] = block;
+  return blocks_shape, blocks_block_ranges, blocks_valid_ranges;
+
+
+###############################################################################
+### Block tables
+###############################################################################
+
+def block_table(source, processes = None, axes = None, 
+                size_max = None, size_min = None, overlap = None,  
+                optimization = True, optimization_fix = 'all', verbose = False):
+  """Layout of the blocks of a source as a compact table.
   
+  Arguments
+  ---------
+  source : Source 
+    Source to divide into blocks.
+  processes, axes, size_max, size_min, overlap, optimization, optimization_fix, verbose
+    See :func:`split_into_blocks`.
+      
+  Returns
+  -------
+  table : structured array
+    One row per block with fields 'index' for the position in the grid of
+    blocks, 'range' for the lower and upper bounds of the block and 'valid'
+    for the bounds of its valid region along each axis.
   
-  if neighbours:
-    for b in blocks:
-      index = np.array(b.index);
-      nbs = {};
-      for d,i in enumerate(index):
-        if i > 0:
-          ii = index.copy(); ii[d] -= 1; ii = tuple(ii);
-          nbs[ii] = index_to_block[ii];
-        if i < blocks_shape[d] - 1:
-          ii = index.copy(); ii[d] += 1; ii = tuple(ii);
-          nbs[ii] = index_to_block[ii];
-      b._neighbours = nbs;
+  Note
+  ----
+  The rows are in the same order as the blocks of :func:`split_into_blocks`
+  but no Block or Source objects are created, so that tens of thousands of 
+  blocks are cheap to create and to send to workers.
+  """
+  shape = source.shape;
+  ndim = len(shape);
+  blocks_shape, blocks_block_ranges, blocks_valid_ranges = \
+    _block_ranges(source, processes=processes, axes=axes, 
+                  size_max=size_max, size_min=size_min, overlap=overlap,
+                  optimization=optimization, optimization_fix=optimization_fix, verbose=verbose);
   
-  return blocks;
+  dtype = np.dtype([('index', np.int64, (ndim,)), ('range', np.int64, (ndim, 2)), ('valid', np.int64, (ndim, 2))]);
+  table = np.zeros(int(np.prod(blocks_shape)), dtype=dtype);
+  index = np.unravel_index(np.arange(len(table)), blocks_shape);
+  for d in range(ndim):
+    ranges = np.array([(0, shape[d]) if r == (None, None) else r for r in blocks_block_ranges[d]], dtype=np.int64);
+    valid  = np.array([(0, shape[d]) if r == (None, None) else r for r in blocks_valid_ranges[d]], dtype=np.int64);
+    table['index'][:, d] = index[d];
+    table['range'][:, d] = ranges[index[d]];
+    table['valid'][:, d] = valid[index[d]];
+  
+  return table;
+
+
+def block_edges(source, processes = None, axes = None, 
+                size_max = None, size_min = None, overlap = None,  
+                optimization = True, optimization_fix = 'all', verbose = False):
+  """Boundaries of the valid regions of the blocks along each axis.
+  
+  Arguments
+  ---------
+  source : Source 
+    Source to divide into blocks.
+  processes, axes, size_max, size_min, overlap, optimization, optimization_fix, verbose
+    See :func:`split_into_blocks`.
+      
+  Returns
+  -------
+  edges : list
+    The edges of the valid regions along each split axis including 0 and the
+    size of the axis, None for axes that are not split.
+  
+  Note
+  ----
+  Used to align the chunks of a :mod:`~IO.CHK` sink with the blocks, so that
+  each block writes whole chunks.
+  """
+  blocks_shape, blocks_block_ranges, blocks_valid_ranges = \
+    _block_ranges(source, processes=processes, axes=axes, 
+                  size_max=size_max, size_min=size_min, overlap=overlap,
+                  optimization=optimization, optimization_fix=optimization_fix, verbose=verbose);
+  
+  edges = [];
+  for valid in blocks_valid_ranges:
+    if valid == [(None, None)]:
+      edges.append(None);
+    else:
+      edges.append([valid[0][0]] + [hi for lo, hi in valid]);
+  return edges;
+
+
+def table_slicing(row):
+  """Slicings of a block, its valid region within the source and within the block."""
+  block = tuple(slice(lo, hi) for lo, hi in row['range']);
+  valid = tuple(slice(lo, hi) for lo, hi in row['valid']);
+  relative = tuple(slice(v[0] - r[0], v[1] - r[0]) for r, v in zip(row['range'], row['valid']));
+  return block, valid, relative;
+
+
+@ptb.parallel_traceback
+def process_block_table(table, sources, sinks, function, function_type = 'array', as_memory = False, verbose = False, **kwargs):
+  """Process the blocks of a table with full traceback.
+  
+  Arguments
+  ---------
+  table : structured array
+    The rows of the blocks to process, see :func:`block_table`.
+  sources : list of Sources
+    Virtual or real sources, opened once for all blocks of the table.
+  sinks : list of Sources
+    Virtual or real sinks where data is written to.
+  function  func : function
+    The function to call.
+  function_type : 'array', 'source' or 'block'
+    The type of the arguments passed to the function.
+  
+  Returns
+  -------
+  timings : list of float
+    The processing time of each block.
+  """
+  sources = [s.as_real() for s in sources];
+  sinks = [s.as_real() for s in sinks];
+  
+  timings = [];
+  for row in table:
+    start = time.perf_counter();
+    block, valid, relative = table_slicing(row);
+    if verbose:
+      timer = tmr.Timer();
+      info = '%r %r' % (tuple(row['index']), block);
+      print('Processing block %s' % info);
+    
+    if function_type == 'block':
+      blocks = [blk.Block(source=s, slicing=block, valid_slicing=relative, index=tuple(row['index'])) for s in sources + sinks];
+      if as_memory:
+        blocks_memory = [b.as_memory_block() for b in blocks];
+        function(*blocks_memory, **kwargs);
+        for sink, sink_memory in zip(blocks[len(sources):], blocks_memory[len(sources):]):
+          sink.valid[:] = sink_memory.valid[:];
+      else:
+        function(*blocks, **kwargs);
+    else:
+      arrays = [np.array(s[block]) if as_memory else s[block] for s in sources];
+      if function_type == 'source':
+        arrays = [io.as_source(a) for a in arrays];
+      results = function(*arrays, **kwargs);
+      if not isinstance(results, (list, tuple)):
+        results = [results];
+      for sink, result in zip(sinks, results):
+        sink[valid] = result[relative];
+    
+    if verbose:
+      timer.print_elapsed_time('Processing block %s' % info);
+    timings.append(time.perf_counter() - start);
+  
+  gc.collect();
+  
+  return timings;
+
+
+def _table_tasks(n_blocks, processes, order = None, chunks = None):
+  """Split the blocks into tasks of consecutive rows of the schedule."""
+  if order is None:
+    order = np.arange(n_blocks);
+  if chunks is None:
+    chunks = 8 * processes;
+  chunks = max(1, min(chunks, n_blocks));
+  return [np.asarray(t) for t in np.array_split(np.asarray(order), chunks)];
 
 
 def _unpack(values, ndim = None):
@@ -794,6 +2551,16 @@ def _test():
   
   io.delete_file(source.location)
   io.delete_file(sink.location)
+  
+  #reduction
+  source = io.as_source(np.asarray(np.random.rand(20,30,40) > 0.5, order='F'));
+  
+  def count_in_valid(block):
+    return int(np.sum(block.valid.array));
+  
+  count = bp.reduce(count_in_valid, source, combine=lambda a, b: a + b, function_type='block',
+                    size_max = 10, size_min = 6, overlap = 3, axes = [2], processes=None, verbose=True);
+  assert(count == np.sum(source.array))
 
   #multiple sources and sinks
   shape = (2,50,30);
@@ -821,6 +2588,22 @@ def _test():
   assert(np.all(sink1[:] == s))
   assert(np.all(sink2[:] == d))
   
+  #prefetching pipeline
+  sink1[:] = 0; sink2[:] = 0;
+  bp.process(sum_and_difference, [source1, source2], [sink1, sink2],
+             processes = 'serial', size_max = 10, size_min = 5, overlap = 3, axes = [1,2],
+             prefetch = 2, verbose = True);
+  assert(np.all(sink1[:] == s))
+  assert(np.all(sink2[:] == d))
+  
+  #table layout
+  sink1[:] = 0; sink2[:] = 0;
+  bp.process(sum_and_difference, [source1, source2], [sink1, sink2],
+             processes = 'serial', size_max = 10, size_min = 5, overlap = 3, axes = [1,2],
+             layout = 'table', verbose = True);
+  assert(np.all(sink1[:] == s))
+  assert(np.all(sink2[:] == d))
+  
   
   #trace backs
   shape = (3,4)
@@ -20,14 +20,16 @@ __webpage__   = 'http://idisco.info'
 __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 
 import os
+import contextlib
 import numpy as np
-import multiprocessing as mp
 
 import IO.IO as io
 import IO.Slice as slc
 
 import Utils.Timer as tmr
 
+import ParallelProcessing.Parallelism as par
+
 import pyximport;
 
 _old_get_distutils_extension = pyximport.pyximport.get_distutils_extension
@@ -43,14 +45,34 @@ pyximport.install(setup_args = {"include_dirs" : [np.get_include(), os.path.dirn
                   reload_support=False)
 
 import ParallelProcessing.DataProcessing.ArrayProcessingCode as code
+import ParallelProcessing.DataProcessing.RunLengthCode as rlc
 
 
 ###############################################################################
 ### Default Machine Settings
 ###############################################################################
 
-default_processes = mp.cpu_count();
-"""Default number of processes to use"""
+default_processes = None;
+"""Default number of processes to use.
+
+Note
+----
+If None, the number of threads from the central configuration in
+:mod:`~ParallelProcessing.Parallelism` is used.
+"""
+
+
+@contextlib.contextmanager
+def processes_per_thread(threads):
+  """Reduce the default number of processes while calling functions from several threads.
+  
+  Arguments
+  ---------
+  threads : int
+    The number of threads calling the array processing functions.
+  """
+  with par.parallelism(threads=par.threads_per_process(threads)) as (_, processes):
+    yield processes;
 
 
 default_blocks_per_process = 10;
@@ -198,7 +220,7 @@ def correlate1d(source, kernel, sink = None, axis = 0, processes = None, verbose
 ### Where
 ###############################################################################
 
-def where(source, sink = None, blocks = None, cutoff = None, processes = None, verbose = False):
+def where(source, sink = None, blocks = None, cutoff = None, occupancy = None, processes = None, verbose = False):
   """Returns the indices of the non-zero entries of the array.
   
   Arguments
@@ -211,6 +233,10 @@ def where(source, sink = None, blocks = None, cutoff = None, processes = None, v
     Number of blocks to split array into for parallel processing
   cutoff : int
     Number of elements below whih to switch to numpy.where
+  occupancy : Occupancy, True or None
+    If given, only the bounding box of the non-empty bricks is searched.
+    If True, the occupancy pyramid is read from the sidecar file of the 
+    source, see :mod:`~IO.Occupancy`.
   processes : None or int
     Number of processes, if None use number of cpus.
     
@@ -229,6 +255,16 @@ def where(source, sink = None, blocks = None, cutoff = None, processes = None, v
   if not ndim in [1,2,3]:
     raise Warning('Using numpy.where for dimension %d!' % (ndim,))
     return io.as_source(np.vstack(np.where(source_buffer)).T);
+  
+  offset = None;
+  if occupancy is not None and occupancy is not False:
+    occupancy = io.occupancy(source) if occupancy is True else io.occupancy(occupancy);
+    if occupancy is not None:
+      box = occupancy.bounding_box();
+      if box is None:
+        box = ((0, 0),) * ndim;
+      source_buffer = source_buffer[tuple(slice(lo, hi) for lo, hi in box)];
+      offset = np.array([lo for lo, hi in box], dtype=int);
 
   processes, timer, blocks = initialize_processing(processes=processes, function='where', verbose=verbose, blocks=blocks, return_blocks=True)
     
@@ -264,6 +300,9 @@ def where(source, sink = None, blocks = None, cutoff = None, processes = None, v
     else:
       code.where_3d(source_buffer, where=sink_buffer, sums=sums, blocks=blocks, processes=processes);
   
+  if offset is not None and np.any(offset):
+    sink[:] = np.asarray(sink[:]) + (offset[0] if ndim == 1 else offset);
+  
   finalize_processing(verbose=verbose, function='where', timer=timer);
     
   return sink;
@@ -300,11 +339,200 @@ def neighbours(indices, offset, processes = None, verbose = False):
   
   return neighbours;
 
+###############################################################################
+### Run length encoding
+###############################################################################
+
+def encode_runs(source, processes = None, verbose = False):
+  """Run length encode a binary array along its contiguous axis.
+  
+  Arguments
+  ---------
+  source : array
+    The binary array, 'C' or 'F' contiguous.
+  processes : None or int
+    Number of processes, if None use number of cpus.
+  verbose : bool
+    If True, print progress information.
+    
+  Returns
+  -------
+  offsets : array
+    The runs of line l are the entries offsets[l] to offsets[l+1] of the 
+    starts and lengths.
+  starts : array
+    The starts of the runs within their line as uint32.
+  lengths : array
+    The lengths of the runs as uint32.
+  
+  Note
+  ----
+  The lines run along the first axis for 'F' and along the last axis for 'C'
+  ordered arrays, see :func:`run_lines`.
+  """
+  processes, timer = initialize_processing(processes=processes, function='encode_runs', verbose=verbose);
+  
+  source, source_buffer = initialize_source(source, as_1d=True);
+  if source_buffer.dtype != np.uint8:
+    source_buffer = np.asarray(source_buffer != 0, dtype=np.uint8);
+  line_size, line_shape = run_lines(source.shape, source.order);
+  n_lines = int(np.prod(line_shape));
+  
+  counts = np.zeros(n_lines, dtype=np.intp);
+  rlc.count_runs(source_buffer, line_size=line_size, counts=counts, processes=processes);
+  offsets = np.zeros(n_lines + 1, dtype=np.intp);
+  np.cumsum(counts, out=offsets[1:]);
+  
+  starts  = np.zeros(offsets[-1], dtype=np.uint32);
+  lengths = np.zeros(offsets[-1], dtype=np.uint32);
+  rlc.encode_runs(source_buffer, line_size=line_size, offsets=offsets, starts=starts, lengths=lengths, processes=processes);
+  
+  finalize_processing(verbose=verbose, function='encode_runs', timer=timer);
+  
+  return offsets, starts, lengths;
+
+
+def decode_runs(offsets, starts, lengths, shape, order = 'F', sink = None, lines = None, lower = None, upper = None, processes = None, verbose = False):
+  """Decode run length encoded lines into a binary array.
+  
+  Arguments
+  ---------
+  offsets, starts, lengths : array
+    The run length encoding, see :func:`encode_runs`.
+  shape : tuple
+    The shape of the encoded array.
+  order : 'C' or 'F'
+    The order of the encoded array.
+  sink : array or None
+    The binary sink for the full array. If None, a new array is created.
+  lines : array or None
+    If given, decode only these lines into an array of shape 
+    (len(lines), upper - lower) and ignore the sink.
+  lower, upper : int or None
+    The range along the lines to decode.
+  processes : None or int
+    Number of processes, if None use number of cpus.
+  verbose : bool
+    If True, print progress information.
+    
+  Returns
+  -------
+  sink : array
+    The decoded binary array.
+  """
+  processes, timer = initialize_processing(processes=processes, function='decode_runs', verbose=verbose);
+  
+  line_size, line_shape = run_lines(shape, order);
+  lower = 0 if lower is None else lower;
+  upper = line_size if upper is None else upper;
+  
+  if lines is None:
+    lines = np.arange(int(np.prod(line_shape)), dtype=np.intp);
+    sink, sink_buffer = initialize_sink(sink=sink, shape=tuple(shape), dtype=bool, order=order, as_1d=True);
+    sink_buffer[:] = 0;
+  else:
+    lines = np.asarray(lines, dtype=np.intp);
+    sink = np.zeros((len(lines), upper - lower), dtype=bool);
+    sink_buffer = sink.view('uint8').reshape(-1);
+  
+  if len(lines) > 0 and upper > lower:
+    rlc.decode_runs(offsets, starts, lengths, lines, lower=lower, upper=upper, sink=sink_buffer, processes=processes);
+  
+  finalize_processing(verbose=verbose, function='decode_runs', timer=timer);
+  
+  return sink;
+
+
+def erode_runs(offsets, starts, lengths, shape, order = 'F', border = False, processes = None, verbose = False):
+  """Erosion with the 6-neighbourhood on run length encoded lines.
+  
+  Arguments
+  ---------
+  offsets, starts, lengths : array
+    The run length encoding, see :func:`encode_runs`.
+  shape : tuple
+    The shape of the encoded array.
+  order : 'C' or 'F'
+    The order of the encoded array.
+  border : bool
+    If True, return the border voxels, i.e. the foreground voxels with a 
+    6-neighbour in the background, instead of the eroded foreground.
+  processes : None or int
+    Number of processes, if None use number of cpus.
+  verbose : bool
+    If True, print progress information.
+    
+  Returns
+  -------
+  offsets, starts, lengths : array
+    The run length encoding of the result.
+  
+  Note
+  ----
+  Voxels outside the array are considered background.
+  """
+  processes, timer = initialize_processing(processes=processes, function='erode_runs', verbose=verbose);
+  
+  line_size, line_shape = run_lines(shape, order);
+  n_lines = int(np.prod(line_shape));
+  line_strides = np.array(_element_strides(line_shape, order), dtype=np.intp);
+  line_shape = np.array(line_shape, dtype=np.intp);
+  
+  counts = np.zeros(n_lines, dtype=np.intp);
+  empty = np.zeros(0, dtype=np.uint32);
+  rlc.erode_runs(offsets, starts, lengths, line_shape, line_strides, counts, counts, empty, empty, 
+                 border=border, fill=False, processes=processes);
+  result_offsets = np.zeros(n_lines + 1, dtype=np.intp);
+  np.cumsum(counts, out=result_offsets[1:]);
+  
+  result_starts  = np.zeros(result_offsets[-1], dtype=np.uint32);
+  result_lengths = np.zeros(result_offsets[-1], dtype=np.uint32);
+  rlc.erode_runs(offsets, starts, lengths, line_shape, line_strides, counts, result_offsets, result_starts, result_lengths, 
+                 border=border, fill=True, processes=processes);
+  
+  finalize_processing(verbose=verbose, function='erode_runs', timer=timer);
+  
+  return result_offsets, result_starts, result_lengths;
+
+
+def run_lines(shape, order = 'F'):
+  """Size of the lines and shape of the grid of lines of a run length encoding.
+  
+  Arguments
+  ---------
+  shape : tuple
+    The shape of the array.
+  order : 'C' or 'F'
+    The order of the array, lines run along the contiguous axis.
+  
+  Returns
+  -------
+  line_size : int
+    The size of each line.
+  line_shape : tuple
+    The shape of the remaining axes.
+  """
+  if order == 'F':
+    return shape[0], tuple(shape[1:]);
+  elif order == 'C':
+    return shape[-1], tuple(shape[:-1]);
+  else:
+    raise ValueError('Cannot run length encode non-contiguous array with order %r!' % (order,));
+
+
+def _element_strides(shape, order = 'F'):
+  """Element strides of a contiguous array with the given shape and order."""
+  strides = np.cumprod((1,) + tuple(shape[:-1]) if order == 'F' else (1,) + tuple(shape[::-1][:-1]));
+  if order == 'C':
+    strides = strides[::-1];
+  return tuple(int(s) for s in strides);
+
+
 ###############################################################################
 ### IO
 ###############################################################################
 
-def read(source, sink = None, slicing = None, memory = None, blocks = None, processes = None, verbose = False, **kwargs):
+def read(source, sink = None, slicing = None, memory = None, segment = None, blocks = None, processes = None, verbose = False, **kwargs):
   """Read a large array into memory in parallel.
   
   Arguments
@@ -315,6 +543,9 @@ def read(source, sink = None, slicing = None, memory = None, blocks = None, proc
     Optional sublice to read.
   memory : 'shared; or None
     If 'shared', read into shared memory.
+  segment : str, True or None
+    If not None, read into a named shared memory segment with this name or 
+    a generated name if True, so other processes can attach to the data.
   blocks : int or None
     number of blocks to split array into for parallel processing
   processes : None or int
@@ -342,7 +573,9 @@ def read(source, sink = None, slicing = None, memory = None, blocks = None, proc
     raise NotImplementedError('Cannot read in parallel from non-contigous source!');
     #TODO: implement parallel reader with strides !
   
-  sink, sink_buffer = initialize_sink(sink=sink, shape=shape, dtype=dtype, order=order, memory=memory, as_1d=True);
+  if segment is not None:
+    memory = 'shared';
+  sink, sink_buffer = initialize_sink(sink=sink, shape=shape, dtype=dtype, order=order, memory=memory, segment=segment, as_1d=True);
   
   code.read(sink_buffer, location.encode(), offset=offset, blocks=blocks, processes=processes);
   
@@ -527,7 +760,7 @@ def initialize_processing(processes = None, verbose = False, function = None, bl
     A timer for the processing.
   """
   if processes is None:
-    processes = default_processes;
+    processes = default_processes if default_processes is not None else par.threads();
   if processes == 'serial':
     processes = 1;
   
@@ -630,7 +863,7 @@ def initialize_source(source, return_buffer = True, as_1d = False,
 
 
 def initialize_sink(sink = None, shape = None, dtype = None, order = None, memory = None, location = None, mode = None, source = None, 
-                    return_buffer = True, as_1d = False, return_shape = False, return_strides = False):
+                    return_buffer = True, as_1d = False, return_shape = False, return_strides = False, segment = None):
   """Initialze or create a sink.
   
   Arguments
@@ -647,6 +880,8 @@ def initialize_sink(sink = None, shape = None, dtype = None, order = None, memor
     If 'shared' create a shared memory sink.
   location : str
     Optional location specification of the sink.
+  segment : str, True or None
+    If not None, create a shared memory sink in a named segment.
   source : Source or None
     Optional source to infer sink specifictions from.
   return_buffer : bool
@@ -668,7 +903,8 @@ def initialize_sink(sink = None, shape = None, dtype = None, order = None, memor
     Element strides of the source. 
   """
        
-  sink = io.initialize(sink, shape=shape, dtype=dtype, order=order, memory=memory, location=location, mode=mode, like=source, as_source=True);
+  kwargs = dict(segment=segment) if segment is not None else {};
+  sink = io.initialize(sink, shape=shape, dtype=dtype, order=order, memory=memory, location=location, mode=mode, like=source, as_source=True, **kwargs);
   
   if return_buffer:
     buffer = sink.as_buffer();
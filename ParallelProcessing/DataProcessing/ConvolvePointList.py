@@ -22,10 +22,11 @@ __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 
 
 import numpy as np;
-from multiprocessing import cpu_count;
 
 import IO.IO as io
 
+import ParallelProcessing.Parallelism as par
+
 import pyximport; 
 pyximport.install(setup_args={"include_dirs": [np.get_include()]}, reload_support=True)
 
@@ -36,7 +37,7 @@ import ParallelProcessing.DataProcessing.ConvolvePointListCode as code
 ###############################################################################
 
 #TODO: use ArrayProcessing initialization tools 
-def convolve_3d(source, kernel, points = None, indices = None, x = None, y = None, z = None, sink = None, sink_dtype = None, strides = None, check_border = True, processes = cpu_count()):
+def convolve_3d(source, kernel, points = None, indices = None, x = None, y = None, z = None, sink = None, sink_dtype = None, strides = None, check_border = True, processes = None):
   """Convolves source with a specified kernel at specific points only.
     
   Arguments
@@ -92,7 +93,7 @@ def convolve_3d(source, kernel, points = None, indices = None, x = None, y = Non
   
 
 
-def convolve_3d_points(source, kernel, points, sink = None, sink_dtype = None, check_border = True, processes = cpu_count()):
+def convolve_3d_points(source, kernel, points, sink = None, sink_dtype = None, check_border = True, processes = None):
   """Convolves source with a specified kernel at specific points only
   
   Arguments
@@ -144,7 +145,7 @@ def convolve_3d_points(source, kernel, points, sink = None, sink_dtype = None, c
     k = kernel;
   
   if processes is None:
-    processes = cpu_count();
+    processes = par.threads();
   
   if check_border:
     code.convolve_3d_points(d, k, points, o, processes);
@@ -154,7 +155,7 @@ def convolve_3d_points(source, kernel, points, sink = None, sink_dtype = None, c
   return sink;
 
 
-def convolve_3d_xyz(source, kernel, x, y, z, sink = None, sink_dtype = None, check_border = True, processes = cpu_count()):
+def convolve_3d_xyz(source, kernel, x, y, z, sink = None, sink_dtype = None, check_border = True, processes = None):
   """Convolves source with a specified kernel at specific points only
     
   Arguments
@@ -206,7 +207,7 @@ def convolve_3d_xyz(source, kernel, x, y, z, sink = None, sink_dtype = None, che
     k = kernel;
     
   if processes is None:
-    processes = cpu_count();
+    processes = par.threads();
   
   if check_border:
     code.convolve_3d_xyz(d, k, x, y, z, o, processes);
@@ -216,7 +217,7 @@ def convolve_3d_xyz(source, kernel, x, y, z, sink = None, sink_dtype = None, che
   return sink;
 
 
-def convolve_3d_indices(source, kernel, indices, sink = None, sink_dtype = None, strides = None, check_border = True, processes = cpu_count()):
+def convolve_3d_indices(source, kernel, indices, sink = None, sink_dtype = None, strides = None, check_border = True, processes = None):
   """Convolves source with a specified kernel at specific points given by a flat array index.
     
   Arguments
@@ -268,7 +269,7 @@ def convolve_3d_indices(source, kernel, indices, sink = None, sink_dtype = None,
     k = kernel; 
 
   if processes is None:
-    processes = cpu_count();
+    processes = par.threads();
   
   if strides is None:
     strides = np.array(io.element_strides(source));
@@ -282,7 +283,7 @@ def convolve_3d_indices(source, kernel, indices, sink = None, sink_dtype = None,
   return sink;
 
 
-def convolve_3d_indices_if_smaller_than(source, kernel, indices, max_value, sink = None, strides = None, check_border = True, processes = cpu_count()):
+def convolve_3d_indices_if_smaller_than(source, kernel, indices, max_value, sink = None, strides = None, check_border = True, processes = None):
   """Convolves source with a specified kernel at specific points given by a flat array indx under conditon the value is smaller than a number
     
   Arguments
@@ -332,7 +333,7 @@ def convolve_3d_indices_if_smaller_than(source, kernel, indices, max_value, sink
     k = kernel;
   
   if processes is None:
-    processes = cpu_count();
+    processes = par.threads();
   
   if strides is None:
     strides = np.array(io.element_strides(source), dtype=int);
@@ -348,7 +349,7 @@ def convolve_3d_indices_if_smaller_than(source, kernel, indices, max_value, sink
 
 
 
-def convolve_3d_find_smaller_than(source, search, indices, max_value, sink = None, processes = cpu_count()):
+def convolve_3d_find_smaller_than(source, search, indices, max_value, sink = None, processes = None):
   """Convolves source with a specified kernel at specific points given by a flat array indx under conditon the value is smaller than a number
     
   Arguments:
@@ -382,7 +383,7 @@ def convolve_3d_find_smaller_than(source, search, indices, max_value, sink = Non
     o = sink;
   
   if processes is None:
-    processes = cpu_count();
+    processes = par.threads();
   
   code.convolve_3d_find_smaller_than(d, search, indices, max_value, o, processes);
   
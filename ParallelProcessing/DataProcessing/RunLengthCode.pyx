@@ -0,0 +1,242 @@
+#cython: language_level=3, boundscheck=False, wraparound=False, nonecheck=False, initializedcheck=False, cdivision=True
+"""
+RunLengthCode
+=============
+
+Cython code for the run length encoding in the ArrayProcessing module.
+
+The runs of a binary array are stored per line along its contiguous axis, 
+the runs of line l are the entries offsets[l] to offsets[l+1] of the
+start and length arrays.
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+import numpy as np
+cimport numpy as np
+
+cimport cython
+from cython.parallel import prange, parallel
+
+from libc.stdlib cimport malloc, free
+
+ctypedef Py_ssize_t index_t;
+
+ctypedef np.uint32_t run_t;
+
+
+###############################################################################
+### Encoding
+###############################################################################
+
+cpdef void count_runs(const np.uint8_t[:] source, index_t line_size, index_t[:] counts, int processes):
+  cdef index_t n_lines = counts.shape[0];
+  cdef index_t l, i, o, n
+  cdef int previous, current
+  
+  with nogil, parallel(num_threads = processes):
+    for l in prange(n_lines, schedule = 'guided'):
+      o = l * line_size;
+      n = 0;
+      previous = 0;
+      for i in range(line_size):
+        current = source[o + i] != 0;
+        if current and not previous:
+          n = n + 1;
+        previous = current;
+      counts[l] = n;
+
+
+cpdef void encode_runs(const np.uint8_t[:] source, index_t line_size, index_t[:] offsets, run_t[:] starts, run_t[:] lengths, int processes):
+  cdef index_t n_lines = offsets.shape[0] - 1;
+  cdef index_t l, i, o, k, start
+  
+  with nogil, parallel(num_threads = processes):
+    for l in prange(n_lines, schedule = 'guided'):
+      o = l * line_size;
+      k = offsets[l];
+      start = -1;
+      for i in range(line_size):
+        if source[o + i] != 0:
+          if start < 0:
+            start = i;
+        elif start >= 0:
+          starts[k] = start;
+          lengths[k] = i - start;
+          k = k + 1;
+          start = -1;
+      if start >= 0:
+        starts[k] = start;
+        lengths[k] = line_size - start;
+
+
+###############################################################################
+### Decoding
+###############################################################################
+
+cpdef void decode_runs(const index_t[:] offsets, const run_t[:] starts, const run_t[:] lengths, const index_t[:] lines, 
+                       index_t lower, index_t upper, np.uint8_t[:] sink, int processes):
+  cdef index_t n_lines = lines.shape[0];
+  cdef index_t width = upper - lower;
+  cdef index_t j, l, o, k, i, s, e
+  
+  with nogil, parallel(num_threads = processes):
+    for j in prange(n_lines, schedule = 'guided'):
+      l = lines[j];
+      o = j * width - lower;
+      for k in range(offsets[l], offsets[l+1]):
+        s = starts[k];
+        e = s + lengths[k];
+        if s < lower:
+          s = lower;
+        if e > upper:
+          e = upper;
+        for i in range(s, e):
+          sink[o + i] = 1;
+
+
+###############################################################################
+### Morphology
+###############################################################################
+
+cdef inline index_t _line_runs(const index_t[:] offsets, const run_t[:] starts, const run_t[:] lengths, index_t l, 
+                               index_t* s, index_t* e) nogil:
+  cdef index_t k, n = 0
+  for k in range(offsets[l], offsets[l+1]):
+    s[n] = starts[k];
+    e[n] = starts[k] + lengths[k];
+    n = n + 1;
+  return n;
+
+
+cdef inline index_t _intersect(index_t* as_, index_t* ae, index_t na, index_t* bs, index_t* be, index_t nb, 
+                               index_t* os, index_t* oe) nogil:
+  cdef index_t i = 0, j = 0, n = 0, s, e
+  while i < na and j < nb:
+    s = as_[i] if as_[i] > bs[j] else bs[j];
+    e = ae[i] if ae[i] < be[j] else be[j];
+    if s < e:
+      os[n] = s;
+      oe[n] = e;
+      n = n + 1;
+    if ae[i] < be[j]:
+      i = i + 1;
+    else:
+      j = j + 1;
+  return n;
+
+
+cdef inline index_t _subtract(index_t* as_, index_t* ae, index_t na, index_t* bs, index_t* be, index_t nb, 
+                              index_t* os, index_t* oe) nogil:
+  cdef index_t i, j = 0, k, n = 0, s, e
+  for i in range(na):
+    s = as_[i];
+    e = ae[i];
+    while j < nb and be[j] <= s:
+      j = j + 1;
+    k = j;
+    while k < nb and bs[k] < e:
+      if bs[k] > s:
+        os[n] = s;
+        oe[n] = bs[k];
+        n = n + 1;
+      if be[k] > s:
+        s = be[k];
+      k = k + 1;
+    if s < e:
+      os[n] = s;
+      oe[n] = e;
+      n = n + 1;
+  return n;
+
+
+cpdef void erode_runs(const index_t[:] offsets, const run_t[:] starts, const run_t[:] lengths, 
+                      const index_t[:] line_shape, const index_t[:] line_strides, 
+                      index_t[:] counts, index_t[:] out_offsets, run_t[:] out_starts, run_t[:] out_lengths,
+                      int border, int fill, int processes):
+  """Erosion with the 6-neighbourhood or its border on the runs of each line.
+  
+  Voxels outside the array are background. If fill is 0 only the number of 
+  resulting runs per line is written to counts, otherwise the runs are 
+  written to the output arrays at out_offsets.
+  """
+  cdef index_t n_lines = offsets.shape[0] - 1;
+  cdef index_t n_axes = line_shape.shape[0];
+  cdef index_t l, d, c, k, m, r, total, size, n, nb, inside
+  cdef index_t* buffer
+  cdef index_t* cs
+  cdef index_t* ce
+  cdef index_t* ns
+  cdef index_t* ne
+  cdef index_t* bs
+  cdef index_t* be
+  cdef index_t* tmp
+  
+  with nogil, parallel(num_threads = processes):
+    for l in prange(n_lines, schedule = 'guided'):
+      r = offsets[l+1] - offsets[l];
+      if r == 0:
+        if not fill:
+          counts[l] = 0;
+        continue;
+      
+      total = r;
+      inside = 1;
+      for d in range(n_axes):
+        c = (l / line_strides[d]) % line_shape[d];
+        if c == 0 or c == line_shape[d] - 1:
+          inside = 0;
+        else:
+          m = l + line_strides[d];
+          total = total + offsets[m+1] - offsets[m];
+          m = l - line_strides[d];
+          total = total + offsets[m+1] - offsets[m];
+      
+      # intersections keep at most total runs, the border subtraction 
+      # of those from the r runs of the line adds at most r more
+      size = total + r + 1;
+      buffer = <index_t*> malloc(6 * size * sizeof(index_t));
+      cs = buffer;
+      ce = buffer + size;
+      ns = buffer + 2 * size;
+      ne = buffer + 3 * size;
+      bs = buffer + 4 * size;
+      be = buffer + 5 * size;
+      
+      n = 0;
+      if inside:
+        for k in range(offsets[l], offsets[l+1]):
+          if lengths[k] > 2:
+            cs[n] = starts[k] + 1;
+            ce[n] = starts[k] + lengths[k] - 1;
+            n = n + 1;
+        for d in range(n_axes):
+          m = l + line_strides[d];
+          nb = _line_runs(offsets, starts, lengths, m, bs, be);
+          n = _intersect(cs, ce, n, bs, be, nb, ns, ne);
+          tmp = cs; cs = ns; ns = tmp;
+          tmp = ce; ce = ne; ne = tmp;
+          m = l - line_strides[d];
+          nb = _line_runs(offsets, starts, lengths, m, bs, be);
+          n = _intersect(cs, ce, n, bs, be, nb, ns, ne);
+          tmp = cs; cs = ns; ns = tmp;
+          tmp = ce; ce = ne; ne = tmp;
+      
+      if border:
+        nb = _line_runs(offsets, starts, lengths, l, bs, be);
+        n = _subtract(bs, be, nb, cs, ce, n, ns, ne);
+        tmp = cs; cs = ns; ns = tmp;
+        tmp = ce; ce = ne; ne = tmp;
+      
+      if fill:
+        m = out_offsets[l];
+        for k in range(n):
+          out_starts[m + k] = cs[k];
+          out_lengths[m + k] = ce[k] - cs[k];
+      else:
+        counts[l] = n;
+      
+      free(buffer);
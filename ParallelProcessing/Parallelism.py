@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Parallelism
+===========
+
+Central configuration of the number of cpus, processes and threads.
+
+The usable cpus are detected from the affinity mask and the cgroup cpu quota
+of the container, and can be set via the environment variable
+:const:`cpus_variable`. The cpus are split between process level parallelism,
+e.g. in :mod:`~ParallelProcessing.BlockProcessing`, and thread level
+parallelism in the cython kernels of
+:mod:`~ParallelProcessing.DataProcessing.ArrayProcessing` and
+:mod:`~ParallelProcessing.DataProcessing.ConvolvePointList`.
+
+The configuration is stored in environment variables so that it is inherited
+by worker processes.
+
+Example
+-------
+>>> import ParallelProcessing.Parallelism as par
+>>> par.cpu_count()
+64
+>>> with par.parallelism(processes=8):
+>>>   par.processes(), par.threads()
+(8, 8)
+"""
+__author__    = 'Christoph Kirst <ckirst@rockefeller.edu>'
+__license__   = 'MIT License <http://www.opensource.org/licenses/mit-license.php>'
+__copyright__ = 'Copyright (c) 2019 by Christoph Kirst, The Rockefeller University, New York City'
+
+
+import os
+import math
+import contextlib
+import multiprocessing as mp
+
+
+cpus_variable = 'BINARY_PROCESSING_CPUS';
+"""Environment variable overriding the number of usable cpus."""
+
+processes_variable = 'BINARY_PROCESSING_PROCESSES';
+"""Environment variable for the default number of processes."""
+
+threads_variable = 'BINARY_PROCESSING_THREADS';
+"""Environment variable for the default number of threads of the kernels."""
+
+
+###############################################################################
+### Cpu detection
+###############################################################################
+
+def cpu_count():
+  """Number of cpus usable by this process.
+
+  Returns
+  -------
+  cpus : int
+    The number of cpus from :const:`cpus_variable` if set, otherwise the
+    minimum of the cpus in the affinity mask and the cgroup cpu quota.
+  """
+  cpus = _variable(cpus_variable);
+  if cpus is not None:
+    return cpus;
+
+  if hasattr(os, 'sched_getaffinity'):
+    cpus = len(os.sched_getaffinity(0));
+  else:
+    cpus = mp.cpu_count();
+
+  quota = cgroup_cpus();
+  if quota is not None:
+    cpus = min(cpus, quota);
+
+  return max(1, cpus);
+
+
+def cgroup_cpus():
+  """Cpu quota of the cgroup rounded up, None if not limited."""
+  #cgroup v2
+  try:
+    with open('/sys/fs/cgroup/cpu.max') as f:
+      quota, period = f.read().split()[:2];
+    if quota != 'max':
+      return int(math.ceil(float(quota) / float(period)));
+    return None;
+  except (OSError, ValueError):
+    pass;
+
+  #cgroup v1
+  try:
+    with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+      quota = int(f.read());
+    with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+      period = int(f.read());
+    if quota > 0 and period > 0:
+      return int(math.ceil(float(quota) / period));
+  except (OSError, ValueError):
+    pass;
+
+  return None;
+
+
+###############################################################################
+### Configuration
+###############################################################################
+
+def processes():
+  """Default number of processes for process level parallelism."""
+  processes = _variable(processes_variable);
+  if processes is None:
+    processes = cpu_count();
+  return processes;
+
+
+def threads():
+  """Default number of threads of the parallel kernels."""
+  threads = _variable(threads_variable);
+  if threads is None:
+    threads = cpu_count();
+  return threads;
+
+
+def threads_per_process(processes):
+  """Number of kernel threads so that processes times threads fit the cpus."""
+  return max(1, threads() // max(1, processes));
+
+
+def configure(cpus = None, processes = None, threads = None):
+  """Set the parallelism configuration of this and all new worker processes.
+
+  Arguments
+  ---------
+  cpus : int or None
+    The number of usable cpus.
+  processes : int or None
+    The default number of processes.
+  threads : int or None
+    The default number of kernel threads. If None and processes is given,
+    the cpus are split between the processes.
+  """
+  if threads is None and processes is not None:
+    threads = max(1, (cpus or cpu_count()) // max(1, processes));
+  for variable, value in ((cpus_variable, cpus), (processes_variable, processes), (threads_variable, threads)):
+    if value is not None:
+      os.environ[variable] = str(int(value));
+
+
+@contextlib.contextmanager
+def parallelism(cpus = None, processes = None, threads = None):
+  """Context manager to set the parallelism configuration temporarily.
+
+  Arguments
+  ---------
+  cpus, processes, threads : int or None
+    See :func:`configure`.
+
+  Returns
+  -------
+  configuration : tuple
+    The resulting number of processes and threads.
+  """
+  variables = (cpus_variable, processes_variable, threads_variable);
+  saved = {v : os.environ.get(v) for v in variables};
+  configure(cpus=cpus, processes=processes, threads=threads);
+  try:
+    yield configuration();
+  finally:
+    for variable, value in saved.items():
+      if value is None:
+        os.environ.pop(variable, None);
+      else:
+        os.environ[variable] = value;
+
+
+def configuration():
+  """The current number of processes and threads."""
+  return processes(), threads();
+
+
+def _variable(name):
+  """Positive integer value of an environment variable or None."""
+  value = os.environ.get(name);
+  if value is None or value == '':
+    return None;
+  try:
+    value = int(value);
+  except ValueError:
+    raise ValueError('Environment variable %s=%r is not an integer!' % (name, value));
+  return max(1, value);
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import ParallelProcessing.Parallelism as par
+
+  print(par.cpu_count(), par.cgroup_cpus())
+  with par.parallelism(processes=4):
+    print(par.processes(), par.threads())
+    with par.parallelism(threads=1):
+      print(par.threads())
+  print(par.processes(), par.threads())
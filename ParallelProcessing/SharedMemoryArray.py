@@ -4,6 +4,9 @@ SharedMemoryArray
 =================
 
 Shared ctype memory arrays.
+
+Arrays are either ctype arrays inherited by forked processes or named POSIX 
+shared memory segments that processes, also spawned ones, attach by name.
 """
 __author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
 __license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE)'
@@ -11,11 +14,23 @@ __copyright__ = 'Copyright © 2020 by Christoph Kirst'
 __webpage__   = 'http://idisco.info'
 __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 
+import threading
+import weakref
+
 import numpy as np
 import multiprocessing as mp
+from multiprocessing import shared_memory
 
 __all__ = ['ctype', 'base', 'empty', 'zeros', 'zeros_like', 'ones']
 
+_segments = {};
+"""Named shared memory segments opened in this process by name."""
+
+_segment_arrays = {};
+"""Weak references to the arrays wrapping each segment in this process."""
+
+_segments_lock = threading.Lock();
+
 ###############################################################################
 ### Functionality
 ###############################################################################
@@ -73,14 +88,35 @@ def base(array):
     raise RuntimeError('Array has no shared base');
 
 
-def array(shape, dtype = None, order = None):
-  """Create a shared array wrapped in numpy array."""
+def array(shape, dtype = None, order = None, segment = None):
+  """Create a shared array wrapped in numpy array.
+  
+  Arguments
+  ---------
+  shape : tuple of ints
+    The shape of the shared memory array to create.
+  dtype : array or dtype
+    The data type of the array, if None float is used.
+  order : 'A', 'C', 'F', or None
+    The order of the array.
+  segment : str, True or None
+    If not None, create the array in a named shared memory segment with this
+    name or a generated name if True.
+  
+  Returns
+  -------
+  array : array
+    A shared memory array wrapped as ndarray.
+  """
   if dtype is None:
     dtype = float;
     
   if order is None:
     order = 'A';
   
+  if segment is not None:
+    return create_segment(shape=shape, dtype=dtype, order=order, name=None if segment is True else segment);
+  
   #create shared memory
   shared = mp.RawArray(ctype(dtype), int(np.prod(shape)));
   
@@ -91,7 +127,7 @@ def array(shape, dtype = None, order = None):
   return array;
 
 
-def empty(shape, dtype = None, order = None):
+def empty(shape, dtype = None, order = None, segment = None):
   """Creates a empty shared memory array with numpy wrapper
   
   Arguments
@@ -102,16 +138,18 @@ def empty(shape, dtype = None, order = None):
     The array or data type to determine the c type from, if None float is used.
   order : C', 'F', or None
     The order of the array.
+  segment : str, True or None
+    Optional name of a shared memory segment to create, see :func:`array`.
   
   Returns
   -------
   array : array
     A shared memory array wrapped as ndarray.
   """
-  return array(shape=shape, dtype=dtype, order=order);
+  return array(shape=shape, dtype=dtype, order=order, segment=segment);
 
 
-def zeros(shape, dtype = None, order = None):
+def zeros(shape, dtype = None, order = None, segment = None):
   """Creates a shared memory array of zeros with numpy wrapper
   
   Arguments
@@ -128,10 +166,10 @@ def zeros(shape, dtype = None, order = None):
   array : array
     A shared memory array wrapped as ndarray.
   """
-  return array(shape, dtype=dtype, order=order);
+  return array(shape, dtype=dtype, order=order, segment=segment);
 
 
-def zeros_like(source, shape = None,  dtype = None, order = None):
+def zeros_like(source, shape = None,  dtype = None, order = None, segment = None):
   """Creates a shared memory array with numpy wrapper using shape, dtype and order from source
   
   Arguments
@@ -163,10 +201,10 @@ def zeros_like(source, shape = None,  dtype = None, order = None):
     else:
       order = 'C';
   
-  return array(shape, dtype=dtype, order=order);
+  return array(shape, dtype=dtype, order=order, segment=segment);
 
 
-def ones(shape, dtype = None, order = None):
+def ones(shape, dtype = None, order = None, segment = None):
   """Creates a shared memory array of ones with numpy wrapper
   
   Arguments
@@ -183,7 +221,7 @@ def ones(shape, dtype = None, order = None):
   array : array
     A shared memory array wrapped as ndarray.
   """
-  a = array(shape, dtype=dtype, order=order);
+  a = array(shape, dtype=dtype, order=order, segment=segment);
   a[:] = 1;
   return a;
 
@@ -204,6 +242,8 @@ def is_shared(array):
   """
   if not isinstance(array, np.ndarray):
     return False;
+  if segment_name(array) is not None:
+    return True;
   try:
     base = array.base
     if base is None:
@@ -216,7 +256,7 @@ def is_shared(array):
       return False
 
 
-def as_shared(source, copy=False, order=None):
+def as_shared(source, copy=False, order=None, segment=None):
   """Convert array to a shared memory array
   
   Arguments
@@ -227,6 +267,8 @@ def as_shared(source, copy=False, order=None):
     If True, the data in source is copied.
   order : C', 'F', or None
     The order to use for an array if copied or not a shared array. If None, the order of the source is used.
+  segment : str, True or None
+    If not None, copy the source into a named shared memory segment, see :func:`array`.
 
   Returns
   -------
@@ -234,18 +276,184 @@ def as_shared(source, copy=False, order=None):
     A shared memory array wrapped as ndarray based on the source array.
   """
   # already a shared array ?
-  if not copy and is_shared(source):
+  if not copy and is_shared(source) and (segment is None or segment_name(source) is not None):
     return source
     
   if order is None:
     order = 'A';
   
-  a = array(shape=source.shape, dtype=source.dtype, order=order)
+  a = array(shape=source.shape, dtype=source.dtype, order=order, segment=segment)
   a[:] = source
   
   return a;
 
 
+###############################################################################
+### Named segments
+###############################################################################
+
+def _wrap(memory, shape, dtype, order):
+  """Wrap a shared memory segment as numpy array."""
+  dtype = np.dtype(dtype);
+  n = int(np.prod(shape, dtype=np.int64));
+  flat = np.ndarray((n,), dtype=dtype, buffer=memory.buf);
+  with _segments_lock:
+    _segment_arrays.setdefault(memory.name, []).append(weakref.ref(flat));
+  return flat.reshape(shape, order='F' if order == 'F' else 'C');
+
+
+def create_segment(shape, dtype = None, order = None, name = None):
+  """Create an array in a named shared memory segment.
+  
+  Arguments
+  ---------
+  shape : tuple of ints
+    The shape of the array.
+  dtype : dtype or None
+    The data type of the array, if None float is used.
+  order : 'C', 'F' or None
+    The order of the array.
+  name : str or None
+    The name of the segment, if None a unique name is generated.
+  
+  Returns
+  -------
+  array : array
+    The array in the segment, initialized with zeros.
+    
+  Note
+  ----
+  The segment persists until it is unlinked via :func:`unlink` by one of the
+  processes using it.
+  """
+  if dtype is None:
+    dtype = float;
+  shape = (shape,) if np.ndim(shape) == 0 else tuple(shape);
+  nbytes = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize;
+  memory = shared_memory.SharedMemory(name=name, create=True, size=max(nbytes, 1));
+  _register(memory);
+  return _wrap(memory, shape, dtype, order);
+
+
+def attach(name, shape, dtype = None, order = None):
+  """Attach to an array in a named shared memory segment.
+  
+  Arguments
+  ---------
+  name : str
+    The name of the segment.
+  shape : tuple of ints
+    The shape of the array.
+  dtype : dtype or None
+    The data type of the array, if None float is used.
+  order : 'C', 'F' or None
+    The order of the array.
+  
+  Returns
+  -------
+  array : array
+    The array in the segment without copying the data.
+  """
+  if dtype is None:
+    dtype = float;
+  with _segments_lock:
+    memory = _segments.get(name);
+  if memory is None:
+    try:
+      memory = shared_memory.SharedMemory(name=name, track=False);
+    except TypeError: # python < 3.13
+      memory = shared_memory.SharedMemory(name=name);
+    memory = _register(memory);
+  shape = (shape,) if np.ndim(shape) == 0 else tuple(shape);
+  nbytes = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize;
+  if nbytes > memory.size:
+    raise ValueError('The segment %r of size %d is too small for an array of %d bytes!' % (name, memory.size, nbytes));
+  return _wrap(memory, shape, dtype, order);
+
+
+def segment_name(array):
+  """Name of the shared memory segment holding an array.
+  
+  Arguments
+  ---------
+  array : array
+    The array.
+  
+  Returns
+  -------
+  name : str or None
+    The name of the segment or None if the array is not in a named segment.
+  """
+  if not isinstance(array, np.ndarray) or len(_segments) == 0:
+    return None;
+  address = array.__array_interface__['data'][0];
+  with _segments_lock:
+    for name, memory in _segments.items():
+      start = np.frombuffer(memory.buf, dtype=np.uint8, count=1).ctypes.data;
+      if start <= address < start + memory.size:
+        return name;
+  return None;
+
+
+def unlink(name):
+  """Remove the name of a shared memory segment.
+  
+  Arguments
+  ---------
+  name : str or array
+    The name of the segment or an array in the segment.
+  
+  Note
+  ----
+  Arrays in the segment stay valid in the processes that attached it, the 
+  memory is released once all of them closed it.
+  """
+  name = _name(name);
+  with _segments_lock:
+    memory = _segments.get(name);
+  if memory is None:
+    memory = shared_memory.SharedMemory(name=name);
+    memory.close();
+  memory.unlink();
+
+
+def close(name):
+  """Close a named shared memory segment in this process.
+  
+  Arguments
+  ---------
+  name : str or array
+    The name of the segment or an array in the segment.
+  
+  Note
+  ----
+  All arrays of the segment in this process need to be deleted before.
+  """
+  name = _name(name);
+  with _segments_lock:
+    if any(a() is not None for a in _segment_arrays.get(name, [])):
+      raise ValueError('The segment %r is still used by arrays in this process!' % name);
+    memory = _segments.pop(name, None);
+    _segment_arrays.pop(name, None);
+  if memory is not None:
+    memory.close();
+
+
+def _name(name):
+  """Segment name from a name or array."""
+  if isinstance(name, np.ndarray):
+    name = segment_name(name);
+    if name is None:
+      raise ValueError('The array is not in a named shared memory segment!');
+  return name;
+
+
+def _register(memory):
+  """Keep a segment open in this process."""
+  with _segments_lock:
+    return _segments.setdefault(memory.name, memory);
+
+
 ###############################################################################
 ### Tests
 ###############################################################################
@@ -279,4 +487,14 @@ def _test():
 
   pool = sma.mp.Pool(processes=4)
   pp = pool.map(propagate_non_shared, zip(range(n), [None] * n)); #analysis:ignore
-  print(non_shared)
\ No newline at end of file
+  print(non_shared)
+
+  # named segments
+  a = sma.zeros((5, 3), dtype='uint16', order='F', segment=True);
+  name = sma.segment_name(a);
+  b = sma.attach(name, shape=(5, 3), dtype='uint16', order='F');
+  b[2, 1] = 7;
+  print(a[2, 1] == 7, sma.is_shared(a))
+  sma.unlink(name);
+  del a, b;
+  sma.close(name);
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+WorkerPool
+==========
+
+Persistent process pool that can be reused across block processing calls.
+
+Starting the worker processes, importing the cython modules and loading the
+look-up tables is done once per worker when the pool starts, instead of in
+every call to :func:`ParallelProcessing.BlockProcessing.process`.
+
+Example
+-------
+>>> import ParallelProcessing.WorkerPool as wp
+>>> import ImageProcessing.binarysmoothing.Smoothing as sm
+>>> with wp.WorkerPool(processes=8, modules=sm.worker_modules) as pool:
+>>>   for source, sink in zip(sources, sinks):
+>>>     sm.smooth_by_configuration(source, sink, processes=pool)
+"""
+__author__    = 'Christoph Kirst <ckirst@rockefeller.edu>'
+__license__   = 'MIT License <http://www.opensource.org/licenses/mit-license.php>'
+__copyright__ = 'Copyright (c) 2019 by Christoph Kirst, The Rockefeller University, New York City'
+
+
+import contextlib
+import importlib
+
+import ParallelProcessing.Parallelism as par
+
+from Utils.utilities import CancelableProcessPoolExecutor
+
+
+default_modules = ['ParallelProcessing.DataProcessing.ArrayProcessing'];
+"""Modules imported in each worker of a pool.
+
+Note
+----
+If a module defines a function `initialize_worker` it is called after the
+import, e.g. to memory map look-up tables.
+"""
+
+
+###############################################################################
+### Worker pool
+###############################################################################
+
+class WorkerPool(CancelableProcessPoolExecutor):
+  """Process pool with workers initialized once for a whole pipeline.
+
+  Arguments
+  ---------
+  processes : int or None
+    The number of worker processes. If None, use the number of processes
+    from :mod:`~ParallelProcessing.Parallelism`.
+  modules : list of str or None
+    Additional modules to import in each worker.
+  threads : int or None
+    The number of kernel threads in each worker. If None, the cpus are
+    split between the workers.
+  """
+  def __init__(self, processes = None, modules = None, threads = None):
+    if processes is None:
+      processes = par.processes();
+    if threads is None:
+      threads = par.threads_per_process(processes);
+    modules = default_modules + [m for m in (modules or []) if m not in default_modules];
+
+    self.processes = processes;
+    self.threads = threads;
+    self.modules = modules;
+
+    #compile cython extensions once before the workers import them
+    for name in modules:
+      importlib.import_module(name);
+
+    super(WorkerPool, self).__init__(max_workers=processes, initializer=initialize_worker, initargs=(modules, threads));
+
+  def __repr__(self):
+    return 'WorkerPool(%d)' % self.processes;
+
+
+def initialize_worker(modules, threads = None):
+  """Import the modules and call their worker initialization."""
+  if threads is not None:
+    par.configure(threads=threads);
+  for name in modules:
+    module = importlib.import_module(name);
+    initialize = getattr(module, 'initialize_worker', None);
+    if initialize is not None:
+      initialize();
+
+
+###############################################################################
+### Helpers
+###############################################################################
+
+def is_pool(processes):
+  """Check if processes is a worker pool."""
+  return isinstance(processes, WorkerPool);
+
+
+def n_processes(processes):
+  """The number of processes from a processes specification or pool."""
+  if is_pool(processes):
+    return processes.processes;
+  return processes;
+
+
+@contextlib.contextmanager
+def executor(processes):
+  """Executor for a processes specification.
+
+  Arguments
+  ---------
+  processes : int or WorkerPool
+    The number of processes or a persistent pool.
+
+  Returns
+  -------
+  executor : Executor
+    A worker pool is returned as is and not shut down at the end of the
+    context, otherwise a new process pool is created and shut down. The 
+    workers of a new pool split the cpus for their kernel threads.
+  """
+  if is_pool(processes):
+    yield processes;
+  else:
+    with par.parallelism(threads=par.threads_per_process(processes)), \
+         CancelableProcessPoolExecutor(max_workers=processes) as pool:
+      yield pool;
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import numpy as np
+  import IO.IO as io
+  import ParallelProcessing.BlockProcessing as bp
+  import ParallelProcessing.WorkerPool as wp
+
+  source = io.as_source(np.asarray(np.random.rand(20,30,40) > 0.5, order='F'));
+
+  with wp.WorkerPool(processes=4) as pool:
+    for i in range(3):
+      count = bp.reduce(np.sum, source, combine=np.add, size_max=10, axes=[2], processes=pool);
+      print(count == np.sum(source.array))
@@ -56,9 +56,12 @@ __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 
 
 import copy
+import functools
 
 import re
 
+import numpy as np
+
 TAG_START = '<';
 TAG_END   = '>';
 TAG_SEPARATOR = ',';
@@ -73,6 +76,12 @@ def ttype_to_dtype(ttype):
   else:
     raise ValueError('The specified tag type %r is not valid!' % ttype);
 
+@functools.lru_cache(maxsize=256)
+def compiled(expression, flags = 0):
+  """Compiled regular expression, cached for repeated matching."""
+  return re.compile(expression, flags);
+
+
 def default_tag_name(index = None):
   tag = 'Tag';
   if index is not None:
@@ -311,9 +320,13 @@ class Expression(object):
         e += p;
     return e;
     
+  def matcher(self):
+    """The compiled regular expression of this expression."""
+    return compiled(self.re());
+  
   def values(self, string):
     tags = self.tags;
-    search = re.compile(self.re()).search;
+    search = self.matcher().search;
     match = search(string);
     if match is None:
       return {};
@@ -342,7 +355,7 @@ class Expression(object):
     
   def indices(self, string):
     tags = self.tags;
-    search = re.compile(self.re()).search;
+    search = self.matcher().search;
     match = search(string);
     if match is None:
       raise ValueError('Cannot infer indices from string!')
@@ -357,6 +370,53 @@ class Expression(object):
     indices = [d[t.label(i)] for t in tags];
     return indices;
   
+  def indices_array(self, strings):
+    """Indices of the tags of many strings.
+    
+    Arguments
+    ---------
+    strings : list of str
+      The strings to match, e.g. a list of file names.
+    
+    Returns
+    -------
+    indices : array
+      The tag indices of each string as array of shape (n_strings, n_tags).
+    
+    Note
+    ----
+    All strings are matched in a single pass of the compiled expression over
+    the joined strings and the tag values are converted as arrays.
+    """
+    tags = self.tags;
+    if len(strings) == 0:
+      return np.zeros((0, len(tags)), dtype=int);
+    
+    text = '\n'.join(strings);
+    groups = None;
+    if '\n' not in ''.join(p for p in self.pattern if not isinstance(p, Tag)):
+      finditer = compiled('^.*?' + self.re() + '.*$', re.MULTILINE).finditer;
+      groups = [m.groups() for m in finditer(text)];
+    if groups is None or len(groups) != len(strings):
+      return np.array([self.indices(s) for s in strings], dtype=int).reshape(len(strings), len(tags));
+    
+    names = list(compiled(self.re()).groupindex.keys());
+    columns = list(zip(*groups));
+    indices = np.zeros((len(strings), len(tags)), dtype=int);
+    for i, t in enumerate(tags):
+      values = np.array(columns[names.index(t.label(i))]);
+      if t.dtype() is int:
+        values = values.astype(int);
+      if t.trange is not None:
+        lookup = {};
+        for j, v in enumerate(t.trange):
+          lookup.setdefault(v, j);
+        values = np.array([lookup[v] for v in values.tolist()]);
+      elif t.dtype() is not int:
+        raise IndexError('No range to determine index for tag %r!' % t);
+      indices[:, i] = values;
+    return indices;
+  
   def tag_names(self):
     return [t.label(i) for i,t in enumerate(self.tags)];
   
@@ -419,54 +479,38 @@ class Expression(object):
     if names is None:
       names = [];
     
-    #detect differences in filenames
+    #detect differences in filenames as runs of differing characters
     s0 = strings[0];
-    tags = [];
-    tag_start = -1;
-    tag_end = -1;
-    for i, c in enumerate(s0):
-      same = True;
-      for s in strings[1:]:
-        if s[i] != c:
-          if i == tag_end:
-            tag_end += 1;
-          else:
-            tag_start = i;
-            tag_end   = i + 1;
-          break;
-      if same and tag_start != -1:
-        tags.append((tag_start, tag_end));
-        tag_start = -1; tag_end = -1;
+    codes = _character_codes(strings);
+    differ = np.any(codes != codes[:1], axis=0);
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], differ, [0]]).astype(int)));
+    tags = [(int(s), int(e)) for s, e in zip(edges[::2], edges[1::2])];
   
     #detect trailing zeros  
     tags_full = [];
+    end = 0;
     for t in tags:
       s,e = t;
-      while s > 0 and s0[s-1] == '0':
+      while s > end and s0[s-1] == '0':
         s -= 1;
       tags_full.append((s,e));
+      end = e;
     tags = tags_full;  
     
     #infer pattern
+    digits = (codes[:max_check] >= ord('0')) & (codes[:max_check] <= ord('9'));
     pattern = [];
     p = 0;
     for i,t in enumerate(tags):
       s,e = t; 
       if s-p > 0:
         pattern.append(s0[p:s]);
-        p = e;
+      p = e;
       
-      ttype = TAG_INT;
-      values = [];
-      for s in strings[:max_check]:
-        v = s[t[0]:t[1]];
-        try:
-          v = int(v);
-        except:
-          ttype = TAG_STR;
-          if not with_trange:
-            break;
-        values.append(v);
+      ttype = TAG_INT if np.all(digits[:, s:e]) else TAG_STR;
+      values = [v[s:e] for v in strings[:max_check]] if with_trange else [];
+      if ttype == TAG_INT:
+        values = [int(v) for v in values];
       if len(names) > 0:
         name = names.pop(0);
       else:
@@ -499,6 +543,14 @@ def detect(strings, names = None, max_check = None, with_trange = False):
   return e;
 
 
+def _character_codes(strings):
+  """Unicode code points of strings of equal length as array of shape (n_strings, length)."""
+  length = len(strings[0]);
+  if length == 0:
+    return np.zeros((len(strings), 0), dtype=np.uint32);
+  return np.array(strings, dtype='U%d' % length).view(np.uint32).reshape(len(strings), length);
+
+
 def escape_glob(string):
   e = '';
   for c in string:
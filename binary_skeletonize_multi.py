@@ -6,7 +6,7 @@ from pathlib import Path
 import numpy as np
 
 import IO.IO as io
-import ParallelProcessing.DataProcessing.ConvolvePointList as cpl
+import ParallelProcessing.Parallelism as par
 import ImageProcessing.skeletonization.PK12 as pk12
 
 
@@ -40,32 +40,25 @@ def parse_args():
     return p.parse_args()
 
 
-def configure_convolution_threads(processes: int | None):
-    """Override ConvolvePointList thread defaults so PK12 uses the requested value."""
-    if processes is None:
-        return
-    if processes < 1:
-        raise ValueError("processes must be >= 1")
-    for fn in (
-        cpl.convolve_3d,
-        cpl.convolve_3d_points,
-        cpl.convolve_3d_xyz,
-        cpl.convolve_3d_indices,
-        cpl.convolve_3d_indices_if_smaller_than,
-    ):
-        defaults = list(fn.__defaults__)
-        defaults[-1] = processes
-        fn.__defaults__ = tuple(defaults)
-
-
 def main():
     args = parse_args()
     t0 = time.perf_counter()
 
-    configure_convolution_threads(args.processes)
+    if args.processes is not None and args.processes < 1:
+        raise ValueError("processes must be >= 1")
+    # PK12 convolutions take their thread count from the central parallelism configuration
+    par.configure(threads=args.processes)
 
     print("[1/3] 读取 TIFF:", args.input_tif, flush=True)
-    vol = io.read(args.input_tif)
+    source = io.as_source(args.input_tif)
+    # 若有占用金字塔边车文件，只读取并细化非空砖块的包围盒 (外扩 1 体素保持边界为空)
+    occupancy = io.occupancy(source)
+    box = None if occupancy is None else occupancy.bounding_box(margin=1)
+    if box is not None:
+        print("    按占用金字塔裁剪到包围盒:", box, flush=True)
+        vol = source[tuple(slice(lo, hi) for lo, hi in box)]
+    else:
+        vol = io.read(args.input_tif)
     print("    形状:", vol.shape, "dtype:", vol.dtype, flush=True)
 
     print("[2/3] 转换为 Fortran-order 二值数组", flush=True)
@@ -83,9 +76,15 @@ def main():
         verbose=True,
     )
 
+    if box is not None:
+        cropped = skeleton
+        skeleton = np.zeros(source.shape, dtype=bool, order="F")
+        skeleton[tuple(slice(lo, hi) for lo, hi in box)] = cropped
+        del cropped
+
     output_path = Path(args.output_tif)
     output_path.parent.mkdir(parents=True, exist_ok=True)
-    io.write(str(output_path), np.asarray(skeleton, dtype=np.uint8))
+    io.write(str(output_path), skeleton, dtype=np.uint8)
     print("完成，输出:", output_path, "总耗时: %.2fs" % (time.perf_counter() - t0), flush=True)
 
 
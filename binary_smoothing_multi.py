@@ -1,27 +1,12 @@
 import time
 import argparse
-import gc
 from pathlib import Path
 import numpy as np
 import IO.IO as io
 import IO.MMP as mmp
+import IO.TIF as tif
 import ImageProcessing.binarysmoothing.Smoothing as sm
-
-
-def calculate_blockshape_by_processes(full_shape, num_processes):
-    """根据进程数计算合适的块大小 (size_max)。"""
-    if num_processes <= 1:
-        return full_shape
-
-    total_voxels = np.prod(full_shape)
-    target_voxels_per_block = total_voxels / num_processes
-    current_shape = list(full_shape)
-
-    while np.prod(current_shape) > target_voxels_per_block:
-        longest_axis = np.argmax(current_shape)
-        current_shape[longest_axis] = max(16, current_shape[longest_axis] // 2)
-
-    return tuple(current_shape)
+import ParallelProcessing.BlockManifest as bm
 
 
 def parse_args():
@@ -30,6 +15,11 @@ def parse_args():
     parser.add_argument("output_tif", help="输出 TIFF 文件路径")
     parser.add_argument("--iterations", type=int, default=2, help="平滑迭代次数 (默认: 2)")
     parser.add_argument("--processes", type=int, default=1, help="并行进程数 (默认: 1, 即串行)")
+    parser.add_argument("--memory-limit", type=float, default=None, help="内存预算 (GB)，据此推导块大小与进程数 (默认: 当前可用内存)")
+    parser.add_argument("--resume", action="store_true", help="记录已完成的块，中断后以相同参数重新运行时跳过这些块")
+    parser.add_argument("--incremental", action="store_true", help="保存各输入块(含 halo)的哈希，重新运行时只计算输入发生变化的块")
+    parser.add_argument("--exchange-halos", action="store_true", help="逐次迭代并在块间交换 1 体素 halo，避免重叠随迭代次数增大")
+    parser.add_argument("--retries", type=int, default=0, help="失败块的重试次数 (默认: 0)")
     return parser.parse_args()
 
 
@@ -43,29 +33,14 @@ def main():
     processes_param = None if args.processes <= 1 else args.processes
 
     t0 = time.perf_counter()
-    print("[1/5] 读取 TIFF 到内存:", input_tif, flush=True)
-    vol = io.read(input_tif)
-    print("    读取完成，形状:", vol.shape, "dtype:", vol.dtype, "耗时: %.2fs" % (time.perf_counter() - t0), flush=True)
-
-    # 转换为 bool (内存操作)
-    print("[2/5] 转换为二值数据...", flush=True)
-    source_array = (vol > 0)
-    del vol
-    gc.collect()
-
-    # 使用 memmap 保存二值数据，避免后续进程间拷贝
+    # 按 z 分段流式读取 TIFF，二值化后直接写入 F-order bool memmap，峰值内存只有几个分段
     output_path.parent.mkdir(parents=True, exist_ok=True)
     memmap_source_path = output_path.with_name(output_path.name + ".source.mmp.npy")
-    print(f"    创建/覆盖 memmap 源文件: {memmap_source_path}", flush=True)
-    source_mmp = mmp.create(
-        location=str(memmap_source_path),
-        shape=source_array.shape,
-        dtype=bool,
-        order='F'
-    )
-    source_mmp[:] = source_array.astype(bool, copy=False)
-    del source_array
-    gc.collect()
+    print("[1/5] 流式读取 TIFF:", input_tif, flush=True)
+    print(f"[2/5] 二值化并写入 memmap 源文件: {memmap_source_path}", flush=True)
+    # 同时统计各砖块的前景体素数，写出占用金字塔边车文件，平滑时跳过空块
+    source_mmp = tif.convert(input_tif, str(memmap_source_path), threshold=0, occupancy=True, processes=args.processes)
+    print("    读取完成，形状:", source_mmp.shape, "耗时: %.2fs" % (time.perf_counter() - t0), flush=True)
 
     # -----------------------------------------------------------
     # 生成查找表
@@ -78,17 +53,18 @@ def main():
     # -----------------------------------------------------------
     # 分块参数
     # -----------------------------------------------------------
-    processing_parameter = {}
+    # 块大小与进程数由内存预算推导 (平滑函数声明了每体素内存占用与 halo)
+    # 分块形状 (slab/pencil/cube) 自动选择，使重叠区域的冗余计算最少
+    memory_limit = None if args.memory_limit is None else int(args.memory_limit * 1e9)
+    processing_parameter = {"memory_limit": memory_limit, "manifest": args.resume, "retries": args.retries,
+                            "incremental": args.incremental, "occupancy": True}
     if args.processes > 1:
-        max_block_size = calculate_blockshape_by_processes(source_mmp.shape, args.processes)
-        processing_parameter = {
-            "size_max": max_block_size,
-            "axes": [0, 1, 2],
-            "optimization": False,
+        processing_parameter.update({
+            "axes": "optimal",
             # memmap 支持按块加载，不需要额外内存开销
             "as_memory": True
-        }
-        print(f"    [自动分块] 进程数: {args.processes}, size_max: {max_block_size}", flush=True)
+        })
+        print(f"    [自动分块] 进程数: {args.processes}, 内存预算: {args.memory_limit or '可用内存'} GB", flush=True)
 
     # -----------------------------------------------------------
     # 进行拓扑平滑
@@ -98,12 +74,18 @@ def main():
 
     # 输出 memmap，平滑结果直接写入，不占用额外内存
     memmap_result_path = output_path.with_name(output_path.name + ".smooth.mmp.npy")
-    print(f"    创建/覆盖 memmap 结果文件: {memmap_result_path}", flush=True)
+    # 续跑或增量计算时保留已有结果文件，已完成或未变化的块不再重新计算
+    resume_sink = (args.resume or args.incremental) and memmap_result_path.exists()
+    print(f"    {'打开已有' if resume_sink else '创建/覆盖'} memmap 结果文件: {memmap_result_path}", flush=True)
+    if not resume_sink:
+        # 新建结果文件时删除旧的 manifest/哈希记录，否则会误判块已完成而留下全零结果
+        bm.discard(str(memmap_result_path))
     result_sink = mmp.create(
         location=str(memmap_result_path),
         shape=source_mmp.shape,
         dtype=bool,
-        order=source_mmp.order
+        order=source_mmp.order,
+        mode="r+" if resume_sink else None
     )
 
     # 直接传入 memmap，子进程从磁盘按块读取，避免 pickling 大数组
@@ -113,15 +95,10 @@ def main():
         iterations=args.iterations,
         processes=processes_param,
         processing_parameter=processing_parameter,
+        exchange_halos=args.exchange_halos,
         verbose=True
     )
     
-    # sm.smooth_by_configuration 返回的可能是 Source 对象或 array
-    if hasattr(result, 'array'):
-        result_array = result.array
-    else:
-        result_array = result
-
     print("    平滑完成，耗时: %.2fs" % (time.perf_counter() - t2), flush=True)
 
     # -----------------------------------------------------------
@@ -133,9 +110,8 @@ def main():
     # 确保输出目录存在
     Path(output_tif).parent.mkdir(parents=True, exist_ok=True)
     
-    # 转换为普通 ndarray 再写出，避免把 memmap 当成 MMP 源导致写入路径为空
-    result_uint8 = np.asarray(result_array, dtype=np.uint8)
-    io.write(output_tif, result_uint8)
+    # 按 z 分段从结果 memmap 流式写出 uint8 BigTIFF，不在内存中物化整个结果
+    tif.write(output_tif, io.as_source(result), dtype=np.uint8, occupancy=True)
     print("    写出完成，耗时: %.2fs" % (time.perf_counter() - t3), flush=True)
     
     print("全流程耗时: %.2fs" % (time.perf_counter() - t0), flush=True)
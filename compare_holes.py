@@ -1,7 +1,7 @@
 import argparse
 import numpy as np
-import scipy.ndimage as ndi
 import IO.IO as io
+import ImageProcessing.Topology.Topology3d as t3d
 
 def parse_args():
     p = argparse.ArgumentParser(description="比较两幅二值体的内部空洞数量与体素体积")
@@ -17,36 +17,9 @@ def parse_args():
     return p.parse_args()
 
 def count_cavities(binary: np.ndarray, connectivity: int):
-    """返回空洞个数与空洞体素总数"""
+    """返回空洞个数与空洞体素总数（从边界泛洪背景，仅对空洞体素做连通分量统计）"""
     binary = np.asarray(binary, dtype=bool)
-    background = ~binary
-    structure = ndi.generate_binary_structure(3, connectivity)
-    labels, n = ndi.label(background, structure=structure)
-    if n == 0:
-        return 0, 0
-
-    # 找到接触边界的背景标签
-    touching = set()
-    slices = [
-        labels[0, :, :],
-        labels[-1, :, :],
-        labels[:, 0, :],
-        labels[:, -1, :],
-        labels[:, :, 0],
-        labels[:, :, -1],
-    ]
-    for s in slices:
-        touching.update(np.unique(s))
-
-    # 空洞 = 未接触边界的背景分量
-    all_ids = np.arange(1, n + 1)
-    cavity_ids = np.setdiff1d(all_ids, list(touching), assume_unique=False)
-    if cavity_ids.size == 0:
-        return 0, 0
-
-    counts = np.bincount(labels.ravel())
-    voxel_total = int(counts[cavity_ids].sum())
-    return int(cavity_ids.size), voxel_total
+    return t3d.count_cavities(binary, connectivity=connectivity)
 
 def summarize(path, connectivity):
     arr = io.read(path)
@@ -0,0 +1,55 @@
+import json
+import argparse
+import IO.IO as io
+import ImageProcessing.Topology.VolumeMetrics as vm
+
+def parse_args():
+    p = argparse.ArgumentParser(description="单次流式读取，比较两幅二值体的体素数、连通分量、欧拉示性数与空洞")
+    p.add_argument("before_path", help="处理前 TIFF 路径")
+    p.add_argument("after_path", help="处理后 TIFF 路径")
+    p.add_argument("--output-json", default="compare_metrics.json", help="JSON 报告输出路径 (默认: compare_metrics.json)")
+    p.add_argument(
+        "--connectivity",
+        type=int,
+        choices=[1, 2, 3],
+        default=1,
+        help="空洞判定的背景连通性：1=6邻域, 2=18邻域, 3=26邻域 (默认 1)",
+    )
+    p.add_argument("--slab-size", type=int, default=None, help="每个任务处理的 z 层数 (默认: %d)" % vm.default_slab_size)
+    p.add_argument("--processes", default=None, help="进程数，或 'serial' (默认: CPU 核数)")
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    processes = args.processes
+    if processes is not None and processes != "serial":
+        processes = int(processes)
+
+    print("[1/2] 流式分析:", args.before_path, "&", args.after_path, flush=True)
+    before, after = vm.analyze_sources(
+        [args.before_path, args.after_path],
+        slab_size=args.slab_size,
+        connectivity=args.connectivity,
+        # 有占用金字塔边车文件时只分析前景包围盒，结果不变
+        occupancy=True,
+        processes=processes,
+        verbose=True,
+    )
+
+    report = {
+        "before": dict(path=args.before_path, **before),
+        "after": dict(path=args.after_path, **after),
+        "difference": {k: after[k] - before[k] for k in before},
+        "connectivity": args.connectivity,
+    }
+
+    print("[2/2] 写出报告:", args.output_json, flush=True)
+    with open(args.output_json, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print("\n=== 结果 ===")
+    for key in before:
+        print(f"  {key}: before={before[key]}, after={after[key]}, 差值={after[key] - before[key]}")
+
+if __name__ == "__main__":
+    main()